@@ -0,0 +1,147 @@
+import hashlib
+import os
+import pickle
+
+import analysis
+import macho
+
+
+# Per-user directory for the on-disk caches. The caches are pickles, so the directory must not be writable by anybody
+# else: it's created with mode 0700, and an existing one that isn't ours (or is accessible to others) isn't used.
+def cache_directory():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    path = os.path.join(base, "cricket")
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.lstat(path)
+    if st.st_uid != os.getuid() or (st.st_mode & 0o077) != 0:
+        raise OSError("Refusing to use cache directory %s" % path)
+    return path
+
+
+# On-disk cache of the Binary-level analysis results (functions, block descriptors and literals, dyld info, selectors,
+# class refs, cfstrings, ivars, the xref index, function summaries), so that re-opening a binary doesn't have to scan it
+# again. The cache file is keyed by the contents of the binary and the architecture, and every entry carries a digest
+# of the analysis and Mach-O parsing code, so any change to the code invalidates it. Only plain tuples and dicts are stored, the objects
+# are recreated on load.
+class BinaryAnalysisCache:
+    FORMAT_VERSION = 2
+
+    def __init__(self, binary):
+        self.binary = binary
+        ":type: Binary"
+        self.binary_digest = None
+        self.code_digest = None
+
+    def compute_binary_digest(self):
+        if self.binary_digest is not None: return self.binary_digest
+
+        self.binary.get_macho()
+        checksum = hashlib.md5()
+        if self.binary.shared_cache is not None:
+            # Hashing the whole cache for every image would take longer than analyzing it. The cache header (with the
+            # UUID) and the image's path identify the image.
+            checksum.update(self.binary.macho.file[:0x1000])
+            checksum.update(self.binary.shared_cache.image(self.binary.image_name).path.encode('utf-8'))
+        else:
+            checksum.update(self.binary.macho.file)
+        checksum.update(self.binary.arch.archvalue.encode('utf-8'))
+        # The discovery mode changes the set of functions.
+        checksum.update(repr((self.binary.use_function_starts, self.binary.supplement_function_starts)).encode('utf-8'))
+        self.binary_digest = checksum.hexdigest()
+        return self.binary_digest
+
+    def compute_code_digest(self):
+        if self.code_digest is not None: return self.code_digest
+
+        checksum = hashlib.md5()
+        checksum.update(str(self.FORMAT_VERSION).encode('utf-8'))
+        # The analysis code and EcaFretni, which parses the Mach-O (bind info, function starts, shared caches, Obj-C).
+        code_roots = [os.path.dirname(os.path.abspath(analysis.__file__)),
+                      os.path.dirname(os.path.dirname(os.path.abspath(macho.__file__)))]
+        for code_root in code_roots:
+            for (dirpath, dirnames, filenames) in os.walk(code_root):
+                dirnames.sort()
+                for f in sorted(filenames):
+                    if not f.endswith(".py"): continue
+                    checksum.update(os.path.relpath(os.path.join(dirpath, f), code_root).encode('utf-8'))
+                    with open(os.path.join(dirpath, f), 'rb') as source:
+                        checksum.update(source.read())
+        self.code_digest = checksum.hexdigest()
+        return self.code_digest
+
+    def cache_file(self):
+        return os.path.join(cache_directory(), "analysis-%s.cache" % self.compute_binary_digest())
+
+    # Returns True if the analysis results were restored into the binary.
+    def load(self):
+        try:
+            with open(self.cache_file(), "rb") as f:
+                (code_digest, data) = pickle.load(f)
+            if code_digest != self.compute_code_digest(): return False
+        except:
+            return False  # Ignore all cache failures, the binary will just be analyzed again.
+
+        self.restore(data)
+        return True
+
+    def save(self):
+        data = self.collect()
+        try:
+            cache_file = self.cache_file()
+            tmp_file = "%s.%d.tmp" % (cache_file, os.getpid())
+            with open(tmp_file, "wb") as f:
+                pickle.dump((self.compute_code_digest(), data), f, -1)
+            os.replace(tmp_file, cache_file)
+        except:
+            pass  # Not being able to write the cache is not an error.
+
+    def collect(self):
+        b = self.binary
+        return {
+            "code_section": (b.code_section_start, b.code_section_end),
+            "functions": [(f.addr, f.name, f.len) for f in b.functions],
+            "block_descriptors": [(d.name, d.addr, d.literal_size, d.copy_addr, d.dispose_addr, d.signature) for d in b.block_descriptors],
+            "global_block_literals": [(l.addr, l.invoke_addr, l.block_descriptor_addr, l.name) for l in b.global_block_literals],
+            "block_references": b.block_references,
+            "stubs": b.stubs,
+            "external_pointers": b.external_pointers,
+            "imported_data_symbols": b.imported_data_symbols,
+            "selectors": [(s.name, s.addr, s.string_location) for s in b.selectors.values()],
+            "class_refs": [(r.symbol_name, r.class_name, r.addr, r.class_location, r.external_dylib) for r in b.class_refs.values()],
+            "cfstrings": [(s.name, s.addr, s.string, s.length) for s in b.cfstrings.values()],
+            "ivars": [(i.name, i.addr, i.offset) for i in b.ivars.values()],
+            "xrefs": b.xrefs.index.to_bytes(),
+            "function_summaries": [s.to_tuple() for s in b.function_summaries.values()],
+        }
+
+    def restore(self, data):
+        from analysis.binary import ObjCBlockDescriptor, ObjCCFString, ObjCClassRef, ObjCGlobalBlockLiteral, ObjCIVar, \
+            ObjCSelector
+        from analysis.function import Function
+        from analysis.summaries import FunctionSummary
+        from analysis.xrefs import BinaryXrefs, XrefIndex
+
+        b = self.binary
+        (b.code_section_start, b.code_section_end) = data["code_section"]
+
+        for (addr, name, length) in data["functions"]:
+            func = Function(b.arch, b, name, addr, length)
+            func.binary = b
+            b.functions.append(func)
+            b.addr_to_func_map[addr] = func
+        b.build_function_index()
+        b.xrefs = BinaryXrefs(b, XrefIndex.from_bytes(data["xrefs"]))
+
+        b.block_descriptors = [ObjCBlockDescriptor(*args) for args in data["block_descriptors"]]
+        b.global_block_literals = [ObjCGlobalBlockLiteral(*args) for args in data["global_block_literals"]]
+        b.block_references = data["block_references"]
+        b.link_block_references(b.block_references)
+
+        b.stubs = data["stubs"]
+        b.external_pointers = data["external_pointers"]
+        b.imported_data_symbols = data["imported_data_symbols"]
+        b.selectors = dict([(args[1], ObjCSelector(*args)) for args in data["selectors"]])
+        b.class_refs = dict([(args[2], ObjCClassRef(*args)) for args in data["class_refs"]])
+        b.cfstrings = dict([(args[1], ObjCCFString(*args)) for args in data["cfstrings"]])
+        b.ivars = dict([(args[1], ObjCIVar(*args)) for args in data["ivars"]])
+        b.function_summaries = dict([(t[0], FunctionSummary.from_tuple(t)) for t in data["function_summaries"]])
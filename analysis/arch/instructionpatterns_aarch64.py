@@ -1,6 +1,6 @@
 import copy
-import re
 
+import capstone.arm64_const
 from capstone import *
 from capstone.arm64_const import *
 
@@ -11,6 +11,69 @@ class AnyObject(object):
     pass
 
 
+# Prologue and epilogue instructions are classified by their capstone ids and register operands, not by their text.
+X_REGISTERS = frozenset([getattr(capstone.arm64_const, "ARM64_REG_X%d" % i) for i in range(31)])
+# "mov x29, sp" is an alias of "add x29, sp, #0", capstone may report either id, so it's told apart by the mnemonic.
+MOV_ALIAS_IDS = frozenset([ARM64_INS_MOV, ARM64_INS_ADD, ARM64_INS_ORR])
+
+
+def reg_operand(csinstr, idx):
+    ops = csinstr.operands
+    if len(ops) <= idx or ops[idx].type != ARM64_OP_REG: return None
+    return ops[idx].reg
+
+
+def mem_operand(csinstr, idx):
+    ops = csinstr.operands
+    if len(ops) <= idx or ops[idx].type != ARM64_OP_MEM: return None
+    return ops[idx].mem
+
+
+def has_registers(csinstr, reg0, reg1):
+    return reg_operand(csinstr, 0) == reg0 and reg_operand(csinstr, 1) == reg1
+
+
+def is_sub_sp_sp(csinstr):
+    return csinstr.id == ARM64_INS_SUB and has_registers(csinstr, ARM64_REG_SP, ARM64_REG_SP)
+
+
+def is_add_sp_sp(csinstr):
+    return csinstr.id == ARM64_INS_ADD and has_registers(csinstr, ARM64_REG_SP, ARM64_REG_SP)
+
+
+def is_mov(csinstr, dst, src):
+    return csinstr.id in MOV_ALIAS_IDS and csinstr.mnemonic == "mov" and has_registers(csinstr, dst, src)
+
+
+def is_add_fp_sp(csinstr):
+    if csinstr.id != ARM64_INS_ADD or csinstr.mnemonic != "add": return False
+    return has_registers(csinstr, ARM64_REG_X29, ARM64_REG_SP)
+
+
+def is_sub_sp_fp(csinstr):
+    return csinstr.id == ARM64_INS_SUB and has_registers(csinstr, ARM64_REG_SP, ARM64_REG_X29)
+
+
+# "stp x29, x30, [sp, #...]", with a non-zero offset.
+def is_save_fp_lr(csinstr):
+    if csinstr.id != ARM64_INS_STP or not has_registers(csinstr, ARM64_REG_X29, ARM64_REG_X30): return False
+    mem = mem_operand(csinstr, 2)
+    return mem is not None and mem.base == ARM64_REG_SP and mem.disp != 0
+
+
+def is_restore_fp_lr(csinstr):
+    if csinstr.id != ARM64_INS_LDP or not has_registers(csinstr, ARM64_REG_X29, ARM64_REG_X30): return False
+    return mem_operand(csinstr, 2) is not None
+
+
+# "stp/ldp xN, xM, [sp...]"
+def is_pair_on_stack(csinstr, ins_id):
+    if csinstr.id != ins_id: return False
+    if reg_operand(csinstr, 0) not in X_REGISTERS or reg_operand(csinstr, 1) not in X_REGISTERS: return False
+    mem = mem_operand(csinstr, 2)
+    return mem is not None and mem.base == ARM64_REG_SP
+
+
 class InstructionPatternsAArch64:
     def __init__(self, arch):
         self.arch = arch
@@ -47,18 +110,14 @@ class InstructionPatternsAArch64:
         ni.csinstr.cc = ARM64_CC_INVALID
         return ni
 
-    def all_instructions_startwith(self, instrs, s):
-        for instr in instrs:
-            if not instr.canonicalsyntax.startswith(s): return False
-        return True
-
-    def all_instructions_match(self, instrs, r):
+    def all_instructions(self, instrs, predicate):
         for instr in instrs:
-            if not re.match(r, instr.canonicalsyntax): return False
+            if not predicate(instr.csinstr): return False
         return True
 
     def detect_pattern(self, function):
         first_instr = function.bbs[0].instructions[0]
+        first = first_instr.csinstr
 
         last_instrs = []
         for bb in function.bbs:
@@ -69,43 +128,42 @@ class InstructionPatternsAArch64:
                     elif last_instr.mnem == "b": last_instr = bb.instructions[-2]
                 last_instrs.append(last_instr)
 
-        if first_instr.canonicalsyntax.startswith("sub sp, sp,"):
-            if self.all_instructions_startwith(last_instrs, "add sp, sp,"):
+        if is_sub_sp_sp(first):
+            if self.all_instructions(last_instrs, is_add_sp_sp):
                 p = InstructionPattern()
                 p.matched_instructions = [first_instr] + last_instrs
                 p.name = "Make space for local variables"
                 return p
 
-        if first_instr.canonicalsyntax.startswith("stp x29, x30, [sp,"):
-            if self.all_instructions_startwith(last_instrs, "ldp x29, x30, ["):
+        if is_save_fp_lr(first):
+            if self.all_instructions(last_instrs, is_restore_fp_lr):
                 p = InstructionPattern()
                 p.matched_instructions = [first_instr] + last_instrs
                 p.name = "Save SP and LR"
                 return p
 
-        if first_instr.canonicalsyntax.startswith("mov x29, sp"):
-            if self.all_instructions_startwith(last_instrs, "mov sp, x29"):
+        if is_mov(first, ARM64_REG_X29, ARM64_REG_SP):
+            if self.all_instructions(last_instrs, lambda i: is_mov(i, ARM64_REG_SP, ARM64_REG_X29)):
                 p = InstructionPattern()
                 p.matched_instructions = [first_instr] + last_instrs
                 p.name = "Setup FP"
                 return p
 
-        if first_instr.canonicalsyntax.startswith("sub sp, sp,"):
+        if is_sub_sp_sp(first):
             p = InstructionPattern()
             p.matched_instructions = [first_instr]
             p.name = "Make space for local variables"
             return p
 
-        m = re.match("^stp x([0-9]+), x([0-9]+), \\[sp", first_instr.canonicalsyntax)
-        if m:
-            if self.all_instructions_match(last_instrs, "^ldp x([0-9]+), x([0-9]+), \\[sp"):
+        if is_pair_on_stack(first, ARM64_INS_STP):
+            if self.all_instructions(last_instrs, lambda i: is_pair_on_stack(i, ARM64_INS_LDP)):
                 p = InstructionPattern()
                 p.matched_instructions = [first_instr] + last_instrs
                 p.name = "Save preserved registers"
                 return p
 
-        if first_instr.canonicalsyntax.startswith("add x29, sp,"):
-            if self.all_instructions_startwith(last_instrs, "sub sp, x29,"):
+        if is_add_fp_sp(first):
+            if self.all_instructions(last_instrs, is_sub_sp_fp):
                 p = InstructionPattern()
                 p.matched_instructions = [first_instr] + last_instrs
                 p.name = "Setup FP"
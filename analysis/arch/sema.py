@@ -25,6 +25,11 @@ class Sema():
     def guess_pointers(self, csinstr, lookahead, min_addr, max_addr):
         assert False
 
+    # All absolute addresses the instruction refers to, loaded from, or stores to (for the xref index). 'lookahead' is
+    # the list of following instructions, for addresses built by instruction pairs.
+    def data_references(self, csinstr, lookahead):
+        return self.guess_pointers(csinstr, lookahead, 0, 1 << 64)
+
     @abstractmethod
     def looks_like_a_function_start(self, address, instructions):
         assert False
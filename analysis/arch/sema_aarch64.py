@@ -1,14 +1,29 @@
-import re
-
 from capstone.arm64_const import *
 
 from analysis.arch.cg_aarch64 import CodeGenAArch64
 from analysis.function import FunctionVariable
-from analysis.arch.instructionpatterns_aarch64 import InstructionPatternsAArch64
+from analysis.arch.instructionpatterns_aarch64 import InstructionPatternsAArch64, X_REGISTERS, reg_operand
 from analysis.arch.sema import Sema
 from analysis.types import IntegerType, PointerType, VariadicArguments
 
 
+# Instruction classification tables, keyed by capstone instruction ids.
+BRANCH_IDS = frozenset([  # list from capstone.arm64_const
+    ARM64_INS_B,
+    ARM64_INS_BL,
+    ARM64_INS_BLR,
+    ARM64_INS_BR,
+    ARM64_INS_CBZ,
+    ARM64_INS_CBNZ,
+    ARM64_INS_TBZ,
+    ARM64_INS_TBNZ,
+])
+COMPARE_AND_BRANCH_IDS = frozenset([ARM64_INS_CBZ, ARM64_INS_CBNZ, ARM64_INS_TBZ, ARM64_INS_TBNZ])
+UNCONDITIONAL_JUMP_IDS = frozenset([ARM64_INS_B, ARM64_INS_BLR, ARM64_INS_BR])
+STACK_ACCESS_IDS = frozenset([ARM64_INS_STR, ARM64_INS_STUR, ARM64_INS_LDR, ARM64_INS_LDUR, ARM64_INS_STRB,
+                              ARM64_INS_LDRB, ARM64_INS_LDRSW])
+
+
 class SemaAArch64(Sema):
     def __init__(self, arch):
         Sema.__init__(self, arch)
@@ -50,22 +65,26 @@ class SemaAArch64(Sema):
 
         return ret
 
+    # Besides "adrp; add", picks up "adrp x8, #0x100008000; ldr x1, [x8, #0xc50]" (selector refs, class refs, ivar
+    # offsets are all loaded like this).
+    def data_references(self, csinstr, lookahead):
+        ret = self.guess_pointers(csinstr, lookahead, 0, 1 << 64)
+        if csinstr.id == ARM64_INS_ADRP and lookahead is not None and len(lookahead) >= 1:
+            csinstr2 = lookahead[0]
+            if csinstr2.id in [ARM64_INS_LDR, ARM64_INS_STR] and len(csinstr2.operands) == 2 \
+                    and csinstr2.operands[1].type == ARM64_OP_MEM \
+                    and csinstr2.operands[1].mem.base == csinstr.operands[0].reg \
+                    and csinstr2.operands[1].mem.index == ARM64_REG_INVALID:
+                ret.append(csinstr.operands[1].imm + csinstr2.operands[1].mem.disp)
+        return ret
+
     def looks_like_a_function_start(self, address, instructions):
         if len(instructions) < 2: return False  # Non-decodable instructions.
 
         return False  # TODO
 
     def is_branch(self, instruction):
-        return instruction.csinstr.id in [  # list from capstone.arm64_const
-            ARM64_INS_B,
-            ARM64_INS_BL,
-            ARM64_INS_BLR,
-            ARM64_INS_BR,
-            ARM64_INS_CBZ,
-            ARM64_INS_CBNZ,
-            ARM64_INS_TBZ,
-            ARM64_INS_TBNZ,
-        ]
+        return instruction.csinstr.id in BRANCH_IDS
 
     def is_bl(self, instruction):
         return instruction.csinstr.id == ARM64_INS_BL
@@ -73,20 +92,18 @@ class SemaAArch64(Sema):
     def is_unconditional_jump(self, instruction):
         is_branch = self.is_branch(instruction)
         is_unconditional = instruction.csinstr.cc == ARM64_CC_INVALID or instruction.csinstr.cc == ARM64_CC_AL
-        if instruction.csinstr.id in [ARM64_INS_CBZ, ARM64_INS_CBNZ, ARM64_INS_TBZ, ARM64_INS_TBNZ]: is_unconditional = False
+        if instruction.csinstr.id in COMPARE_AND_BRANCH_IDS: is_unconditional = False
         is_bl = self.is_bl(instruction)
         return is_branch and is_unconditional and not is_bl
 
     def is_unconditional_jump_csinstr(self, csinstr):
         is_unconditional = csinstr.cc == ARM64_CC_INVALID or csinstr.cc == ARM64_CC_AL
-        return is_unconditional and csinstr.id in [ARM64_INS_B,
-            ARM64_INS_BLR,
-            ARM64_INS_BR]
+        return is_unconditional and csinstr.id in UNCONDITIONAL_JUMP_IDS
 
     def is_conditional_jump(self, instruction):
         is_branch = self.is_branch(instruction)
         is_unconditional = instruction.csinstr.cc == ARM64_CC_INVALID or instruction.csinstr.cc == ARM64_CC_AL
-        if instruction.csinstr.id in [ARM64_INS_CBZ, ARM64_INS_CBNZ, ARM64_INS_TBZ, ARM64_INS_TBNZ]: is_unconditional = False
+        if instruction.csinstr.id in COMPARE_AND_BRANCH_IDS: is_unconditional = False
         return is_branch and not is_unconditional
 
     def is_return(self, instruction):
@@ -133,7 +150,7 @@ class SemaAArch64(Sema):
     def looks_like_stack_var_access(self, instr):
         base = None
 
-        if instr.csinstr.id in [ARM64_INS_STR, ARM64_INS_STUR, ARM64_INS_LDR, ARM64_INS_LDUR, ARM64_INS_STRB, ARM64_INS_LDRB, ARM64_INS_LDRSW]:
+        if instr.csinstr.id in STACK_ACCESS_IDS:
             if len(instr.csinstr.operands) == 2:
                 ptr_op = instr.csinstr.operands[1]
                 if ptr_op.type == ARM64_OP_MEM:
@@ -203,19 +220,18 @@ class SemaAArch64(Sema):
     def match_switch_jump_points(self, instrs):
         pts = []
 
+        # "add xA, xB, xC" (no shift or extend) followed by "br xA".
         for (idx, instruction) in enumerate(instrs):
-            if instrs[idx].csinstr.mnemonic == "add":
-                m = re.match("^(x[0-9]+), (x[0-9]+), (x[0-9]+)$", instrs[idx].csinstr.op_str)
-                if m is not None:
-                    reg1 = m.group(1)
-                    reg2 = m.group(1)
-                    reg3 = m.group(1)
-                    if reg1 == reg2:
-                        for idx2 in range(idx, min(idx+3, len(instrs))):
-                            if instrs[idx2].csinstr.mnemonic == "br":
-                                if instrs[idx2].csinstr.op_str == reg1:
-                                    pts.append((instrs[idx2], "r8"))  # TODO, find real register to switch on
-                                    break
+            csinstr = instruction.csinstr
+            if csinstr.id == ARM64_INS_ADD and csinstr.mnemonic == "add" and len(csinstr.operands) == 3:
+                regs = [reg_operand(csinstr, i) for i in range(3)]
+                if all([r in X_REGISTERS for r in regs]) and csinstr.operands[2].shift.type == ARM64_SFT_INVALID \
+                        and csinstr.operands[2].ext == ARM64_EXT_INVALID:
+                    for idx2 in range(idx, min(idx+3, len(instrs))):
+                        csinstr2 = instrs[idx2].csinstr
+                        if csinstr2.id == ARM64_INS_BR and reg_operand(csinstr2, 0) == regs[0]:
+                            pts.append((instrs[idx2], "r8"))  # TODO, find real register to switch on
+                            break
 
         return pts
 
@@ -1,5 +1,3 @@
-import re
-
 from capstone.x86_const import *
 
 from analysis.arch.cg_x86 import CodeGenX86
@@ -9,6 +7,42 @@ from analysis.types import IntegerType, PointerType, FloatingPointType, Variadic
 from analysis.arch.sema import Sema
 
 
+# Instruction classification tables, keyed by capstone instruction and register ids.
+CONDITIONAL_JUMP_IDS = frozenset([  # list from capstone.x86_const
+    X86_INS_JAE,
+    X86_INS_JA,
+    X86_INS_JBE,
+    X86_INS_JB,
+    X86_INS_JCXZ,
+    X86_INS_JECXZ,
+    X86_INS_JE,
+    X86_INS_JGE,
+    X86_INS_JG,
+    X86_INS_JLE,
+    X86_INS_JL,
+    # X86_INS_JMP,
+    X86_INS_JNE,
+    X86_INS_JNO,
+    X86_INS_JNP,
+    X86_INS_JNS,
+    X86_INS_JO,
+    X86_INS_JP,
+    X86_INS_JRCXZ,
+    X86_INS_JS,
+])
+FRAME_POINTER_REGISTERS = frozenset([X86_REG_RBP, X86_REG_EBP])
+STACK_POINTER_REGISTERS = frozenset([X86_REG_RSP, X86_REG_ESP])
+# Registers a switch jump table's "add reg, reg; jmp reg" may use.
+SWITCH_REGISTERS = frozenset([X86_REG_RAX, X86_REG_RBX, X86_REG_RCX, X86_REG_RDX, X86_REG_RSI, X86_REG_RDI, X86_REG_R8,
+                              X86_REG_R9, X86_REG_EAX, X86_REG_EBX, X86_REG_ECX, X86_REG_EDX, X86_REG_ESI, X86_REG_EDI])
+
+
+def reg_operand(csinstr, idx):
+    ops = csinstr.operands
+    if len(ops) <= idx or ops[idx].type != X86_OP_REG: return None
+    return ops[idx].reg
+
+
 class SemaX86(Sema):
     def __init__(self, arch):
         Sema.__init__(self, arch)
@@ -19,7 +53,7 @@ class SemaX86(Sema):
         # Treat "CALL $+5; POP EAX" as not a call. Detect "CALL EIP" with encoding E8 00 00 00 00.
         if list(csinstr.bytes) == [0xe8, 0, 0, 0, 0]: return False
 
-        return csinstr.id in [ X86_INS_CALL ]
+        return csinstr.id == X86_INS_CALL
 
     def call_destination(self, csinstr):
         assert csinstr.id in [ X86_INS_CALL ]
@@ -51,11 +85,23 @@ class SemaX86(Sema):
                     return [imm]
         return []
 
+    def data_references(self, csinstr, lookahead):
+        ret = []
+        for op in csinstr.operands:
+            if op.type != X86_OP_MEM: continue
+            if op.mem.base == X86_REG_RIP and op.mem.index == X86_REG_INVALID:
+                ret.append(csinstr.address + csinstr.size + op.mem.disp)
+            elif op.mem.base == X86_REG_INVALID and op.mem.index == X86_REG_INVALID and self.arch.bits == 32:
+                ret.append(op.mem.disp)
+        return ret
+
     def looks_like_a_function_start(self, address, instructions):
         if len(instructions) < 2: return False  # Non-decodable instructions.
             
-        if instructions[0].mnemonic == "push" and re.match("^(r|e)bp$", instructions[0].op_str):
-            if instructions[1].mnemonic == "mov" and re.match("^(r|e)bp, (r|e)sp$", instructions[1].op_str):
+        (i1, i2) = (instructions[0], instructions[1])
+        if i1.id == X86_INS_PUSH and len(i1.operands) == 1 and reg_operand(i1, 0) in FRAME_POINTER_REGISTERS:
+            if i2.id == X86_INS_MOV and len(i2.operands) == 2 and reg_operand(i2, 0) in FRAME_POINTER_REGISTERS \
+                    and reg_operand(i2, 1) in STACK_POINTER_REGISTERS:
                 return True
 
         return False
@@ -67,28 +113,7 @@ class SemaX86(Sema):
         return csinstr.id == X86_INS_JMP
 
     def is_conditional_jump(self, instruction):
-        return instruction.csinstr.id in [  # list from capstone.x86_const
-                                            X86_INS_JAE,
-                                            X86_INS_JA,
-                                            X86_INS_JBE,
-                                            X86_INS_JB,
-                                            X86_INS_JCXZ,
-                                            X86_INS_JECXZ,
-                                            X86_INS_JE,
-                                            X86_INS_JGE,
-                                            X86_INS_JG,
-                                            X86_INS_JLE,
-                                            X86_INS_JL,
-                                            # X86_INS_JMP,
-                                            X86_INS_JNE,
-                                            X86_INS_JNO,
-                                            X86_INS_JNP,
-                                            X86_INS_JNS,
-                                            X86_INS_JO,
-                                            X86_INS_JP,
-                                            X86_INS_JRCXZ,
-                                            X86_INS_JS,
-                                            ]
+        return instruction.csinstr.id in CONDITIONAL_JUMP_IDS
 
     def is_nop(self, instruction):
         return instruction.csinstr.id == X86_INS_NOP
@@ -202,7 +227,7 @@ class SemaX86(Sema):
     def detect_stack_frame_size(self, function):
         for instr in function.instructions:
             if instr.csinstr.id == X86_INS_SUB:
-                if instr.csinstr.operands[0].type == X86_OP_REG and instr.csinstr.operands[0].reg in [X86_REG_RSP, X86_REG_ESP]:
+                if reg_operand(instr.csinstr, 0) in STACK_POINTER_REGISTERS:
                     if instr.csinstr.operands[1].type == X86_OP_IMM:
                         function.stack_frame_size = instr.csinstr.operands[1].imm
                         return
@@ -266,29 +291,33 @@ class SemaX86(Sema):
         pts = []
 
         for (idx, instruction) in enumerate(instrs):
-            if instrs[idx].csinstr.mnemonic == "add":
-                m = re.match("^([re][abcds0-9][xi]?), ([re][abcds0-9][xi]?)$", instrs[idx].csinstr.op_str)
-                if m is not None:
-                    reg = m.group(1)
+            csinstr = instruction.csinstr
+            if csinstr.id == X86_INS_ADD and len(csinstr.operands) == 2:
+                reg = reg_operand(csinstr, 0)
+                if reg in SWITCH_REGISTERS and reg_operand(csinstr, 1) in SWITCH_REGISTERS:
                     for idx2 in range(idx, min(idx+3, len(instrs))):
-                        if instrs[idx2].csinstr.mnemonic == "jmp":
-                            if instrs[idx2].csinstr.op_str == reg:
-                                pts.append((instrs[idx2], "rcx"))  # TODO, find real register to switch on
-                                break
+                        csinstr2 = instrs[idx2].csinstr
+                        if csinstr2.id == X86_INS_JMP and reg_operand(csinstr2, 0) == reg:
+                            pts.append((instrs[idx2], "rcx"))  # TODO, find real register to switch on
+                            break
 
         return pts
 
     def detect_pic(self, function):
         pic_register = None
+        pic_register_id = None
         pic_value = None
 
         instrs = function.instructions
         for (idx, instruction) in enumerate(instrs):
-            if instrs[idx].csinstr.mnemonic == "call":
-                a = instrs[idx].csinstr.address + instrs[idx].csinstr.size
-                if instrs[idx].csinstr.op_str == ("0x%x" % a):
-                    if instrs[idx+1].csinstr.mnemonic == "pop":
-                        pic_register = instrs[idx+1].csinstr.op_str
+            csinstr = instruction.csinstr
+            if csinstr.id == X86_INS_CALL and len(csinstr.operands) == 1:
+                a = csinstr.address + csinstr.size
+                if csinstr.operands[0].type == X86_OP_IMM and csinstr.operands[0].imm == a:
+                    csinstr2 = instrs[idx+1].csinstr
+                    if csinstr2.id == X86_INS_POP and reg_operand(csinstr2, 0) is not None:
+                        pic_register = csinstr2.op_str
+                        pic_register_id = reg_operand(csinstr2, 0)
                         pic_value = a
                         # print "PIC register: %s" % pic_register
                         break
@@ -297,14 +326,13 @@ class SemaX86(Sema):
 
         function.pic_info = (pic_register, pic_value)
 
+        # "ptr [pic_register + 0x...]" and "ptr [pic_register + index*scale + 0x...]" operands.
         for (idx, instruction) in enumerate(instrs):
-            s = instrs[idx].csinstr.op_str
             instruction.pointer_hints = []
-            for m in re.findall("ptr \\[%s \\+ ([a-z0-9*]+ \\+)? (0x[0-9a-f]+)\\]" % pic_register, s):
-                offset = m[1]
-                a = int(offset, 16)
-                a = pic_value + a
-                instruction.pointer_hints.append(a)
+            for op in instruction.csinstr.operands:
+                if op.type == X86_OP_MEM and op.mem.base == pic_register_id and op.mem.disp > 0:
+                    a = pic_value + op.mem.disp
+                    instruction.pointer_hints.append(a)
 
                 # print instruction
                 # print "ptr to 0x%x" % a
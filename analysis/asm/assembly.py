@@ -3,8 +3,16 @@
 import distorm3
 import capstone
 
+from analysis.tools.slots import slot_names
+
+# Marks a released capstone instruction, see AssemblyInstruction.release_csinstr().
+RELEASED = object()
+
 
 class AssemblyInstruction:
+    __slots__ = ("arch", "addr", "bytes", "mnem", "params", "canonicalsyntax", "_csinstr", "bb", "pointer_hints",
+                 "jump_table", "jump_table_index_register")
+
     def __init__(self, arch, addr, rawbytes, mnem, params):
         self.arch = arch
         self.addr = addr
@@ -12,7 +20,7 @@ class AssemblyInstruction:
         self.mnem = mnem
         self.params = params
         self.canonicalsyntax = None
-        self.csinstr = None
+        self._csinstr = None
         self.bb = None
         #self.pattern = None
         self.pointer_hints = None
@@ -28,16 +36,36 @@ class AssemblyInstruction:
     def __repr__(self):
         return str(self)
 
+    # The capstone instruction (with its details) is only needed until the ucode is built, after that it's released and
+    # decoded again from the bytes if anything still asks for it.
+    @property
+    def csinstr(self):
+        if self._csinstr is RELEASED:
+            decoded = list(self.arch.capstone.disasm(self.bytes, self.addr, 1))
+            self._csinstr = decoded[0] if len(decoded) == 1 else None
+        return self._csinstr
+
+    @csinstr.setter
+    def csinstr(self, value):
+        self._csinstr = value
+
+    def is_decoded(self):
+        return self._csinstr is not None
+
+    def release_csinstr(self):
+        if isinstance(self._csinstr, capstone.CsInsn):
+            self._csinstr = RELEASED
+
     def __deepcopy__(self, memo):
         # Don't copy csinstr.
         import copy
         result = self.__class__(None, None, None, None, None)
         memo[id(self)] = result
-        for key, value in list(vars(self).items()):
-            if key == "csinstr":
-                result.csinstr = self.csinstr
+        for key in slot_names(self.__class__):
+            if key == "_csinstr":
+                result._csinstr = self._csinstr
             else:
-                setattr(result, key, copy.deepcopy(value, memo))
+                setattr(result, key, copy.deepcopy(getattr(self, key), memo))
         return result
 
     def canonicalize_distorm(self):
@@ -64,4 +92,30 @@ class AssemblyInstruction:
 
 
 class AssemblyDataInstruction(AssemblyInstruction):
-    pass
+    __slots__ = ()
+
+    @staticmethod
+    def from_byte(arch, addr, b):
+        instr = AssemblyDataInstruction(arch, addr, b, "db", "0x%x" % b)
+        instr.csinstr = data_byte_csinstr(b)
+        instr.canonicalsyntax = "%s %s" % ("db", "0x%x" % b)
+        return instr
+
+
+# Stands in for the capstone instruction of a data byte, there's one shared object per byte value.
+class DataByteCsInstr(object):
+    __slots__ = ("mnemonic", "id", "groups", "operands", "op_str")
+
+    def __init__(self, b):
+        self.mnemonic = "db"
+        self.id = -1
+        self.groups = []
+        self.operands = []
+        self.op_str = "0x%x" % b
+
+
+data_byte_csinstrs = [DataByteCsInstr(b) for b in range(256)]
+
+
+def data_byte_csinstr(b):
+    return data_byte_csinstrs[b]
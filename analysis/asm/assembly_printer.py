@@ -1,23 +1,21 @@
+from analysis.tools.textbuilder import TextBuilder
+
+
 class AssemblyPrinter:
     def __init__(self, function):
         self.function = function
         self.text = ""
-        self.line_number = 0
+        self.builder = None
         self.line_to_object_map = {}
 
     def line(self, s, o=None):
-        self.text += s + "\n"
-        if o is not None:
-            self.line_to_object_map[self.line_number] = o
-        self.line_number += 1
+        self.builder.line(s, o)
 
     def print_to_text(self):
-        self.text = ""
-        self.line_number = 0
-        self.line_to_object_map = {}
+        self.builder = TextBuilder()
 
         func = self.function
-        l = self.line
+        l = self.builder.line
 
         l(";")
         l("; Disassembly for function " + func.name)
@@ -55,4 +53,6 @@ class AssemblyPrinter:
 
             l("0x%x        %s" % (instr.addr, s), instr)
 
+        self.text = self.builder.text()
+        self.line_to_object_map = self.builder.line_map()
         return (self.text, self.line_to_object_map)
@@ -4,6 +4,9 @@ from analysis.asm.assembly import AssemblyDataInstruction
 
 
 class BasicBlock():
+    __slots__ = ("arch", "function", "number", "addr", "instructions", "succs", "preds", "has_terminator", "is_entry",
+                 "is_exit")
+
     def __init__(self, arch, function, number, addr, instructions):
         self.arch = arch
         self.function = function
@@ -147,9 +150,6 @@ def convert_stuff_beyond_end_to_data(func):
             break
         idx += 1
 
-    class AnyObject(object):
-        pass
-
     instrs = func.instructions[idx:]
     output_instrs = []
     for instr in instrs:
@@ -158,15 +158,7 @@ def convert_stuff_beyond_end_to_data(func):
         else:
             addr = instr.addr
             for b in instr.bytes:
-                instr = AssemblyDataInstruction(func.arch, addr, b, "db", "0x%x" % b)
-                instr.csinstr = AnyObject()
-                instr.csinstr.mnemonic = "db"
-                instr.csinstr.id = -1
-                instr.csinstr.groups = []
-                instr.csinstr.operands = []
-                instr.csinstr.op_str = "0x%x" % b
-                instr.canonicalsyntax = "%s %s" % ("db", "0x%x" % b)
-                output_instrs.append(instr)
+                output_instrs.append(AssemblyDataInstruction.from_byte(func.arch, addr, b))
                 addr += 1
 
     func.instructions[idx:] = output_instrs
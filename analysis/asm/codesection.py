@@ -0,0 +1,128 @@
+import bisect
+import collections
+from array import array
+
+# Instructions decoded at once, the decoded instructions are stored in chunks of this size. Once the binary is loaded
+# only the last few chunks are kept around.
+SWEEP_CHUNK_INSTRUCTIONS = 4096
+DECODED_CHUNKS_LIMIT = 16
+
+
+# Linear sweep disassembly of the whole code section, done once per binary. The instruction boundaries are kept
+# (addresses and sizes in compact arrays), grouped into runs of contiguously decoded instructions (a new run starts
+# after an undecodable byte, exactly where the old per-scan sweeps restarted capstone). The capstone instructions are
+# decoded from the recorded boundaries chunk by chunk the first time they are asked for, and stored, so function
+# discovery, reference scanning, block reference scanning, the function start probes and Function loading all read the
+# same decoded instructions. release() bounds the store once the binary's load is done.
+class CodeSectionInstructions:
+    def __init__(self, arch, start, end):
+        self.arch = arch
+        ":type: Architecture"
+        self.start = start
+        self.end = end
+        self.content = None
+        self.addresses = array('Q')
+        self.sizes = array('B')
+        self.runs = []
+        # {index of the first instruction of a chunk: decoded instructions}, chunks start at the start of their run.
+        self.chunks = collections.OrderedDict()
+        self.chunks_limit = None
+
+    def build(self, content, load_progress_callback=None):
+        self.content = content
+        addresses = self.addresses
+        sizes = self.sizes
+
+        addr = self.start
+        while addr < self.end:
+            p = float(addr - self.start) / float(self.end - self.start)
+            if load_progress_callback: load_progress_callback.progress("Disassembling code section...", p)
+
+            run_start = len(addresses)
+            to_skip = addr - self.start
+            for (address, size, _, _) in self.arch.capstone.disasm_lite(content[to_skip:], addr):
+                addresses.append(address)
+                sizes.append(size)
+                addr = address + size
+            if len(addresses) > run_start:
+                self.runs.append((run_start, len(addresses)))
+
+            # skip one instruction (can't be decoded), or align the address to next arch.bytes() byte
+            addr = (addr + self.arch.bytes()) & (~(self.arch.bytes() - 1))
+
+    def __len__(self):
+        return len(self.addresses)
+
+    # Decodes the instructions with indexes [lo, hi), which have to be in the same run.
+    def decode(self, lo, hi):
+        if lo >= hi: return []
+        first = self.addresses[lo]
+        last_end = self.addresses[hi - 1] + self.sizes[hi - 1]
+        code = self.content[first - self.start:last_end - self.start]
+        return list(self.arch.capstone.disasm(code, first, hi - lo))
+
+    # Drops the stored chunks and from now on only keeps the last DECODED_CHUNKS_LIMIT ones.
+    def release(self):
+        self.chunks.clear()
+        self.chunks_limit = DECODED_CHUNKS_LIMIT
+
+    # The decoded chunk starting at index 'lo' of 'run'.
+    def chunk(self, run, lo):
+        chunks = self.chunks
+        if lo in chunks:
+            chunks.move_to_end(lo)
+            return chunks[lo]
+
+        result = self.decode(lo, min(lo + SWEEP_CHUNK_INSTRUCTIONS, run[1]))
+        chunks[lo] = result
+        if self.chunks_limit is not None and len(chunks) > self.chunks_limit:
+            chunks.popitem(last=False)
+        return result
+
+    # The instructions of a run, chunk by chunk.
+    def run_instructions(self, run):
+        (run_start, run_end) = run
+        for lo in range(run_start, run_end, SWEEP_CHUNK_INSTRUCTIONS):
+            for i in self.chunk(run, lo):
+                yield i
+
+    # The run containing the instruction with index 'idx'.
+    def run_of(self, idx):
+        r = bisect.bisect_right(self.runs, (idx, len(self.addresses))) - 1
+        return self.runs[r]
+
+    # The instructions with indexes [lo, hi) of a single run.
+    def instructions_between(self, lo, hi):
+        if lo >= hi: return []
+        run = self.run_of(lo)
+        result = []
+        chunk_lo = lo - (lo - run[0]) % SWEEP_CHUNK_INSTRUCTIONS
+        while chunk_lo < hi:
+            chunk = self.chunk(run, chunk_lo)
+            result.extend(chunk[max(lo - chunk_lo, 0):hi - chunk_lo])
+            chunk_lo += SWEEP_CHUNK_INSTRUCTIONS
+        return result
+
+    def index_of(self, addr):
+        idx = bisect.bisect_left(self.addresses, addr)
+        if idx < len(self.addresses) and self.addresses[idx] == addr:
+            return idx
+        return -1
+
+    def instruction_at(self, addr):
+        idx = self.index_of(addr)
+        if idx < 0: return None
+        return self.instructions_between(idx, idx + 1)[0]
+
+    # Contiguous instructions starting exactly at 'start' which lie completely within [start, end). Stops at the first
+    # gap, i.e. where the sweep couldn't decode or where it decoded with a different alignment.
+    def instructions_in_range(self, start, end):
+        idx = self.index_of(start)
+        if idx < 0: return []
+
+        (_, run_end) = self.run_of(idx)
+        hi = idx
+        while hi < run_end and self.addresses[hi] + self.sizes[hi] <= end:
+            hi += 1
+
+        return self.instructions_between(idx, hi)
@@ -1,88 +1,120 @@
-import re
-import subprocess
+import bisect
+import os
+
+from capstone import CS_OP_IMM, CS_OP_MEM
+from capstone.arm64_const import ARM64_INS_ADRP, ARM64_INS_BR, ARM64_INS_LDR, ARM64_REG_X16
+from capstone.x86_const import X86_INS_JMP, X86_REG_RIP
 
 from analysis.arch.architecture import AArch64Architecture
+from macho.loadcommands.dyld_info import _bind
 
 
+# Reads the bind and lazy bind info (imported symbols, class refs, GOT entries) and the symbol stubs of a Mach-O file by
+# decoding the bind opcodes and the stubs section directly from the already mapped file.
 class DyldInfoReader(object):
-    def __init__(self, arch, executable):
-
-        bind_info = subprocess.check_output(["xcrun", "dyldinfo", "-arch", arch.archvalue, "-bind", executable])
-        bind_lines = bind_info.decode('utf-8').split("\n")[2:]
-        lazy_bind_info = subprocess.check_output(["xcrun", "dyldinfo", "-arch", arch.archvalue, "-lazy_bind", executable])
-        lazy_bind_lines = lazy_bind_info.decode('utf-8').split("\n")[2:]
-
-        symbol_stub_info = subprocess.check_output(["otool", "-arch", arch.archvalue, "-V", "-s", "__TEXT", arch.stubs_section_name, executable])
-        symbol_stub_lines = symbol_stub_info.decode('utf-8').split("\n")[2:]
-
+    def __init__(self, arch, macho):
         self.arch = arch
+        self.macho = macho
         self.items = []
         self.stubs = []
-        for line in bind_lines:
-            if line.strip() == "": continue
-
-            unpack = re.split('[ \n\r]+', line)
-            segment = unpack[0]
-            section = unpack[1]
-            addr = int(unpack[2], 16)
-            dylib = unpack[5]
-            symbol = unpack[6]
-            self.items.append({"segment": segment, "section": section, "addr": addr, "dylib": dylib, "symbol": symbol})
-
-        for line in lazy_bind_lines:
-            if line.strip() == "": continue
-
-            unpack = re.split('[ \n\r]+', line)
-            segment = unpack[0]
-            section = unpack[1]
-            addr = int(unpack[2], 16)
-            dylib = unpack[4]
-            symbol = unpack[5]
-            self.items.append({"segment": segment, "section": section, "addr": addr, "dylib": dylib, "symbol": symbol})
-
-        idx = 0
-        while idx < len(symbol_stub_lines):
-            line = symbol_stub_lines[idx]
-            idx += 1
-
-            if line.strip() == "": continue
-
-            if arch != AArch64Architecture:
-                unpack = re.split('[ \t]+', line)
-                addr = int(unpack[0], 16)
-                instr = unpack[1]
-                if instr == "jmpl":
-                    symbol_addr = int(unpack[2].replace("*", ""), 16)
-                elif instr == "jmpq":
-                    m = re.match("\*(0x[0-9a-f]+)\\(%rip\\)", unpack[2])
-                    assert m
-                    rel = int(m.group(1), 16)
-                    symbol_addr = addr + rel + 6 # RIP points to the next instruction, "JMPQ" is 6 bytes long
+
+        self.section_starts = []
+        self.section_list = []
+        for s in sorted(self.all_sections(), key=lambda s: s.addr):
+            self.section_starts.append(s.addr)
+            self.section_list.append(s)
+
+        for lc in macho.loadCommands.all('className', 'DyldInfoCommand'):
+            self.read_bind_info(lc)
+
+        stubs_sections = list(macho.allSections("sectname", arch.stubs_section_name))
+        for s in stubs_sections:
+            if s.segname != "__TEXT": continue
+            self.read_stubs(s)
+
+    def all_sections(self):
+        for seg in self.macho.loadCommands.all('className', 'SegmentCommand'):
+            for s in seg.sections:
+                yield s
+
+    def section_for_addr(self, addr):
+        idx = bisect.bisect_right(self.section_starts, addr) - 1
+        if idx < 0: return None
+        s = self.section_list[idx]
+        if addr >= s.addr + s.size: return None
+        return s
+
+    def dylib_name(self, libord):
+        if libord == 0: return "this-image"
+        if libord == 0xff: return "main-executable"
+        if libord == 0xfe: return "flat-namespace"
+        lc = self.macho.dylibFromLibord(libord)
+        if lc is None: return "ordinal-%d" % libord
+
+        # Same short form as dyldinfo prints, e.g. "/usr/lib/libobjc.A.dylib" -> "libobjc".
+        name = os.path.basename(lc.name)
+        while True:
+            (stem, ext) = os.path.splitext(name)
+            if not ext: break
+            name = stem
+        return name
+
+    def read_bind_info(self, lc):
+        f = self.macho.file
+        pos = f.tell()
+        self.macho.seek(lc.offset)
+        (_, _, bind_off, bind_size, _, _, lazy_bind_off, lazy_bind_size, _, _) = self.macho.readFormatStruct('10L')
+
+        symbols = []
+        if bind_size:
+            self.macho.seek(bind_off)
+            _bind(self.macho, bind_size, symbols)
+        if lazy_bind_size:
+            self.macho.seek(lazy_bind_off)
+            _bind(self.macho, lazy_bind_size, symbols)
+        f.seek(pos)
+
+        for sym in symbols:
+            section = self.section_for_addr(sym.addr)
+            if section is None: continue
+            self.items.append({"segment": section.segname, "section": section.sectname, "addr": sym.addr,
+                               "dylib": self.dylib_name(sym.libord), "symbol": sym.name})
+
+    def read_stubs(self, section):
+        f = self.macho.file
+        start = section.offset + self.macho.origin
+        code = f[start:start + section.size]
+
+        stub_addr = section.addr
+        x16 = None
+        symbol_addr = None
+        for i in self.arch.capstone.disasm(code, section.addr):
+            if self.arch == AArch64Architecture:
+                # nop / ldr x16, literal / br x16 or adrp x16, page / ldr x16, [x16, offset] / br x16
+                if i.id == ARM64_INS_ADRP and i.operands[0].reg == ARM64_REG_X16:
+                    x16 = i.operands[1].imm
+                elif i.id == ARM64_INS_LDR and i.operands[0].reg == ARM64_REG_X16:
+                    op = i.operands[1]
+                    if op.type == CS_OP_IMM:
+                        symbol_addr = op.imm
+                    elif op.type == CS_OP_MEM and op.mem.base == ARM64_REG_X16 and x16 is not None:
+                        symbol_addr = x16 + op.mem.disp
+                elif i.id == ARM64_INS_BR:
+                    if symbol_addr is not None:
+                        self.stubs.append({"addr": stub_addr, "symbol_addr": symbol_addr})
+                    stub_addr = i.address + i.size
+                    x16 = None
+                    symbol_addr = None
             else:
-                unpack = re.split('[\t]+', line)
-                addr = int(unpack[0], 16)
-                instr = unpack[1]
-                assert instr == "nop"
-
-                line = symbol_stub_lines[idx]
-                idx += 1
-                unpack = re.split('[\t]+', line)
-                # addr = int(unpack[0], 16)
-                instr = unpack[1]
-                assert instr == "ldr"
-                m = re.match("x16, #([0-9a-f]+)", unpack[2])
-                assert m
-                rel = int(m.group(1), 10)
-                symbol_addr = addr + rel + 4  # On AArch64, PC points to next instruction.
-
-                line = symbol_stub_lines[idx]
-                idx += 1
-                unpack = re.split('[\t]+', line)
-                # addr = int(unpack[0], 16)
-                instr = unpack[1]
-                assert instr == "br"
-
-            self.stubs.append({"addr": addr, "symbol_addr": symbol_addr})
+                if i.id == X86_INS_JMP:
+                    op = i.operands[0]
+                    if op.type == CS_OP_MEM:
+                        if op.mem.base == X86_REG_RIP:
+                            symbol_addr = i.address + i.size + op.mem.disp  # RIP points to the next instruction
+                        else:
+                            symbol_addr = op.mem.disp
+                        self.stubs.append({"addr": stub_addr, "symbol_addr": symbol_addr})
+                    stub_addr = i.address + i.size
 
     def get_class_refs(self):
         class_refs = {}
@@ -1,15 +1,32 @@
+import bisect
+import collections
 import os
 import re
 import struct
+from array import array
 import subprocess
+import threading
+from analysis.analysiscache import BinaryAnalysisCache
 from analysis.arch.architecture import Architecture
 from analysis.callprototypes.callprototypes import CallPrototypesResolver
+from analysis.asm.codesection import CodeSectionInstructions
 from analysis.asm.dyldinforeader import DyldInfoReader
 from analysis.function import Function
+from analysis.sharedcache import get_shared_cache
 from analysis.types import TypeManager
+from analysis.vmreader import VMReader
+from analysis.xrefs import BinaryXrefs, XrefIndex
 import macho
 from macho.loadcommands.loadcommand import LC_MAIN
 
+try:
+    import numpy
+except ImportError:
+    numpy = None  # Data section scanning falls back to plain arrays.
+
+# Words a block descriptor probe reads: the zero, the size, two helper pointers (or the signature) and the signature.
+BLOCK_DESCRIPTOR_WORDS = 5
+
 # Holds metainformation about an Objective-C class
 class ObjCClass:
     def __init__(self, binary, name):
@@ -117,17 +134,26 @@ class ObjcBlockDescriptor:
 # Main "Binary" class representing all the data, metadata, assembly, functions, classes,
 # references and everything that is analyzed from one binary file.
 class Binary:
-    def __init__(self, path, arch):
+    # With 'image_name', 'path' is a dyld shared cache and the binary is the image with that install path or short name
+    # ("UIKit") in it.
+    def __init__(self, path, arch, image_name=None):
         self.path = path
         ":type: str"
         self.full_path = os.path.abspath(path)
+        self.image_name = image_name
+        self.shared_cache = None
+        ":type: SharedCache"
         self.arch = arch
         ":type: Architecture"
         self.functions = []
         self.classes = []
         self.block_descriptors = []
         self.global_block_literals = []
+        self.block_references = []
         self.addr_to_func_map = {}
+        self.function_starts = []
+        ":type: list[int]"
+        self.function_by_start = []
 
         self.class_refs = None
         self.stubs = None
@@ -136,13 +162,33 @@ class Binary:
         self.ivars = None
         self.selectors = None
         self.cfstrings = None
+        self.xrefs = None
+        ":type: BinaryXrefs"
+        self.function_summaries = {}
+        ":type: dict[int, FunctionSummary]"
 
         self.macho = None
+        self.code_instructions = None
+        ":type: CodeSectionInstructions"
+        self.function_start_verdicts = collections.OrderedDict()
+        self.function_start_verdicts_limit = 1 << 16
+        self.vm = None
+        ":type: VMReader"
+        self.dyld_info = None
         self.call_resolver = None
         self.types = TypeManager(self.arch)
         ":type: TypeManager"
+        self.use_analysis_cache = True
+        # Take the function starts from LC_FUNCTION_STARTS when the binary has it, and only run the heuristic code and
+        # data section scans on top of it if asked to.
+        self.use_function_starts = True
+        self.supplement_function_starts = False
+        self.analysis_cache = None
+        ":type: BinaryAnalysisCache"
 
         self.load_progress_callback = None
+        # Held while analyzing, when the binary is shared between threads (the IDE decompiles in the background).
+        self.lock = threading.RLock()
 
     # Don't deep copy.
     def __deepcopy__(self, memo):
@@ -175,23 +221,48 @@ class Binary:
         if self.load_progress_callback: self.load_progress_callback.progress("Loading function prototype database...")
         self.call_resolver = CallPrototypesResolver(self.arch, self)
 
+        if self.use_analysis_cache:
+            if self.load_progress_callback: self.load_progress_callback.progress("Loading cached analysis...")
+            self.analysis_cache = BinaryAnalysisCache(self)
+            if self.analysis_cache.load():
+                self.load_classes()
+                return
+
         self.load_info_from_dyld()
 
         self.scan_functions()
         self.load_classes()
 
+        # The xref index classifies data references, so it needs the selectors, class refs, cfstrings and ivars.
+        self.build_xref_index()
+        self.find_block_references_in_functions()
+        if self.shared_cache is not None: self.resolve_cross_image_calls()
+
+        if self.analysis_cache is not None: self.analysis_cache.save()
+        # Only Function loading needs decoded instructions from now on, a few at a time.
+        if self.code_instructions is not None: self.code_instructions.release()
+
+    def get_code_instructions(self):
+        if self.code_instructions is not None: return self.code_instructions
+
+        section_content = self.read_bytes_at_vm(self.code_section_start, self.code_section_end - self.code_section_start)
+        self.code_instructions = CodeSectionInstructions(self.arch, self.code_section_start, self.code_section_end)
+        self.code_instructions.build(section_content, self.load_progress_callback)
+        return self.code_instructions
+
     def scan_code_section(self):
         function_starts = set()
 
-        section_content = self.read_bytes_at_vm(self.code_section_start, self.code_section_end - self.code_section_start)
-        addr = self.code_section_start
-        while addr < self.code_section_end:
-            p = float(addr - self.code_section_start) / float(self.code_section_end - self.code_section_start)
+        # Candidates that need a function start probe, they are probed in bulk after the sweep.
+        tail_jumps = []
+        probe_addrs = []
+
+        code = self.get_code_instructions()
+        for run in code.runs:
+            p = float(run[0]) / float(len(code))
             if self.load_progress_callback: self.load_progress_callback.progress("Scanning code section...", p)
 
-            to_skip = addr - self.code_section_start
-            decoded = self.arch.capstone.disasm(section_content[to_skip:], addr)
-            for i in decoded:
+            for i in code.run_instructions(run):
                 if self.arch.sema.is_call(i):
                     target = self.arch.sema.call_destination(i)
                     if target is not None:
@@ -204,48 +275,65 @@ class Binary:
                     target = self.arch.sema.unconditional_jump_destination_csinstr(i)
                     if target is not None:
                         if target >= self.code_section_start and target < self.code_section_end:
-                            first_few_instructions = self.get_first_few_instructions(i.address + i.size)
-                            looks_like_its_a_tail_jmp = self.arch.sema.looks_like_a_function_start(i.address, first_few_instructions)
-
-                            first_few_instructions = self.get_first_few_instructions(target)
-                            looks_like_a_function = self.arch.sema.looks_like_a_function_start(target, first_few_instructions)
-
-                            if looks_like_a_function and looks_like_its_a_tail_jmp:
-                                # print "0x%x: %s %s  ==> 0x%x" % (i.address, i.mnemonic, i.op_str, target)
-                                function_starts.add(target)
+                            tail_jumps.append((i.address + i.size, target))
 
                 ptrs = self.arch.sema.guess_pointers(i, None, self.code_section_start, self.code_section_end)  # TODO
                 for ptr in ptrs:
                     if ptr >= self.code_section_start and ptr < self.code_section_end:
-                        first_few_instructions = self.get_first_few_instructions(ptr)
-                        if self.arch.sema.looks_like_a_function_start(ptr, first_few_instructions):
-                            # print "0x%x: %s %s  ==>  0x%x" % (i.address, i.mnemonic, i.op_str, ptr)
-                            function_starts.add(ptr)
+                        probe_addrs.append(ptr)
 
                 if self.arch.sema.is_nop_csinstr(i):
-                    a = i.address + i.size
-                    first_few_instructions = self.get_first_few_instructions(a)
-                    looks_like_a_function = self.arch.sema.looks_like_a_function_start(a, first_few_instructions)
-                    if looks_like_a_function:
-                            # print "0x%x: %s %s  ==>  0x%x" % (i.address, i.mnemonic, i.op_str, ptr)
-                            function_starts.add(a)
+                    probe_addrs.append(i.address + i.size)
+
+        candidates = set(probe_addrs)
+        for (after, target) in tail_jumps:
+            candidates.add(after)
+            candidates.add(target)
+        verdicts = self.probe_function_starts(candidates)
 
-                addr = i.address + i.size
+        for (after, target) in tail_jumps:
+            if verdicts[target] and verdicts[after]:
+                function_starts.add(target)
 
-            # skip one instruction (can't be decoded), or align the address to next arch.bytes() byte
-            addr = (addr + self.arch.bytes()) & (~(self.arch.bytes()-1))
+        for a in probe_addrs:
+            if verdicts[a]:
+                function_starts.add(a)
 
         return function_starts
 
     def get_first_few_instructions(self, addr):
+        if self.code_instructions is not None:
+            instrs = self.code_instructions.instructions_in_range(addr, addr + 64)
+            if len(instrs) >= 4: return instrs[:4]
+
         data = self.read_bytes_at_vm(addr, 64)
         decoded = self.arch.capstone.disasm(data, addr, 4)
         return list(decoded)
 
+    def probe_function_start(self, addr):
+        cache = self.function_start_verdicts
+        if addr in cache:
+            cache.move_to_end(addr)
+            return cache[addr]
+
+        first_few_instructions = self.get_first_few_instructions(addr)
+        verdict = self.arch.sema.looks_like_a_function_start(addr, first_few_instructions)
+
+        cache[addr] = verdict
+        if len(cache) > self.function_start_verdicts_limit:
+            cache.popitem(last=False)
+        return verdict
+
+    # Bulk variant, probes the addresses in address order and returns a map of all verdicts.
+    def probe_function_starts(self, addrs):
+        verdicts = {}
+        for addr in sorted(addrs):
+            verdicts[addr] = self.probe_function_start(addr)
+        return verdicts
+
     def ptr_looks_like_a_function_start(self, ptr):
         if self.code_section_start <= ptr < self.code_section_end:
-            first_few_instructions = self.get_first_few_instructions(ptr)
-            if self.arch.sema.looks_like_a_function_start(ptr, first_few_instructions):
+            if self.probe_function_start(ptr):
                 return True
 
         return False
@@ -257,59 +345,98 @@ class Binary:
 
         return False
 
-    def scan_data_section(self):
+    # The pointer-sized words at start, start + size, ... ('count' of them), plus BLOCK_DESCRIPTOR_WORDS - 1 more words
+    # after them for the probes that look ahead, as a NumPy array if NumPy is available.
+    def read_data_words(self, start, count):
+        size = self.arch.bytes()
+        content = self.read_bytes_at_vm(start, count * size)
+        if len(content) < count * size: content = bytes(content) + bytes(count * size - len(content))
+        extra = [self.read_long_at_vm(start + (count + i) * size) for i in range(BLOCK_DESCRIPTOR_WORDS - 1)]
+        if numpy is not None:
+            words = numpy.frombuffer(content, dtype=numpy.uint64 if size == 8 else numpy.uint32)
+            return numpy.concatenate((words, numpy.array(extra, dtype=words.dtype)))
+        words = array('Q' if size == 8 else 'I', content)
+        words.extend(extra)
+        return words
+
+    # Indexes of the words that may be code pointers, and of the words that may start a block descriptor (a zero
+    # followed by a small size).
+    def data_section_candidates(self, words, count):
+        (lo, hi) = (self.code_section_start, self.code_section_end)
+        if numpy is not None:
+            head = words[:count]
+            following = words[1:count + 1]
+            code_pointers = numpy.flatnonzero((head >= lo) & (head < hi))
+            descriptors = numpy.flatnonzero((head == 0) & (following >= 0x20) & (following < 0x100))
+            return (code_pointers.tolist(), descriptors.tolist())
+
+        code_pointers = [i for i in range(count) if lo <= words[i] < hi]
+        descriptors = [i for i in range(count) if words[i] == 0 and 0x20 <= words[i + 1] < 0x100]
+        return (code_pointers, descriptors)
+
+    # Finds block descriptors, global block literals and (if 'discover_functions' is set) code pointers in the __const
+    # sections. The sections are read as word arrays and filtered with vectorized masks, only the candidates are probed.
+    def scan_data_section(self, discover_functions=True):
         sections = list(self.macho.allSections("sectname", "__const"))
         if len(sections) == 0: return set()
 
+        size = self.arch.bytes()
+        global_block_addrs = sorted([addr for (addr, name) in self.imported_data_symbols.items()
+                                     if name == "__NSConcreteGlobalBlock"])
+
         function_starts = set()
         for s in sections:
             section_start = s.addr
             section_end = s.addr + s.size
-
-            addr = section_start
-            while addr < section_end:
-
-                ptr = self.read_long_at_vm(addr)
-
-                # --- look for code pointers and heuristically discover new function starts
+            count = (s.size + size - 1) // size
+            if count == 0: continue
+            words = self.read_data_words(section_start, count)
+            (code_pointers, descriptors) = self.data_section_candidates(words, count)
+            if not discover_functions: code_pointers = []
+
+            def word(idx):
+                return int(words[idx])
+
+            # --- look for code pointers and heuristically discover new function starts
+            for idx in code_pointers:
+                ptr = word(idx)
                 if self.ptr_looks_like_a_function_start(ptr):
                     function_starts.add(ptr)
 
-                # --- look for block descriptors
-                if ptr == 0:
-                    ptr2 = self.read_long_at_vm(addr + 1 * self.arch.bytes())
-                    if 0x20 <= ptr2 < 0x100:
-                        ptr3 = self.read_long_at_vm(addr + 2 * self.arch.bytes())
-                        ptr4 = self.read_long_at_vm(addr + 3 * self.arch.bytes())
-
-                        if self.ptr_looks_like_a_function_start(ptr3) and self.ptr_looks_like_a_function_start(ptr4):
-                            ptr5 = self.read_long_at_vm(addr + 4 * self.arch.bytes())
-                            ptr6 = self.read_long_at_vm(addr + 5 * self.arch.bytes())
-
-                            signature = self.read_c_string_at_vm(ptr5)
-                            if self.looks_like_a_block_signature(signature):
-                                name = "block_descriptor_%x" % addr
-                                self.block_descriptors.append(ObjcBlockDescriptor(name, addr, ptr2, ptr3, ptr4, signature))
-
-                        else:
-                            signature = self.read_c_string_at_vm(ptr3)
-                            if self.looks_like_a_block_signature(signature):
-                                name = "block_descriptor_%x" % addr
-                                self.block_descriptors.append(
-                                    ObjcBlockDescriptor(name, addr, ptr2, ptr3, ptr4, signature))
-
-                # --- look for global block literals
-                if addr in self.imported_data_symbols:
-                    if self.imported_data_symbols[addr] == "__NSConcreteGlobalBlock":
-                        ptr2 = self.read_long_at_vm(addr + 1 * self.arch.bytes())
-                        ptr3 = self.read_long_at_vm(addr + 2 * self.arch.bytes())
-                        ptr4 = self.read_long_at_vm(addr + 3 * self.arch.bytes())
-
-                        if self.ptr_looks_like_a_function_start(ptr3):
-                            name = "global_block_literal_%x" % addr
-                            self.global_block_literals.append(ObjCGlobalBlockLiteral(addr, ptr3, ptr4, name))
-
-                addr += self.arch.bytes()
+            # --- look for block descriptors
+            for idx in descriptors:
+                addr = section_start + idx * size
+                ptr2 = word(idx + 1)
+                ptr3 = word(idx + 2)
+                ptr4 = word(idx + 3)
+
+                if self.ptr_looks_like_a_function_start(ptr3) and self.ptr_looks_like_a_function_start(ptr4):
+                    ptr5 = word(idx + 4)
+
+                    signature = self.read_c_string_at_vm(ptr5)
+                    if self.looks_like_a_block_signature(signature):
+                        name = "block_descriptor_%x" % addr
+                        self.block_descriptors.append(ObjcBlockDescriptor(name, addr, ptr2, ptr3, ptr4, signature))
+
+                else:
+                    signature = self.read_c_string_at_vm(ptr3)
+                    if self.looks_like_a_block_signature(signature):
+                        name = "block_descriptor_%x" % addr
+                        self.block_descriptors.append(
+                            ObjcBlockDescriptor(name, addr, ptr2, ptr3, ptr4, signature))
+
+            # --- look for global block literals
+            lo = bisect.bisect_left(global_block_addrs, section_start)
+            hi = bisect.bisect_left(global_block_addrs, section_end)
+            for addr in global_block_addrs[lo:hi]:
+                if (addr - section_start) % size != 0: continue
+                idx = (addr - section_start) // size
+                ptr3 = word(idx + 2)
+                ptr4 = word(idx + 3)
+
+                if self.ptr_looks_like_a_function_start(ptr3):
+                    name = "global_block_literal_%x" % addr
+                    self.global_block_literals.append(ObjCGlobalBlockLiteral(addr, ptr3, ptr4, name))
 
         return function_starts
 
@@ -376,19 +503,27 @@ class Binary:
                     function_starts.add(addr)
                     addr_to_sym_name[addr] = fullname
 
-        if self.load_progress_callback: self.load_progress_callback.progress("Scanning code section...")
-        scanned_function_starts = self.scan_code_section()
-        function_starts = function_starts.union(scanned_function_starts)
+        table_function_starts = self.read_function_starts() if self.use_function_starts else None
+        if table_function_starts is not None:
+            function_starts.update(table_function_starts)
+
+        # The heuristic function discovery is only needed without the table, block descriptors and global block
+        # literals are always looked for.
+        discover_functions = table_function_starts is None or self.supplement_function_starts
+        if discover_functions:
+            if self.load_progress_callback: self.load_progress_callback.progress("Scanning code section...")
+            scanned_function_starts = self.scan_code_section()
+            function_starts = function_starts.union(scanned_function_starts)
 
         if self.load_progress_callback: self.load_progress_callback.progress("Scanning data section...")
-        scanned_function_starts = self.scan_data_section()
+        scanned_function_starts = self.scan_data_section(discover_functions)
         function_starts = function_starts.union(scanned_function_starts)
 
         if self.load_progress_callback: self.load_progress_callback.progress("Creating functions...")
 
         l = sorted(function_starts)
         for idx, addr in enumerate(l):
-            if addr in list(addr_to_sym_name.keys()) and addr_to_sym_name[addr] != "":
+            if addr in addr_to_sym_name and addr_to_sym_name[addr] != "":
                 sym_name = addr_to_sym_name[addr]
             elif addr == entry_vm_addr:
                 sym_name = "EntryPoint"
@@ -401,15 +536,35 @@ class Binary:
             self.functions.append(func)
             self.addr_to_func_map[addr] = func
 
-        self.find_block_references_in_functions()
+        self.build_function_index()
 
         # print function_starts
 
+    # Function starts in the code section from the LC_FUNCTION_STARTS table, or None if the binary doesn't have one.
+    def read_function_starts(self):
+        if self.load_progress_callback: self.load_progress_callback.progress("Reading function starts...")
+        addrs = self.macho.functionStarts()
+        if addrs is None: return None
+        return [addr for addr in addrs if self.code_section_start <= addr < self.code_section_end]
+
+    # Sorted function start addresses (and the functions in the same order) for bisect lookups.
+    def build_function_index(self):
+        self.function_by_start = sorted(self.functions, key=lambda f: f.addr)
+        self.function_starts = [f.addr for f in self.function_by_start]
+
     def addr_to_function(self, addr):
-        for f in self.functions:
-            if f.addr <= addr < f.addr + f.len:
-                return f
+        idx = bisect.bisect_right(self.function_starts, addr) - 1
+        if idx < 0: return None
+        f = self.function_by_start[idx]
+        if f.addr <= addr < f.addr + f.len:
+            return f
+
+        return None
 
+    def next_function_start(self, addr):
+        idx = bisect.bisect_right(self.function_starts, addr)
+        if idx < len(self.function_starts):
+            return self.function_starts[idx]
         return None
 
     def lookup_block_invoke_addr(self, instrs):
@@ -448,54 +603,55 @@ class Binary:
         return None
 
     def find_block_references_in_functions(self):
-        section_content = self.read_bytes_at_vm(self.code_section_start,
-                                                self.code_section_end - self.code_section_start)
+        self.block_references = self.scan_block_references()
+        self.link_block_references(self.block_references)
+
+    # Finds instructions referencing block descriptors or global block literals in the xref index. Returns plain tuples,
+    # either ("descriptor", instruction_addr, descriptor_addr, invoke_addr) or ("global", instruction_addr, literal_addr),
+    # so the result can be stored in the analysis cache.
+    def scan_block_references(self):
+        refs = []
+        block_kinds = (XrefIndex.KIND_BLOCK_DESCRIPTOR, XrefIndex.KIND_GLOBAL_BLOCK_LITERAL)
+        block_refs = self.xrefs.index.references_to(0, 1 << 64, kinds=block_kinds)
+        if len(block_refs) == 0: return refs
+
+        code = self.get_code_instructions()
+        consumed_end = -1
+        for (source, target, kind) in sorted(block_refs):
+            idx = code.index_of(source)
+            # The instructions after a block descriptor reference are only used to find the invoke function.
+            if idx < consumed_end: continue
+
+            if kind == XrefIndex.KIND_BLOCK_DESCRIPTOR:
+                (run_start, run_end) = code.run_of(idx)
+                window = code.instructions_between(max(run_start, idx - 4), min(run_end, idx + 6))
+                consumed_end = min(run_end, idx + 6)
+                refs.append(("descriptor", source, target, self.lookup_block_invoke_addr(window)))
+            else:
+                refs.append(("global", source, target))
+
+        return refs
 
-        block_descriptor_addresses = set([b.addr for b in self.block_descriptors])
+    def link_block_references(self, refs):
         block_descriptor_address_to_block_map = dict([(b.addr, b) for b in self.block_descriptors])
-        global_literal_addresses = set([bl.addr for bl in self.global_block_literals])
         global_literal_address_to_literal_map = dict([(bl.addr, bl) for bl in self.global_block_literals])
 
-        if len(block_descriptor_addresses | global_literal_addresses) == 0: return
-        lowest_data_pointer = min(block_descriptor_addresses | global_literal_addresses)
-        highest_data_pointer = max(block_descriptor_addresses | global_literal_addresses) + 1
-
-        addr = self.code_section_start
-        while addr < self.code_section_end:
-            to_skip = addr - self.code_section_start
-            decoded = self.arch.capstone.disasm(section_content[to_skip:], addr)
-            window = []
-
-            for (idx, i) in enumerate(decoded):
-                window.append(i)
-                if len(window) > 5: del(window[0])
-
-                ptrs = self.arch.sema.guess_pointers(i, None, lowest_data_pointer, highest_data_pointer)
-                for ptr in ptrs:
-                    if ptr in block_descriptor_address_to_block_map:
-                        block = block_descriptor_address_to_block_map[ptr]
-                        f = self.addr_to_function(i.address)
-                        bl = ObjCBlockLiteralInFunction(i.address, f, f.name)
-
-                        for _ in range(0, 5):
-                            i = next(decoded)
-                            window.append(i)
-
-                        bl.invoke_addr = self.lookup_block_invoke_addr(window)
-                        bl.invoke_func = self.addr_to_function(bl.invoke_addr)
-                        bl.invoke_func.block_descriptor = block
-                        block.uses.append(bl)
-
-                    elif ptr in global_literal_address_to_literal_map:
-                        bl = global_literal_address_to_literal_map[ptr]
-                        f = self.addr_to_function(i.address)
-                        f.block_descriptor = bl.block_descriptor_addr
-                        bl.uses.append(ObjCGlobalBlockLiteralReferenceInFunction(i.address, f, f.name))
-
-                addr = i.address + i.size
-
-            # skip one instruction (can't be decoded), or align the address to next arch.bytes() byte
-            addr = (addr + self.arch.bytes()) & (~(self.arch.bytes() - 1))
+        for ref in refs:
+            if ref[0] == "descriptor":
+                (_, instruction_addr, descriptor_addr, invoke_addr) = ref
+                block = block_descriptor_address_to_block_map[descriptor_addr]
+                f = self.addr_to_function(instruction_addr)
+                bl = ObjCBlockLiteralInFunction(instruction_addr, f, f.name)
+                bl.invoke_addr = invoke_addr
+                bl.invoke_func = self.addr_to_function(bl.invoke_addr)
+                bl.invoke_func.block_descriptor = block
+                block.uses.append(bl)
+            else:
+                (_, instruction_addr, literal_addr) = ref
+                bl = global_literal_address_to_literal_map[literal_addr]
+                f = self.addr_to_function(instruction_addr)
+                f.block_descriptor = bl.block_descriptor_addr
+                bl.uses.append(ObjCGlobalBlockLiteralReferenceInFunction(instruction_addr, f, f.name))
 
         # okay, we're done with the code section, now let's connect global block literals to descriptors
         for bl in self.global_block_literals:
@@ -506,19 +662,121 @@ class Binary:
             bl.invoke_func = self.addr_to_func_map[bl.invoke_addr]
             b.uses.append(bl)
 
+    def build_xref_index(self):
+        self.xrefs = BinaryXrefs(self, XrefIndex.from_references(self.scan_references()))
+
+    # One sweep over the code section collecting calls, tail jumps and references to Objective-C metadata, blocks and
+    # functions, followed by the data sections' pointers to functions.
+    def scan_references(self):
+        sema = self.arch.sema
+        data_kinds = {}
+        for (objects, kind) in [(self.selectors, XrefIndex.KIND_SELECTOR), (self.class_refs, XrefIndex.KIND_CLASS_REF),
+                                (self.cfstrings, XrefIndex.KIND_CFSTRING), (self.ivars, XrefIndex.KIND_IVAR)]:
+            for addr in objects.keys(): data_kinds[addr] = kind
+        for b in self.block_descriptors: data_kinds[b.addr] = XrefIndex.KIND_BLOCK_DESCRIPTOR
+        for bl in self.global_block_literals: data_kinds[bl.addr] = XrefIndex.KIND_GLOBAL_BLOCK_LITERAL
+
+        refs = []
+        code = self.get_code_instructions()
+        for run in code.runs:
+            p = float(run[0]) / float(len(code))
+            if self.load_progress_callback: self.load_progress_callback.progress("Building cross-references...", p)
+
+            instrs = code.run_instructions(run)
+            i = next(instrs, None)
+            while i is not None:
+                following = next(instrs, None)
+                if sema.is_call(i):
+                    target = sema.call_destination(i)
+                    if target is not None:
+                        refs.append((i.address, target, XrefIndex.KIND_CALL))
+                elif sema.is_unconditional_jump_csinstr(i):
+                    target = sema.unconditional_jump_destination_csinstr(i)
+                    if target is not None and self.is_tail_jump(i.address, target):
+                        refs.append((i.address, target, XrefIndex.KIND_TAIL_JUMP))
+
+                for target in sema.data_references(i, [following] if following is not None else []):
+                    kind = data_kinds.get(target)
+                    if kind is None and target in self.addr_to_func_map: kind = XrefIndex.KIND_FUNCTION_POINTER
+                    if kind is not None:
+                        refs.append((i.address, target, kind))
+                i = following
+
+        refs.extend(self.scan_data_pointers())
+        return refs
+
+    # A jump to the start of another function, or out of the code section (to a stub).
+    def is_tail_jump(self, addr, target):
+        f = self.addr_to_func_map.get(target)
+        if f is None:
+            return not (self.code_section_start <= target < self.code_section_end)
+        return f is not self.addr_to_function(addr)
+
+    def scan_data_pointers(self):
+        refs = []
+        size = self.arch.bytes()
+        for name in ["__const", "__data", "__objc_const", "__objc_data"]:
+            for s in self.macho.allSections("sectname", name):
+                if s.size < size: continue
+                start = (s.addr + size - 1) & ~(size - 1)
+                content = self.read_bytes_at_vm(start, (s.addr + s.size - start) & ~(size - 1))
+                pointers = array('Q' if size == 8 else 'I', content)
+                for (idx, ptr) in enumerate(pointers):
+                    if ptr in self.addr_to_func_map:
+                        refs.append((start + idx * size, ptr, XrefIndex.KIND_DATA_POINTER))
+        return refs
+
     def load_info_from_dyld(self):
         if self.load_progress_callback: self.load_progress_callback.progress("Loading sections and segments...")
         self.get_macho()
 
-        dyldreader = DyldInfoReader(self.arch, self.full_path)
+        dyldreader = self.get_dyld_info()
         self.stubs = dyldreader.get_stubs()
         self.external_pointers = dyldreader.get_external_pointers()
         self.imported_data_symbols = dyldreader.get_imported_data_symbols()
+        if self.shared_cache is not None: self.resolve_cross_image_pointers(dyldreader)
+
+    # In a shared cache, the stub and GOT pointers are already bound to the other images and the bind info is mostly
+    # gone. Whatever the bind info doesn't name is named by the symbol the pointer points at.
+    def resolve_cross_image_pointers(self, dyldreader):
+        for item in dyldreader.stubs:
+            if item["addr"] in self.stubs: continue
+            name = self.shared_cache.symbol_at(self.read_long_at_vm(item["symbol_addr"]))
+            if name is not None: self.stubs[item["addr"]] = name
+
+        for s in self.macho.allSections("sectname", "__got"):
+            for addr in range(s.addr, s.addr + s.size, self.arch.bytes()):
+                if addr in self.external_pointers: continue
+                name = self.shared_cache.symbol_at(self.read_long_at_vm(addr))
+                if name is not None: self.external_pointers[addr] = name
+
+    # dyld also turns calls through stubs into direct calls into the other images. Those targets are named like stubs,
+    # so calls to them are resolved the same way.
+    def resolve_cross_image_calls(self):
+        index = self.xrefs.index
+        targets = set()
+        for i in range(len(index)):
+            if index.kinds[i] not in XrefIndex.CODE_KINDS: continue
+            target = index.targets[i]
+            if self.code_section_start <= target < self.code_section_end: continue
+            targets.add(target)
+
+        for target in sorted(targets):
+            if target in self.stubs: continue
+            name = self.shared_cache.symbol_at(target)
+            if name is not None: self.stubs[target] = name
+
+    def get_dyld_info(self):
+        if self.dyld_info is not None: return self.dyld_info
+
+        self.get_macho()
+        self.dyld_info = DyldInfoReader(self.arch, self.macho)
+        return self.dyld_info
 
     def function_from_addr(self, addr, length=None, name=None):
         addr = self.arch.sema.function_start_from_addr(addr)
 
-        if addr not in list(self.addr_to_func_map.keys()):
+        if addr not in self.addr_to_func_map:
             assert False # We should already have all the functions
             assert length is not None
             assert name is not None
@@ -526,6 +784,7 @@ class Binary:
             func.binary = self
             self.functions.append(func)
             self.addr_to_func_map[addr] = func
+            self.build_function_index()
 
         return self.addr_to_func_map[addr]
 
@@ -542,6 +801,7 @@ class Binary:
             import macho.loadcommands.symtab
             import macho.loadcommands.dysymtab
             import macho.loadcommands.dyld_info
+            import macho.loadcommands.function_starts
             import macho.sections.symbol_ptr
         def _enable_encryption():
             import macho.loadcommands.encryption_info
@@ -562,44 +822,25 @@ class Binary:
             _enable_objc()
         _enable_all()
 
-        self.macho = macho.macho.MachO(self.path, self.arch.archvalue)
-        self.macho.open()
+        if self.image_name is not None:
+            self.shared_cache = get_shared_cache(self.path)
+            self.macho = self.shared_cache.image_macho(self.image_name)
+        else:
+            self.macho = macho.macho.MachO(self.path, self.arch.archvalue)
+            self.macho.open()
+        self.vm = VMReader(self.macho, self.arch)
 
     def read_long_at_vm(self, vm_addr):
-        file_addr = self.macho.mappings.fromVM(vm_addr)
-        pos = self.macho.file.tell()
-        self.macho.file.seek(self.macho.origin + file_addr)
-        bytes = self.macho.file.read(self.arch.bytes())
-        self.macho.file.seek(pos)
-        return struct.unpack("<L" if self.arch.bytes() == 4 else "<Q", bytes)[0]
+        return self.vm.read_pointer(vm_addr)
 
     def read_uin64_at_file_addr(self, file_addr):
-        pos = self.macho.file.tell()
-        self.macho.file.seek(self.macho.origin + file_addr)
-        bytes = self.macho.file.read(8)
-        self.macho.file.seek(pos)
-        return struct.unpack("<Q", bytes)[0]
+        return self.vm.read_uint64_at_file_addr(file_addr)
 
     def read_bytes_at_vm(self, vm_addr, num_bytes):
-        file_addr = self.macho.mappings.fromVM(vm_addr)
-        pos = self.macho.file.tell()
-        self.macho.file.seek(self.macho.origin + file_addr)
-        bytes = self.macho.file.read(num_bytes)
-        self.macho.file.seek(pos)
-        return bytes
+        return self.vm.read_bytes(vm_addr, num_bytes)
 
     def read_c_string_at_vm(self, vm_addr):
-        file_addr = self.macho.mappings.fromVM(vm_addr)
-        pos = self.macho.file.tell()
-        self.macho.file.seek(self.macho.origin + file_addr)
-        s = []
-        while True:
-            byte = self.macho.file.read_byte()
-            if byte == 0:
-                break
-            s.append(byte)
-        self.macho.file.seek(pos)
-        return str(bytes(s), 'utf-8')
+        return self.vm.read_c_string(vm_addr)
 
     def read_selectors(self):
         self.get_macho()
@@ -631,8 +872,9 @@ class Binary:
         section = sections[0]
 
 
-        dyldreader = DyldInfoReader(self.arch, self.full_path)
+        dyldreader = self.get_dyld_info()
         dyld_class_refs = dyldreader.get_class_refs()
+        own_image = self.shared_cache.image(self.image_name) if self.shared_cache is not None else None
 
         idx = 0
         while idx < section.size:
@@ -644,6 +886,8 @@ class Binary:
                 class_name = self.read_c_string_at_vm(class_name_addr)
                 symbol_name = "_OBJC_CLASS_$_%s" % class_name
                 external_dylib = None
+                if self.shared_cache is not None:
+                    external_dylib = self.shared_cache.external_image_name(classdef_addr, own_image)
             else:
                 symbol_name = dyld_class_refs[classref_addr]["symbol"]
                 class_name = symbol_name.replace("_OBJC_CLASS_$_", "")
@@ -715,23 +959,28 @@ class Binary:
         self.get_macho()
         self.classes = []
 
-        self.ivars = {}
+        # Selectors, class refs, cfstrings and ivars might already be restored from the analysis cache.
+        load_ivars = self.ivars is None
+        if load_ivars: self.ivars = {}
 
-        if self.load_progress_callback: self.load_progress_callback.progress("Loading selectors...")
-        self.read_selectors()
+        if self.selectors is None:
+            if self.load_progress_callback: self.load_progress_callback.progress("Loading selectors...")
+            self.read_selectors()
 
-        if self.load_progress_callback: self.load_progress_callback.progress("Loading class references...")
-        self.read_class_refs()
+        if self.class_refs is None:
+            if self.load_progress_callback: self.load_progress_callback.progress("Loading class references...")
+            self.read_class_refs()
 
-        if self.load_progress_callback: self.load_progress_callback.progress("Loading strings...")
-        self.read_cfstrings()
+        if self.cfstrings is None:
+            if self.load_progress_callback: self.load_progress_callback.progress("Loading strings...")
+            self.read_cfstrings()
 
         if self.load_progress_callback: self.load_progress_callback.progress("Loading class list...")
 
         s = self.get_section_classes()
         if s is not None:
             for c in s.classes:
-                self.load_class(c, True, c.name)
+                self.load_class(c, load_ivars, c.name)
 
         if self.load_progress_callback: self.load_progress_callback.progress("Loading category list...")
 
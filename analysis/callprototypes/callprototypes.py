@@ -5,6 +5,7 @@ import pickle
 
 from pycparser import c_ast, parse_file
 
+from analysis.analysiscache import cache_directory
 from analysis.types import VariadicArguments, VoidType
 from analysis.ucode.ucode import *
 from analysis.ucode.ucode_utils import UCodeUtils
@@ -16,7 +17,7 @@ class CallPrototypesResolver:
         self.binary = binary
         self.prototypes = {}
 
-        cache_file = "/var/tmp/cricket-" + "callprototypes.cache"
+        cache_file = None
         files_to_load = [
             os.path.dirname(os.path.abspath(__file__)) + "/" + "callprototypes_objc_runtime.h",
             os.path.dirname(os.path.abspath(__file__)) + "/" + "callprototypes_objc_runtime2.h",
@@ -29,12 +30,13 @@ class CallPrototypesResolver:
         code_file = __file__
 
         checksum = hashlib.md5()
-        for f in files_to_load:
-            checksum.update(open(f, 'rb').read())
-        checksum.update(open(code_file, 'rb').read())
+        for f in files_to_load + [code_file]:
+            with open(f, 'rb') as source:
+                checksum.update(source.read())
         digest = checksum.hexdigest()
 
         try:
+            cache_file = os.path.join(cache_directory(), "callprototypes.cache")
             (checksum_from_cache, prototypes_from_cache) = self.load_from_cache(cache_file, digest)
             if checksum_from_cache == digest:
                 self.prototypes = prototypes_from_cache
@@ -45,13 +47,19 @@ class CallPrototypesResolver:
         self.load_from_files(files_to_load, cache_file, digest)
 
     def load_from_cache(self, cache_file, digest):
-        return pickle.load(open(cache_file, "rb"))
+        with open(cache_file, "rb") as f:
+            return pickle.load(f)
 
     def load_from_files(self, files, cache_file, checksum):
         for f in files:
             self.parse_header(f)
 
-        pickle.dump((checksum, self.prototypes), open(cache_file, "wb"), -1)
+        if cache_file is None: return
+        try:
+            with open(cache_file, "wb") as f:
+                pickle.dump((checksum, self.prototypes), f, -1)
+        except:
+            pass  # Not being able to write the cache is not an error.
 
     def parse_header(self, f):
         ast = parse_file(f, use_cpp=False)
@@ -91,6 +99,13 @@ class CallPrototypesResolver:
                 self.resolve_format_string(function, call_instruction)
             return
 
+        # Internal functions that were already analyzed (bottom-up, see analysis.summaries).
+        summary = self.binary.function_summaries.get(call_instruction.callee().value)
+        if summary is not None:
+            (param_types, return_type) = summary.prototype(self.binary.types)
+            self.process_call_with_params(function, call_instruction, param_types, return_type)
+            return
+
         assert call_instruction.callee().name is not None
         assert call_instruction.callee().name[0] == "_"
         name = call_instruction.callee().name[1:]
@@ -146,11 +161,8 @@ class CallPrototypesResolver:
         callee = call_instruction.callee()
         # destination = (call_instruction.destination() if returns_something else None)
         destination = (self.arch.sema.get_uregister(function, self.arch.sema.retval_location(return_type)) if returns_something else None)
-        new_instr = call_instruction.replace_with(UCodeCall(callee, destination, params))
-        if not ellipsis:
-            new_instr.has_unknown_operands = False
-        new_instr.param_types = param_types
-        new_instr.return_type = return_type
+        # The new call is complete before it replaces the old one, replace_with compares the prototypes as well.
+        call_instruction.replace_with(UCodeCall(callee, destination, params, not ellipsis, param_types, return_type))
 
     def resolve_objc_msgsend(self, function, call_instruction):
         selector = call_instruction.params()[1]
@@ -313,8 +325,7 @@ class CallPrototypesResolver:
         #print params
         callee = call_instruction.callee()
         destination = call_instruction.destination()
-        new_instr = call_instruction.replace_with(UCodeCall(callee, destination, params))
-        new_instr.has_unknown_operands = False
+        call_instruction.replace_with(UCodeCall(callee, destination, params, True))
 
 
 class FuncDeclVisitor(c_ast.NodeVisitor):
@@ -1,3 +1,5 @@
+import itertools
+
 from analysis.asm.assembly_printer import AssemblyPrinter
 import analysis.source.ast_printer
 from analysis.asm.basicblock import detect_bb_beginnings_and_function_end, convert_stuff_beyond_end_to_data, \
@@ -86,16 +88,10 @@ class Function:
     def load_disassembly_from_binary(self):
 
         if self.len == -1:
-            function_addrs = sorted(self.binary.addr_to_func_map.keys())
-            idx = function_addrs.index(self.addr)
-            self.len = function_addrs[idx + 1] - self.addr if idx + 1 < len(function_addrs) else self.binary.code_section_end - self.addr
+            next_addr = self.binary.next_function_start(self.addr)
+            self.len = next_addr - self.addr if next_addr is not None else self.binary.code_section_end - self.addr
 
-        macho = self.binary.macho
-        file_addr = macho.mappings.fromVM(self.addr)
-        pos = macho.file.tell()
-        macho.file.seek(self.binary.macho.origin + file_addr)
-        bytes = macho.file.read(self.len)
-        macho.file.seek(pos)
+        bytes = self.binary.read_bytes_at_vm(self.addr, self.len)
 
         self.bytes = bytes
         self.instructions = self.instructions_from_bytes(bytes)
@@ -107,9 +103,14 @@ class Function:
         # self.instructions = reader.parseDisassemblyForMethod(self.name)
 
     def instructions_from_bytes(self, bytes):
-        decoded = self.arch.capstone.disasm(bytes, self.addr)
+        # Decode along the instruction boundaries of the binary's linear sweep, disassemble whatever it doesn't cover.
+        decoded = []
+        if self.binary is not None and self.binary.code_instructions is not None:
+            decoded = self.binary.code_instructions.instructions_in_range(self.addr, self.addr + len(bytes))
+        next_instr_address = decoded[-1].address + decoded[-1].size if len(decoded) > 0 else self.addr
+        decoded = itertools.chain(decoded, self.arch.capstone.disasm(bytes[next_instr_address - self.addr:], next_instr_address))
+
         instructions = []
-        next_instr_address = self.addr
         for csinstr in decoded:
             instr = AssemblyInstruction(self.arch, csinstr.address, csinstr.bytes, csinstr.mnemonic, csinstr.op_str)
             instr.csinstr = csinstr
@@ -117,30 +118,43 @@ class Function:
             instructions.append(instr)
             next_instr_address = csinstr.address + csinstr.size
 
-        class AnyObject(object):
-            pass
-
         while (next_instr_address - self.addr) < len(bytes):
             b = bytes[next_instr_address - self.addr]
-            instr = AssemblyDataInstruction(self.arch, next_instr_address, b, "db", "0x%x" % ord(b))
-            instr.csinstr = AnyObject()
-            instr.csinstr.mnemonic = "db"
-            instr.csinstr.id = -1
-            instr.csinstr.groups = []
-            instr.csinstr.operands = []
-            instr.csinstr.op_str = "0x%x" % ord(b)
-            instr.canonicalsyntax = "%s %s" % ("db", "0x%x" % ord(b))
-            instructions.append(instr)
+            instructions.append(AssemblyDataInstruction.from_byte(self.arch, next_instr_address, b))
             next_instr_address += 1
 
         return instructions
 
     def capstone_instructions(self):
         for instr in self.instructions:
-            if instr.csinstr is not None: continue
+            if instr.is_decoded(): continue
             instr.canonicalize_capstone()
 
-        self.instructions = [instr for instr in self.instructions if instr.csinstr is not None]
+        self.instructions = [instr for instr in self.instructions if instr.is_decoded()]
+
+    # Drops the capstone instructions (and their operand details), they're decoded again if something asks for them.
+    def release_capstone_instructions(self):
+        for instr in self.instructions:
+            instr.release_csinstr()
+        for bb in self.bbs:
+            for instr in bb.instructions:
+                if isinstance(instr, AssemblyInstruction): instr.release_csinstr()
+
+    # Drops everything load() and the decompilation built, the next load() starts over from the bytes.
+    def unload(self):
+        self.bytes = None
+        self.instructions = None
+        self.bb_beginnings = None
+        self.func_end = None
+        self.bbs = None
+        self.ast = None
+        self.patterns = []
+        self.ufunction = None
+        self.parameters = None
+        self.returns = None
+        self.stack_frame_size = 0
+        self.stack_variables = None
+        self.pic_info = None
 
     def is_objc(self):
         return self.method is not None
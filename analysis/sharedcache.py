@@ -0,0 +1,118 @@
+import bisect
+import os
+import struct
+
+from macho.sharedcache import DyldSharedCache
+from sym import SYMTYPE_UNDEFINED
+
+LC_SEGMENT = 0x1
+LC_SEGMENT_64 = 0x19
+
+
+# Short form of an image path, the same one dyldinfo prints, e.g. "/usr/lib/libobjc.A.dylib" -> "libobjc".
+def short_image_name(path):
+    name = os.path.basename(path)
+    while True:
+        (stem, ext) = os.path.splitext(name)
+        if not ext: break
+        name = stem
+    return name
+
+
+# A dyld shared cache, mapped once per process and shared by all the Binary objects analyzing images from it. The
+# images' MachO objects read straight from the cache's mmap, and since the cache's mappings cover all images, pointers
+# into other images (bound stubs, GOT entries, class refs) can be followed and named by the image they point into.
+class SharedCache:
+    def __init__(self, path):
+        self.path = path
+        self.cache = DyldSharedCache(path)
+        ":type: DyldSharedCache"
+        self.cache.open()
+        self.segment_starts = None
+        self.segments = None
+
+    # The architecture from the cache header ("dyld_v1   arm64"), as an archvalue.
+    def archvalue(self):
+        return self.cache.file[:16].split(b'\0')[0].decode('utf-8').split()[1]
+
+    # 'name' is either the install path of the image or its short name ("UIKit", "libobjc").
+    def image(self, name):
+        image = self.cache.images.any('path', name)
+        if image is None: image = self.cache.images.any('name', name)
+        if image is None: assert False  # No such image in the cache.
+        return image
+
+    def image_names(self):
+        return [image.path for image in self.unique_images()]
+
+    def unique_images(self):
+        result = []
+        seen = set()
+        for image in self.cache.images:
+            if id(image) in seen: continue
+            seen.add(id(image))
+            result.append(image)
+        return result
+
+    def image_macho(self, name):
+        return self.image(name).machO
+
+    # Segments of all images, sorted by address. Only the load commands are read, the images' MachO objects aren't
+    # created. __LINKEDIT is shared by all images in the cache, so it's left out.
+    def build_segment_index(self):
+        f = self.cache.file
+        endian = self.cache.endian
+        segments = []
+        for image in self.unique_images():
+            offset = self.cache.mappings.fromVM(image.address)
+            if offset < 0: continue
+            (magic, _, _, ncmds, _, _) = struct.unpack_from(endian + "6L", f, offset)
+            pos = offset + (32 if magic in [0xfeedfacf, 0xcffaedfe] else 28)
+            for _ in range(ncmds):
+                (cmd, cmdsize) = struct.unpack_from(endian + "2L", f, pos)
+                if cmd in [LC_SEGMENT, LC_SEGMENT_64]:
+                    segname = f[pos + 8:pos + 24].split(b'\0')[0]
+                    fmt = endian + ("2Q" if cmd == LC_SEGMENT_64 else "2L")
+                    (vmaddr, vmsize) = struct.unpack_from(fmt, f, pos + 24)
+                    if segname != b"__LINKEDIT" and vmsize > 0:
+                        segments.append((vmaddr, vmaddr + vmsize, image))
+                pos += cmdsize
+
+        segments.sort(key=lambda s: s[0])
+        self.segment_starts = [s[0] for s in segments]
+        self.segments = segments
+
+    def image_for_addr(self, addr):
+        if self.segments is None: self.build_segment_index()
+        idx = bisect.bisect_right(self.segment_starts, addr) - 1
+        if idx < 0: return None
+        (start, end, image) = self.segments[idx]
+        if addr >= end: return None
+        return image
+
+    # Name of the symbol defined at 'addr' by whichever image contains it, or None.
+    def symbol_at(self, addr):
+        image = self.image_for_addr(addr)
+        if image is None: return None
+        macho = image.machO
+        if not hasattr(macho, 'symbols'): return None
+        for sym in macho.symbols.all('addr', addr):
+            if sym.symtype != SYMTYPE_UNDEFINED and sym.name:
+                return sym.name
+        return None
+
+    # Short name of the image containing 'addr' if that's not 'own_image', None otherwise.
+    def external_image_name(self, addr, own_image):
+        image = self.image_for_addr(addr)
+        if image is None or image is own_image: return None
+        return short_image_name(image.path)
+
+
+shared_caches = {}
+
+
+def get_shared_cache(path):
+    path = os.path.abspath(path)
+    if path not in shared_caches:
+        shared_caches[path] = SharedCache(path)
+    return shared_caches[path]
@@ -10,86 +10,138 @@ class Sublist(object):
         self.list = list
 
 
+# A pattern compiled into a predicate. 'root_class' is the only class of node the pattern can match (None for Any), so
+# walks only evaluate the pattern on nodes of that class. Leaf values in patterns (names, numbers) only constrain the
+# type of the node, the callbacks check the actual values.
+class CompiledPattern(object):
+    def __init__(self, root_class, test, sublist=None):
+        self.root_class = root_class
+        self.test = test
+        self.sublist = sublist
+
+    def accepts(self, node):
+        if self.root_class is not None and node.__class__ is not self.root_class: return False
+        return self.test(node)
+
+    # What the match callbacks get: the node itself, or a Sublist of the matched items for Sublist patterns.
+    def result(self, node):
+        if self.sublist is None: return node
+        return Sublist(match_sublist(node, 0, self.sublist, 0))
+
+
+def always(node):
+    return True
+
+
+# Matches 'matchers' in order against items[start:], not necessarily adjacent ones, without copying the list. Returns
+# the matched items, or None.
+def match_sublist(items, start, matchers, k):
+    if k == len(matchers): return []
+    matcher = matchers[k]
+    for idx in range(start, len(items)):
+        if matcher.accepts(items[idx]):
+            rest = match_sublist(items, idx + 1, matchers, k + 1)
+            if rest is not None:
+                return [items[idx]] + rest
+    return None
+
+
+def pattern_key(cond):
+    if cond.__class__ == Any: return ("any",)
+    if cond.__class__ == Sublist: return ("sublist",) + tuple([pattern_key(c) for c in cond.list])
+    if isinstance(cond, _ast.AST):
+        return (cond.__class__,) + tuple([(field, pattern_key(getattr(cond, field))) for field in cond.__class__._fields])
+    return ("leaf", cond.__class__)
+
+
+compiled_patterns = {}
+
+
 class AstMatcher(object):
     def __init__(self):
         pass
 
-    def compare1(self, node, cond):
+    def compile(self, cond):
+        key = pattern_key(cond)
+        if key not in compiled_patterns:
+            compiled_patterns[key] = self.compile_uncached(cond)
+        return compiled_patterns[key]
+
+    def compile_uncached(self, cond):
         if cond.__class__ == Any:
-            return True
+            return CompiledPattern(None, always)
+
         if cond.__class__ == Sublist:
-            if node.__class__ == list:
+            matchers = [self.compile_uncached(c) for c in cond.list]
+            return CompiledPattern(list, lambda node: match_sublist(node, 0, matchers, 0) is not None, matchers)
+
+        if isinstance(cond, _ast.AST):
+            fields = []
+            for field in cond.__class__._fields:
+                sub = self.compile_uncached(getattr(cond, field))
+                if sub.test is always and sub.root_class is None: continue
+                fields.append((field, sub))
+
+            def test(node):
+                for (field, sub) in fields:
+                    if not sub.accepts(getattr(node, field)): return False
                 return True
-        if node.__class__ == cond.__class__:
-            return True
-        if node.__class__ in [str, str] and cond.__class__ in [str, str]:
-            return True
-
-        return False
 
-    def deep_compare_sublist(self, node, cond):
-        # Sublist comparison.
-        if len(cond.list) == 0: return True, Sublist([])
-
-        for idx, item in enumerate(node):
-            result, matched_node = self.deep_compare(item, cond.list[0])
-            if result:
-                rest_result, rest_sublist = self.deep_compare_sublist(node[idx + 1:], Sublist(cond.list[1:]))
-                if rest_result:
-                    return True, Sublist([item] + rest_sublist.list)
-        return False, []
-
-    def deep_compare(self, node, cond):
-        if cond.__class__ == Any:
-            return True, node
+            return CompiledPattern(cond.__class__, test)
 
-        if not self.compare1(node, cond):
-            return False, None
+        # Lists (compared by type only) and leaf values.
+        return CompiledPattern(cond.__class__, always)
 
-        if isinstance(node, list):
-            if cond.__class__ == Sublist:
-                compare_result, compare_sublist = self.deep_compare_sublist(node, cond)
-                return compare_result, compare_sublist
-            else:
-                # Compare all indices.
-                for i in node:
-                    if not self.deep_compare(i, cond):
-                        return False, None
+    def match(self, node, cond, callback):
+        self.match_compiled(node, self.compile(cond), callback)
+
+    def match_compiled(self, node, pattern, callback):
+        if pattern.accepts(node):
+            callback(pattern.result(node))
+        elif isinstance(node, list):
+            for field in node:
+                self.match_compiled(field, pattern, callback)
         elif isinstance(node, _ast.AST):
-            if node.__class__ != cond.__class__:
-                return False
-
             for field in node.__class__._fields:
-                compare_result, compare_sublist = self.deep_compare(getattr(node, field), getattr(cond, field))
-                if not compare_result:
-                    return False, None
-
-        return True, node
-
-    def match(self, node, cond, callback):
-        compare_result, matched_node = self.deep_compare(node, cond)
-        if compare_result:
-            callback(matched_node)
-        else:
-            if isinstance(node, list):
-                for field in node:
-                    self.match(field, cond, callback)
-            elif isinstance(node, _ast.AST):
-                for field in node.__class__._fields:
-                    self.match(getattr(node, field), cond, callback)
+                self.match_compiled(getattr(node, field), pattern, callback)
 
     def replace(self, node, cond, callback):
-        compare_result, match_node = self.deep_compare(node, cond)
-        if compare_result:
+        return self.replace_many(node, [(cond, callback)])
+
+    # Replaces the nodes matching any of the (cond, callback) rules in a single walk. At every node the rules are tried
+    # in order, a node matched by a rule is replaced with the callback's result and the rule doesn't look inside it,
+    # the remaining rules continue into the replacement. That's the same as separate replace() calls as long as no rule
+    # matches nodes that the other rules' callbacks create or modify. Like replace(), the root itself is never replaced
+    # and True is returned if it matched.
+    def replace_many(self, node, rules):
+        compiled = [(self.compile(cond), callback) for (cond, callback) in rules]
+        remaining = [rule for rule in compiled if not rule[0].accepts(node)]
+        if len(remaining) > 0:
+            self.replace_children(node, remaining)
+        if len(remaining) < len(compiled):
             return True
 
+    def replace_children(self, node, rules):
         if isinstance(node, list):
             for idx, field in enumerate(node):
-                if self.replace(field, cond, callback):
-                    node[idx] = callback(node[idx])
+                newval = self.replace_node(field, rules)
+                if newval is not field:
+                    node[idx] = newval
         elif isinstance(node, _ast.AST):
             for field in node.__class__._fields:
-                if self.replace(getattr(node, field), cond, callback):
-                    oldval = getattr(node, field)
-                    newval = callback(oldval)
+                oldval = getattr(node, field)
+                newval = self.replace_node(oldval, rules)
+                if newval is not oldval:
                     setattr(node, field, newval)
+
+    def replace_node(self, node, rules):
+        remaining = rules
+        for rule in rules:
+            (pattern, callback) = rule
+            if pattern.accepts(node):
+                node = callback(node)
+                remaining = [r for r in remaining if r is not rule]
+
+        if len(remaining) > 0 and isinstance(node, (list, _ast.AST)):
+            self.replace_children(node, remaining)
+        return node
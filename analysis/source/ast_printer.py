@@ -1,32 +1,50 @@
 import ast
 from analysis.tools.objc import format_msgSend, format_objc_function_declaration, format_c_function_declaration
+from analysis.tools.textbuilder import TextBuilder
 
 
+# Statements are written to self.builder as they are visited, expressions are returned as strings.
 class CCodePrinter(ast.NodeVisitor):
     def __init__(self):
         self.indent_level = 0
         self.text = None
         self.line_to_object_map = None
+        self.builder = None
 
     def execute(self, func):
-        self.line_to_object_map = {}
+        self.builder = TextBuilder()
+        w = self.builder.write
 
-        self.text = ""
-        self.text += "// Generated %s code for function '%s'\n" % ("Obj-C" if func.is_objc() else "C", func.name)
-        self.text += "\n"
+        w("// Generated %s code for function '%s'\n" % ("Obj-C" if func.is_objc() else "C", func.name))
+        w("\n")
         if func.is_objc():
-            self.text += "#import <Foundation/Foundation.h>\n\n"
+            w("#import <Foundation/Foundation.h>\n\n")
             for i in func.ast.globals:
-                self.text += "%s" % self.visit(func.ast.globals[i])
+                self.visit(func.ast.globals[i])
             if len(func.ast.globals) != 0:
-                self.text += "\n"
-            self.text += "@interface %s : NSObject\n@end\n\n" % func.method.cls.name
-            self.text += "@implementation %s\n\n" % func.method.cls.name
+                w("\n")
+            w("@interface %s : NSObject\n@end\n\n" % func.method.cls.name)
+            w("@implementation %s\n\n" % func.method.cls.name)
 
-        self.text += self.visit(func.ast.root)
+        self.visit(func.ast.root)
 
         if func.is_objc():
-            self.text += "\n@end\n"
+            w("\n@end\n")
+
+        self.text = self.builder.text()
+        self.line_to_object_map = self.builder.line_map()
+
+    def emit(self, s):
+        self.builder.write(s)
+
+    # Renders statements into a string instead of the output, for statements nested in expressions (blocks).
+    def capture(self, node):
+        saved = self.builder
+        self.builder = TextBuilder()
+        self.visit(node)
+        s = self.builder.text()
+        self.builder = saved
+        return s
 
     def i(self):
         return " " * (self.indent_level * 4)
@@ -42,10 +60,8 @@ class CCodePrinter(ast.NodeVisitor):
         assert False
 
     def visit_list(self, l):
-        s = ""
         for i in l:
-            s += self.visit(i)
-        return s
+            self.visit(i)
 
     # def visit_Compound(self, node):
     #     assert isinstance(node.body, list)
@@ -60,13 +76,14 @@ class CCodePrinter(ast.NodeVisitor):
         return node.id
 
     def visit_Label(self, node):
-        return "%s:\n%s" % (node.name, self.visit(node.body))
+        self.emit("%s:\n" % node.name)
+        self.visit(node.body)
 
     def visit_Assign(self, node):
         if node.decltype is None:
-            return self.i() + "%s = %s;\n" % (self.visit(node.targets), self.visit(node.value))
+            self.emit(self.i() + "%s = %s;\n" % (self.visit(node.targets), self.visit(node.value)))
         else:
-            return self.i() + "%s %s = %s;\n" % (node.decltype, self.visit(node.targets), self.visit(node.value))
+            self.emit(self.i() + "%s %s = %s;\n" % (node.decltype, self.visit(node.targets), self.visit(node.value)))
 
     def visit_Increment(self, node):
         return "%s++" % self.visit(node.target)
@@ -84,41 +101,37 @@ class CCodePrinter(ast.NodeVisitor):
         return "@selector(%s)" % node.value
 
     def visit_If(self, node):
-        s = self.i() + "if (%s) {\n" % self.visit(node.test)
+        self.emit(self.i() + "if (%s) {\n" % self.visit(node.test))
         self.i_up()
-        s += self.visit(node.body)
+        self.visit(node.body)
         if node.orelse:
             self.i_down()
-            s += self.i() + "} else {\n"
+            self.emit(self.i() + "} else {\n")
             self.i_up()
-            s += self.visit(node.orelse)
+            self.visit(node.orelse)
         self.i_down()
-        s += self.i() + "}\n"
-        return s
+        self.emit(self.i() + "}\n")
 
     def visit_While(self, node):
-        s = self.i() + "while (%s) {\n" % self.visit(node.test)
+        self.emit(self.i() + "while (%s) {\n" % self.visit(node.test))
         self.i_up()
-        s += self.visit(node.body)
+        self.visit(node.body)
         self.i_down()
-        s += self.i() + "}\n"
-        return s
+        self.emit(self.i() + "}\n")
 
     def visit_DoWhile(self, node):
-        s = self.i() + "do {\n"
+        self.emit(self.i() + "do {\n")
         self.i_up()
-        s += self.visit(node.body)
+        self.visit(node.body)
         self.i_down()
-        s += self.i() + "} while (%s);\n" % self.visit(node.test)
-        return s
+        self.emit(self.i() + "} while (%s);\n" % self.visit(node.test))
 
     def visit_ForEach(self, node):
-        s = self.i() + "for (%s %s in %s) {\n" % (node.typename, self.visit(node.variable), self.visit(node.source))
+        self.emit(self.i() + "for (%s %s in %s) {\n" % (node.typename, self.visit(node.variable), self.visit(node.source)))
         self.i_up()
-        s += self.visit(node.body)
+        self.visit(node.body)
         self.i_down()
-        s += self.i() + "}\n"
-        return s
+        self.emit(self.i() + "}\n")
 
     def visit_Compare(self, node):
         return "%s %s %s" % (self.visit(node.left), self.visit(node.ops), self.visit(node.comparators))
@@ -153,25 +166,25 @@ class CCodePrinter(ast.NodeVisitor):
         return self.visit(node.body)
 
     def visit_Statement(self, node):
-        return self.i() + self.visit(node.expr) + ";\n"
+        self.emit(self.i() + self.visit(node.expr) + ";\n")
 
     def visit_Goto(self, node):
-        return self.i() + "goto " + node.label + ";\n"
+        self.emit(self.i() + "goto " + node.label + ";\n")
 
     def visit_Asm(self, node):
-        return self.i() + "__asm { %s };\n" % node.instr.canonicalsyntax
+        self.emit(self.i() + "__asm { %s };\n" % node.instr.canonicalsyntax)
 
     def visit_Return(self, node):
         if node.value:
-            return self.i() + "return %s;\n" % self.visit(node.value)
+            self.emit(self.i() + "return %s;\n" % self.visit(node.value))
         else:
-            return self.i() + "return;\n"
+            self.emit(self.i() + "return;\n")
 
     def visit_Todo(self, node):
         return "<<TODO %s>>" % node.text
 
     def visit_Declaration(self, node):
-        return self.i() + "%s %s;\n" % (node.typename, node.name)
+        self.emit(self.i() + "%s %s;\n" % (node.typename, node.name))
 
     def visit_BoolOp(self, node):
         return (" %s " % self.visit(node.op)).join([self.visit(n) for n in node.values])
@@ -189,27 +202,25 @@ class CCodePrinter(ast.NodeVisitor):
     def visit_ObjCFunctionDef(self, node):
         arg_types = [a.typename for a in node.args]
         arg_names = [a.name for a in node.args]
-        s = "%s {\n" % format_objc_function_declaration(node.static, node.returntype, node.selector, arg_types, arg_names)
+        self.emit("%s {\n" % format_objc_function_declaration(node.static, node.returntype, node.selector, arg_types, arg_names))
         self.i_up()
-        s += self.visit(node.body)
+        self.visit(node.body)
         self.i_down()
-        s += self.i() + "}\n"
-        return s
+        self.emit(self.i() + "}\n")
 
     def visit_CFunctionDef(self, node):
         arg_types = [a.typename for a in node.args]
         arg_names = [a.name for a in node.args]
-        s = "%s {\n" % format_c_function_declaration(node.returntype, node.name, arg_types, arg_names)
+        self.emit("%s {\n" % format_c_function_declaration(node.returntype, node.name, arg_types, arg_names))
         self.i_up()
-        s += self.visit(node.body)
+        self.visit(node.body)
         self.i_down()
-        s += self.i() + "}\n"
-        return s
+        self.emit(self.i() + "}\n")
 
     def visit_BlockDefinition(self, node):
         s = "^() {\n"
         self.i_up()
-        s += self.visit(node.body)
+        s += self.capture(node.body)
         self.i_down()
         s += self.i() + "}"
         return s
@@ -29,12 +29,10 @@ class EmbedBlocksRewriter(object):
         return ast2.Name(id=self.captures[offset])
 
     def process_inner_block_root(self, root):
-        cond = ast2.BinOp(left=ast2.Name("block_literal"), op=ast2.Add(), right=ast2.Num(n=Any()))
-        result = AstMatcher().replace(root, cond, self.callback_capture_usage)
-
-        cond = ast2.FieldAccess(object=ast2.Name("block_literal"), field=Any())
-        result = AstMatcher().replace(root, cond, self.callback_capture_usage2)
-        pass
+        AstMatcher().replace_many(root, [
+            (ast2.BinOp(left=ast2.Name("block_literal"), op=ast2.Add(), right=ast2.Num(n=Any())), self.callback_capture_usage),
+            (ast2.FieldAccess(object=ast2.Name("block_literal"), field=Any()), self.callback_capture_usage2),
+        ])
 
     def callback_process_block_to_be_embedded(self, node):
         if not isinstance(node, ast2.Assign): return node
@@ -26,11 +26,11 @@ class MsgSendRewriter(object):
         cond = ast2.Call(ast2.Name("_objc_msgSendSuper"), Any())
         AstMatcher().replace(self.ast.root, cond, self.callback)
 
-        cond = ast2.Call(ast2.Name("_objc_msgSendSuper2"), Any())
-        AstMatcher().replace(self.ast.root, cond, self.callback)
-
-        cond = ast2.Name(Any())
-        AstMatcher().replace(self.ast.root, cond, self.callback_class_rewriting)
+        # The class name rewriting is independent from the message sends, so it shares the last walk.
+        AstMatcher().replace_many(self.ast.root, [
+            (ast2.Call(ast2.Name("_objc_msgSendSuper2"), Any()), self.callback),
+            (ast2.Name(Any()), self.callback_class_rewriting),
+        ])
 
     def callback_class_rewriting(self, node):
         if not isinstance(node, ast2.Name): return node
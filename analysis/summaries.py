@@ -0,0 +1,266 @@
+from analysis.ucode.ucode import *
+from analysis.xrefs import XrefIndex
+
+
+# What callers need to know about a function: how many argument registers it reads, whether it produces a return value
+# and which registers it may overwrite. Computed from the freshly built ucode (see compute_function_summary) and used by
+# CallPrototypesResolver instead of guessing the prototype of calls to the function from the caller's side.
+class FunctionSummary:
+    def __init__(self, addr, arg_count, returns_value, clobbered_registers):
+        self.addr = addr
+        self.arg_count = arg_count
+        self.returns_value = returns_value
+        self.clobbered_registers = clobbered_registers
+        ":type: frozenset[str]"
+
+    def prototype(self, types):
+        param_types = [types.get("long")] * self.arg_count
+        return_type = types.get("long") if self.returns_value else types.get("void")
+        return (param_types, return_type)
+
+    def to_tuple(self):
+        return (self.addr, self.arg_count, self.returns_value, tuple(sorted(self.clobbered_registers)))
+
+    @staticmethod
+    def from_tuple(t):
+        return FunctionSummary(t[0], t[1], t[2], frozenset(t[3]))
+
+
+# Registers holding the first integer arguments of a call, in order.
+def argument_registers(func):
+    locations = func.arch.sema.call_arg_locations([func.binary.types.get("long")] * 8)
+    return [reg for (reg, subreg, offset) in locations if reg is not None and offset is None]
+
+
+# Computes the summary of 'func' from its ucode, which has to be built but not transformed yet. Calls to functions that
+# already have a summary in binary.function_summaries use it. Other calls and tail jumps may read any argument register
+# and are assumed to overwrite the argument and return value registers. Returns None if it can't tell how many
+# arguments the function takes (it may pass them on to such a call), and on architectures passing arguments on the
+# stack.
+def compute_function_summary(func):
+    arch = func.arch
+    ufunction = func.ufunction
+    arg_registers = argument_registers(func)
+    if len(arg_registers) == 0: return None
+    retval_register = arch.sema.retval_location(func.binary.types.get("long"))
+    summaries = func.binary.function_summaries
+    bbs = ufunction.bbs
+    if len(bbs) == 0: return None
+
+    def callee_summary(instr):
+        callee = instr.callee()
+        if not isinstance(callee, UCodeConstant): return None
+        return summaries.get(callee.value)
+
+    # Target of a branch leaving the function (a tail jump), or None.
+    def tail_jump_target(instr):
+        if not isinstance(instr, UCodeBranch): return None
+        target = instr.target().value
+        if func.addr <= target < func.addr + func.len: return None
+        return target
+
+    # Calls and tail jumps to functions without a summary, they may read any argument register.
+    def is_unknown_transfer(instr):
+        if isinstance(instr, UCodeCall): return callee_summary(instr) is None
+        target = tail_jump_target(instr)
+        return target is not None and target not in summaries
+
+    def call_reads(instr):
+        s = callee_summary(instr)
+        return arg_registers[:s.arg_count] if s is not None else []
+
+    def tail_jump_reads(instr):
+        target = tail_jump_target(instr)
+        if target is None or target not in summaries: return []
+        return arg_registers[:summaries[target].arg_count]
+
+    def call_writes(instr):
+        s = callee_summary(instr)
+        if s is None: return set(arg_registers) | set([retval_register])
+        return set(s.clobbered_registers) | set([retval_register])
+
+    def native_reads(instr):
+        if isinstance(instr, UCodeCall): return call_reads(instr)
+        return [r.name for r in instr.input_operands() if isinstance(r, UCodeRegister) and r.is_native()] + \
+            tail_jump_reads(instr)
+
+    def native_writes(instr):
+        if isinstance(instr, UCodeCall): return call_writes(instr)
+        if not instr.has_destination: return []
+        d = instr.destination()
+        return [d.name] if isinstance(d, UCodeRegister) and d.is_native() else []
+
+    # Registers written on every path to the start of each block (forward "must" analysis).
+    everything = set(arg_registers) | set([retval_register])
+    for bb in bbs:
+        for instr in bb.instructions:
+            everything.update(native_writes(instr))
+    block_writes = dict([(bb, set().union(*[native_writes(i) for i in bb.instructions])) for bb in bbs])
+    written_out = dict([(bb, set(everything)) for bb in bbs])
+    written_out[bbs[0]] = set(block_writes[bbs[0]])
+    changed = True
+    while changed:
+        changed = False
+        for bb in bbs[1:]:
+            preds = [p for p in bb.preds if p in written_out]
+            written_in = set.intersection(*[written_out[p] for p in preds]) if len(preds) > 0 else set()
+            out = written_in | block_writes[bb]
+            if out != written_out[bb]:
+                written_out[bb] = out
+                changed = True
+
+    # Which instruction last wrote the return value register on some path ("may" analysis). The states are "explicit"
+    # or the address of the callee (None if unknown) when the value comes from a call.
+    retval_out = dict([(bb, set()) for bb in bbs])
+    retval_in = dict([(bb, set()) for bb in bbs])
+    changed = True
+    while changed:
+        changed = False
+        for bb in bbs:
+            states = set().union(*[retval_out[p] for p in bb.preds if p in retval_out]) if bb is not bbs[0] else set()
+            retval_in[bb] = states
+            for instr in bb.instructions:
+                if isinstance(instr, UCodeCall):
+                    callee = instr.callee()
+                    states = set([callee.value if isinstance(callee, UCodeConstant) else None])
+                elif retval_register in native_writes(instr):
+                    states = set(["explicit"])
+            if states != retval_out[bb]:
+                retval_out[bb] = states
+                changed = True
+
+    inputs = set()
+    maybe_inputs = set()
+    returns_value = False
+    has_return = False
+    for bb in bbs:
+        written = set.intersection(*[written_out[p] for p in bb.preds if p in written_out]) \
+            if bb is not bbs[0] and len(bb.preds) > 0 else set()
+        states = retval_in[bb]
+        for instr in bb.instructions:
+            for name in native_reads(instr):
+                if name not in written: inputs.add(name)
+            if is_unknown_transfer(instr):
+                for name in arg_registers:
+                    if name not in written: maybe_inputs.add(name)
+            written.update(native_writes(instr))
+
+            if isinstance(instr, UCodeCall):
+                callee = instr.callee()
+                states = set([callee.value if isinstance(callee, UCodeConstant) else None])
+            elif retval_register in native_writes(instr):
+                states = set(["explicit"])
+
+            if isinstance(instr, UCodeRet):
+                has_return = True
+                for state in states:
+                    if state == "explicit" or state is None or state not in summaries or summaries[state].returns_value:
+                        returns_value = True
+
+    # A function without a return (ends with a tail jump or doesn't return at all) keeps the default prototype.
+    if not has_return: returns_value = True
+
+    arg_count = 0
+    while arg_count < len(arg_registers) and arg_registers[arg_count] in inputs:
+        arg_count += 1
+    # The next argument register may be read by an unknown callee, so there may be more arguments.
+    if arg_count < len(arg_registers) and arg_registers[arg_count] in maybe_inputs: return None
+
+    # Registers the function may overwrite, including what its callees overwrite. Saved and restored registers are not
+    # told apart, so this over-approximates.
+    clobbered = set()
+    for bb in bbs:
+        for instr in bb.instructions:
+            clobbered.update(native_writes(instr))
+    for name in [arch.sema.sp_register(), arch.sema.base_register(), arch.sema.pc_register()]:
+        clobbered.discard(name)
+
+    return FunctionSummary(func.addr, arg_count, returns_value, frozenset(clobbered))
+
+
+# Strongly connected components of the call graph between 'funcs' (from the binary's xref index), in reverse
+# topological order: every component comes after the components it calls into. Members of a component are ordered by
+# address.
+def call_graph_sccs(binary, funcs):
+    index = binary.xrefs.index
+    addrs = set([f.addr for f in funcs])
+    callees = {}
+    for f in funcs:
+        targets = []
+        for (_, target, _) in index.references_from(f.addr, f.addr + f.len, kinds=XrefIndex.CODE_KINDS):
+            if target in addrs and target != f.addr and target not in targets:
+                targets.append(target)
+        callees[f.addr] = targets
+
+    # Iterative Tarjan, it emits the components in reverse topological order.
+    number = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    sccs = []
+    counter = 0
+    for root in sorted(addrs):
+        if root in number: continue
+        work = [(root, iter(callees[root]))]
+        number[root] = lowlink[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack.add(root)
+        while len(work) > 0:
+            (v, it) = work[-1]
+            w = next(it, None)
+            if w is not None:
+                if w not in number:
+                    number[w] = lowlink[w] = counter
+                    counter += 1
+                    stack.append(w)
+                    on_stack.add(w)
+                    work.append((w, iter(callees[w])))
+                elif w in on_stack:
+                    lowlink[v] = min(lowlink[v], number[w])
+                continue
+
+            work.pop()
+            if len(work) > 0:
+                u = work[-1][0]
+                lowlink[u] = min(lowlink[u], lowlink[v])
+            if lowlink[v] == number[v]:
+                scc = []
+                while True:
+                    w = stack.pop()
+                    on_stack.discard(w)
+                    scc.append(w)
+                    if w == v: break
+                sccs.append(sorted(scc))
+
+    return (sccs, callees)
+
+
+# Hands out the call graph's components bottom-up: a component becomes ready once all the components it calls into are
+# done, independent ready components can be processed in parallel.
+class BottomUpSchedule:
+    def __init__(self, sccs, callees):
+        self.sccs = sccs
+        self.scc_of = {}
+        for (i, scc) in enumerate(sccs):
+            for addr in scc: self.scc_of[addr] = i
+
+        self.callers = [set() for _ in sccs]
+        self.pending = [0] * len(sccs)
+        for (i, scc) in enumerate(sccs):
+            deps = set([self.scc_of[t] for addr in scc for t in callees[addr]]) - set([i])
+            self.pending[i] = len(deps)
+            for d in deps: self.callers[d].add(i)
+
+        self.ready = [i for i in range(len(sccs)) if self.pending[i] == 0]
+
+    def take_ready(self):
+        result = [self.sccs[i] for i in self.ready]
+        self.ready = []
+        return result
+
+    def complete(self, scc):
+        i = self.scc_of[scc[0]]
+        for c in sorted(self.callers[i]):
+            self.pending[c] -= 1
+            if self.pending[c] == 0: self.ready.append(c)
@@ -0,0 +1,13 @@
+slot_names_cache = {}
+
+
+# Names of all the slots of a class and its bases, for copying objects that have no __dict__.
+def slot_names(cls):
+    names = slot_names_cache.get(cls)
+    if names is None:
+        names = []
+        for c in reversed(cls.__mro__):
+            for name in c.__dict__.get("__slots__", ()):
+                if name not in names and name not in ["__dict__", "__weakref__"]: names.append(name)
+        slot_names_cache[cls] = names
+    return names
@@ -0,0 +1,60 @@
+from collections.abc import Mapping
+
+
+# Line number -> object map, built from the (line, object) pairs the first time it's actually used.
+class LazyLineMap(Mapping):
+    def __init__(self, entries):
+        self.entries = entries
+        self.map = None
+
+    def materialize(self):
+        if self.map is None:
+            self.map = dict(self.entries)
+        return self.map
+
+    def __getitem__(self, key):
+        return self.materialize()[key]
+
+    def __contains__(self, key):
+        return key in self.materialize()
+
+    def __iter__(self):
+        return iter(self.materialize())
+
+    def __len__(self):
+        return len(self.materialize())
+
+
+# Collects text as a list of chunks which are joined once at the end, so building the text is linear in its size.
+class TextBuilder:
+    def __init__(self):
+        self.chunks = []
+        self.line_number = 0
+        self.line_objects = []
+
+    def line(self, s, o=None):
+        self.chunks.append(s + "\n")
+        if o is not None:
+            self.line_objects.append((self.line_number, o))
+        self.line_number += 1
+
+    # Text that doesn't take part in the line accounting.
+    def write(self, s):
+        self.chunks.append(s)
+
+    # Appends lines rendered earlier by another builder (see lines()).
+    def extend(self, lines, line_objects):
+        for (line, o) in line_objects:
+            self.line_objects.append((self.line_number + line, o))
+        self.chunks.extend(lines)
+        self.line_number += len(lines)
+
+    # The chunks added with line(), one per line.
+    def lines(self):
+        return self.chunks
+
+    def text(self):
+        return "".join(self.chunks)
+
+    def line_map(self):
+        return LazyLineMap(self.line_objects)
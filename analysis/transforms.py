@@ -1,5 +1,6 @@
 from analysis.ucode.ucode_builder import UCodeBuilder
 from analysis.ucode.ucode_cfg import CFGGraph
+from analysis.ucode.ucode_passmanager import UCodePassManager
 from analysis.ucode.ucode_transformsbb import *
 from analysis.ucode.ucode_transformsfunction import *
 from analysis.ucode.ucode_transformsinstruction import *
@@ -21,88 +22,90 @@ def auto_build_ucode(func):
     builder = UCodeBuilder(func)
     builder.build_ucode()
 
+def pass_manager(func):
+    if func.ufunction.pass_manager is None:
+        func.ufunction.pass_manager = UCodePassManager(func.ufunction, func.binary)
+    return func.ufunction.pass_manager
+
 def de_spill(func):
-    UCodeApplyBasicBlockTransformToAll(func.ufunction, UCodeConvertStackVariablesToRegisters).perform()
-    func.ufunction.compute_def_use_chains()
-    t = UCodeApplyInstructionTransformToAll(func.ufunction, UCodeStackArgumentsToRegisters)
-    t.binary = func.binary
-    t.perform()
+    pm = pass_manager(func)
+    changes = pm.run_basic_block_transform(UCodeConvertStackVariablesToRegisters)
+    pm.compute_def_use_chains()
+    changes += pm.run_instruction_transform(UCodeStackArgumentsToRegisters)
+    return changes
 
 def propagate(func):
-    func.ufunction.compute_def_use_chains()
-    UCodeApplyInstructionTransformToAll(func.ufunction, UCodeCopyPropagateInstruction).perform()
+    pm = pass_manager(func)
+    pm.compute_def_use_chains()
+    return pm.run_instruction_transform(UCodeCopyPropagateInstruction)
 
 def simplify(func):
-    UCodeApplyInstructionTransformToAll(func.ufunction, UCodeRemovePCReferences).perform()
-    UCodeApplyInstructionTransformToAll(func.ufunction, UCodeConstantFoldInstruction).perform()
-    UCodeApplyInstructionTransformToAll(func.ufunction, UCodeRemoveUselessMoves).perform()
-    func.ufunction.compute_def_use_chains()
-    UCodeApplyInstructionTransformToAll(func.ufunction, UCodeFoldArithmeticChains).perform()
-    func.ufunction.compute_def_use_chains()
-    UCodeApplyInstructionTransformToAll(func.ufunction, UCodeRemoveUnusedCallResults).perform()
-
-    UCodeApplyInstructionTransformToAll(func.ufunction, UCodeNormalizeArithmetics).perform()
+    pm = pass_manager(func)
+    changes = pm.run_instruction_transform(UCodeRemovePCReferences)
+    changes += pm.run_instruction_transform(UCodeConstantFoldInstruction)
+    changes += pm.run_instruction_transform(UCodeRemoveUselessMoves)
+    pm.compute_def_use_chains()
+    changes += pm.run_instruction_transform(UCodeFoldArithmeticChains)
+    pm.compute_def_use_chains()
+    changes += pm.run_instruction_transform(UCodeRemoveUnusedCallResults)
+
+    changes += pm.run_instruction_transform(UCodeNormalizeArithmetics)
+    return changes
 
 def eliminate_ucode(func):
-    func.ufunction.compute_def_use_chains()
-    UCodeApplyInstructionTransformToAll(func.ufunction, UCodeDeadCodeEliminateInstruction).perform()
+    pm = pass_manager(func)
+    pm.compute_def_use_chains()
+    return pm.run_instruction_transform(UCodeDeadCodeEliminateInstruction)
 
 def ucode_patterns(func):
-    func.ufunction.compute_def_use_chains()
-    UCodeApplyBasicBlockTransformToAll(func.ufunction, UCodeDetectPattern1).perform()
-    func.ufunction.compute_def_use_chains()
-    UCodeApplyBasicBlockTransformToAll(func.ufunction, UCodeDetectPattern2).perform()
-    func.ufunction.compute_def_use_chains()
-    UCodeApplyBasicBlockTransformToAll(func.ufunction, UCodeDetectPattern3).perform()
-    func.ufunction.compute_def_use_chains()
-    UCodeApplyBasicBlockTransformToAll(func.ufunction, UCodeDetectPattern4).perform()
+    pm = pass_manager(func)
+    changes = 0
+    for pattern in [UCodeDetectPattern1, UCodeDetectPattern2, UCodeDetectPattern3, UCodeDetectPattern4]:
+        pm.compute_def_use_chains()
+        changes += pm.run_basic_block_transform(pattern)
+    return changes
 
 def arc(func):
-    UCodeApplyInstructionTransformToAll(func.ufunction, UCodeRemoveRetainRelease).perform()
+    return pass_manager(func).run_instruction_transform(UCodeRemoveRetainRelease)
 
 def resolve(func):
-    t = UCodeApplyInstructionTransformToAll(func.ufunction, UCodeResolveIVars)
-    t.binary = func.binary
-    t.perform()
-
-    func.ufunction.compute_def_use_chains()
-    t = UCodeApplyInstructionTransformToAll(func.ufunction, UCodeResolveCalls)
-    t.binary = func.binary
-    t.perform()
-
-    func.ufunction.compute_def_use_chains()
-    t = UCodeApplyInstructionTransformToAll(func.ufunction, UCodeResolveUnknownCalls)
-    t.binary = func.binary
-    t.perform()
-
-    t = UCodeApplyInstructionTransformToAll(func.ufunction, UCodeResolveSelectors)
-    t.binary = func.binary
-    t.perform()
-    t = UCodeApplyInstructionTransformToAll(func.ufunction, UCodeResolveClassRefs)
-    t.binary = func.binary
-    t.perform()
-    t = UCodeApplyInstructionTransformToAll(func.ufunction, UCodeResolveCFStrings)
-    t.binary = func.binary
-    t.perform()
-
-    t = UCodeApplyInstructionTransformToAll(func.ufunction, UCodeResolveOffsetCalls)
-    t.binary = func.binary
-    t.perform()
-
-    t = UCodeApplyInstructionTransformToAll(func.ufunction, UCodeResolveCCalls)
-    t.binary = func.binary
-    t.perform()
+    pm = pass_manager(func)
+    changes = pm.run_instruction_transform(UCodeResolveIVars)
+
+    pm.compute_def_use_chains()
+    changes += pm.run_instruction_transform(UCodeResolveCalls)
+
+    pm.compute_def_use_chains()
+    changes += pm.run_instruction_transform(UCodeResolveUnknownCalls)
+
+    changes += pm.run_instruction_transform(UCodeResolveSelectors)
+    changes += pm.run_instruction_transform(UCodeResolveClassRefs)
+    changes += pm.run_instruction_transform(UCodeResolveCFStrings)
+
+    changes += pm.run_instruction_transform(UCodeResolveOffsetCalls)
+
+    changes += pm.run_instruction_transform(UCodeResolveCCalls)
+    return changes
 
 
 def strip_nops(func):
-    UCodeApplyBasicBlockTransformToAll(func.ufunction, UCodeRemoveNopsFromBasicBlock).perform()
+    return pass_manager(func).run_basic_block_transform(UCodeRemoveNopsFromBasicBlock)
+
+
+# Reports progress between the rounds of a long step, which lets a cancelled job (the IDE's progress callback raises
+# from progress()) stop in the middle of the step instead of only after it.
+def report_round(func, s):
+    if func.binary is not None and func.binary.load_progress_callback:
+        func.binary.load_progress_callback.progress(s)
 
 
+# Upper bound on the number of rounds, in case two transforms keep undoing each other's changes.
+MAX_UCODE_TRANSFORM_ITERATIONS = 50
+
 def auto_transform_ucode(func, single_step=False):
-    changing = True
-    while changing:
-        changing = False
-        ucode_pre, _ = func.ufunction.print_to_text(False, func)
+    for iteration in range(0, MAX_UCODE_TRANSFORM_ITERATIONS):
+        if iteration > 0: report_round(func, "Optimizing uCode (round %d)..." % (iteration + 1))
+        version = func.ufunction.version
 
         resolve(func)
         simplify(func)
@@ -120,47 +123,16 @@ def auto_transform_ucode(func, single_step=False):
         strip_nops(func)
         arc(func)
 
-        ucode_post, _ = func.ufunction.print_to_text(False, func)
-        if ucode_post != ucode_pre: changing = True
-
-        if single_step and changing: return
+        changing = func.ufunction.version != version
+        if not changing: return
+        if single_step: return
 
 def auto_build_cfg(func):
     func.ufunction.cfg = CFGGraph(func.ufunction)
 
 
 def auto_match_cfg(func, single_step=False):
-    transforms = [
-        func.ufunction.cfg.convert_if,
-        func.ufunction.cfg.convert_if_else,
-        func.ufunction.cfg.convert_sequence,
-        func.ufunction.cfg.convert_while,
-        func.ufunction.cfg.convert_single_bb_while,
-        func.ufunction.cfg.convert_do_while,
-        func.ufunction.cfg.convert_multi_if,
-        func.ufunction.cfg.convert_infinite_loop,
-        func.ufunction.cfg.convert_switch,
-
-        # Damn, we can't find anything simple. Let's be more aggressive.
-        func.ufunction.cfg.convert_early_return,
-        func.ufunction.cfg.convert_duplicate_exit_node,
-    ]
-
-    changing = True
-    while changing:
-        changing = False
-
-        num_root_nodes = len(func.ufunction.cfg.unassigned_bbs_with_cfg_roots)
-        if num_root_nodes == 1: return
-
-        for t in transforms:
-            for cfg_node in func.ufunction.cfg.unassigned_bbs_with_cfg_roots:
-                changing |= t(cfg_node)
-                if single_step and changing: return
-
-            if changing: break
-
-        if single_step and changing: return
+    func.ufunction.cfg.structure(single_step, lambda: report_round(func, "Generating CFG..."))
 
 def auto_build_ast(func):
     func.build_ast()
@@ -1,6 +1,8 @@
 import abc
 
-from analysis.ucode.ucode_printer import UCodePrinter
+from analysis.tools.slots import slot_names
+from analysis.ucode.ucode_defuse import UCodeDefUseAnalysis
+from analysis.ucode.ucode_printer import UCodePrinter, UCodeRenderCache
 
 
 class UCodeFunction:
@@ -18,6 +20,18 @@ class UCodeFunction:
         self.stack_frame_layout = []
         self.pc_register = None
         self.input_parameters = []
+        self.def_use = UCodeDefUseAnalysis(self)
+        ":type: UCodeDefUseAnalysis"
+        # Bumped on every change to the ucode, see mark_changed.
+        self.version = 0
+        self.def_use_version = -1
+        self.pass_manager = None
+        self.instruction_index = None
+        self.instruction_index_version = -1
+        self.render_cache = UCodeRenderCache()
+        # Registers whose address is taken by an UCodeAddressOfLocal, None when it has to be recomputed.
+        self.aliased_registers = None
+        ":type: set[UCodeRegister]"
 
     def get_stack_variable_at_offset(self, base_offset, sp_offset):
         if base_offset is not None:
@@ -76,70 +90,49 @@ class UCodeFunction:
         self.uregisters[name] = UCodeRegister(size, name, UCodeRegister.TYPE_TEMP)
         return self.uregisters[name]
 
-    def compute_def_use_chains_single_bb(self, bb):
-        defs = dict(bb._ins)  # Copy.
-        changed = False
-        for uinstr in bb.instructions:
-            assert isinstance(uinstr, UCodeInstruction)
-
-            # Go through all input operands.
-            for operand in uinstr.input_operands():
-                if operand in list(defs.keys()):
-                    for defining_uinstr in defs[operand]:
-                        if defining_uinstr not in uinstr._definitions:
-                            uinstr._definitions.append(defining_uinstr)
-                            assert uinstr not in defining_uinstr._uses
-                            defining_uinstr._uses.append(uinstr)
-                            changed = True
-
-            if uinstr.has_destination:
-                # We found a new definition.
-                destination = uinstr.destination()
-                defs[destination] = [uinstr]  # Discard previous definitions.
-
-        bb._outs = defs
-        return changed
+    def mark_changed(self):
+        self.version += 1
 
-    def merge_ins(self, result, to_merge_in):
-        changed = False
-        for key in list(to_merge_in.keys()):
-            if key not in list(result.keys()):
-                result[key] = list(to_merge_in[key])
-                changed = True
-            else:
-                defs_for_key = result[key]
-                for val in to_merge_in[key]:
-                    if val not in defs_for_key:
-                        defs_for_key.append(val)
-                        changed = True
-        return changed
+    # All instructions grouped by their exact class, as (ordinal, bb, idx, instr) in program order. The index is rebuilt
+    # lazily after the ucode changed, the positions in it are only hints once a transform starts modifying blocks.
+    def instructions_by_class(self):
+        if self.instruction_index is None or self.instruction_index_version != self.version:
+            index = {}
+            ordinal = 0
+            for bb in self.bbs:
+                for (idx, instr) in enumerate(bb.instructions):
+                    cls = instr.__class__
+                    if cls not in index: index[cls] = []
+                    index[cls].append((ordinal, bb, idx, instr))
+                    ordinal += 1
+            self.instruction_index = index
+            self.instruction_index_version = self.version
+        return self.instruction_index
 
     def compute_def_use_chains(self):
-        for bb in self.bbs:
-            bb._outs = {}
-            bb._ins = {}
-            for instr in bb.instructions:
-                instr._definitions = []
-                instr._uses = []
-
-        changing = True
-        while changing:
-            changing = False
-            for bb in self.bbs:
-                changed = self.compute_def_use_chains_single_bb(bb)
-                if changed: changing = True
-                for succ_bb in bb.succs:
-                    changed = self.merge_ins(succ_bb._ins, bb._outs)
-                    if changed: changing = True
+        self.def_use.compute()
+        self.def_use_version = self.version
+
+    # Forces the next compute_def_use_chains to redo the whole function.
+    def invalidate_def_use_chains(self):
+        self.def_use.invalidate()
 
     def is_aliased(self, register):
-        for bb in self.bbs:
-            for instr in bb.instructions:
-                if isinstance(instr, UCodeAddressOfLocal):
-                    if instr.source() == register:
-                        return True
+        if self.aliased_registers is None:
+            aliased = set()
+            for bb in self.bbs:
+                for instr in bb.instructions:
+                    if isinstance(instr, UCodeAddressOfLocal):
+                        aliased.add(instr.source())
+            self.aliased_registers = aliased
 
-        return False
+        return register in self.aliased_registers
+
+    # Has to be called whenever an UCodeAddressOfLocal is added, removed or changed. The instruction helpers
+    # (replace_with, insert_after, replace_uses_of_register) call it, code editing bb.instructions directly has to
+    # call it itself.
+    def invalidate_aliases(self):
+        self.aliased_registers = None
 
     def print_to_text(self, show_ucode_details=False, main_function=None):
         return UCodePrinter(self).print_to_text(show_ucode_details, main_function)
@@ -181,7 +174,11 @@ class UCodeStackInput(UCodeStackFrameItem):
 
 
 class UCodeBasicBlock:
+    __slots__ = ("function", "addr", "instructions", "succs", "preds", "is_entry", "is_exit", "number", "_ins", "_outs",
+                 "version")
+
     def __init__(self):
+        self.function = None
         self.addr = None
         self.instructions = None
         self.succs = set()
@@ -191,15 +188,30 @@ class UCodeBasicBlock:
         self.number = None
         self._ins = None
         self._outs = None
+        self.version = 0
+
+    # Like UCodeFunction.mark_changed, but also records which block changed.
+    def mark_changed(self):
+        self.version += 1
+        if self.function is not None:
+            self.function.mark_changed()
 
 
 class UCodeValue:
+    __slots__ = ("size",)
+
     def __init__(self, size):
         self.size = size
         pass
 
+    # Structural equality, see UCodeInstruction.same_as.
+    def same_as(self, other):
+        return self is other
+
 
 class UCodeRegister(UCodeValue):
+    __slots__ = ("name", "type")
+
     TYPE_NATIVE = 1
     TYPE_NATIVE_SUBREGISTER = 2
     TYPE_NATIVE_EXTRA = 2
@@ -218,8 +230,14 @@ class UCodeRegister(UCodeValue):
     def is_native(self):
         return self.type == UCodeRegister.TYPE_NATIVE
 
+    def same_as(self, other):
+        return self is other or (self.__class__ is other.__class__ and self.name == other.name and
+                                 self.size == other.size and self.type == other.type)
+
 
 class UCodeBasicBlockAddress(UCodeValue):
+    __slots__ = ("bb",)
+
     def __init__(self, bb):
         UCodeValue.__init__(self, 0)
         self.bb = bb
@@ -227,15 +245,26 @@ class UCodeBasicBlockAddress(UCodeValue):
     def __str__(self):
         return "BB#%d" % self.bb.number
 
+    def same_as(self, other):
+        return self is other or (self.__class__ is other.__class__ and self.bb is other.bb)
+
 
 class UCodeConstant(UCodeValue):
+    __slots__ = ("value", "name")
+
     def __init__(self, size, value):
         UCodeValue.__init__(self, size)
         self.value = value
         self.name = None
 
     def display_as_symbol(self, name):
+        changed = self.name != name
         self.name = name
+        return changed
+
+    def same_as(self, other):
+        return self is other or (self.__class__ is other.__class__ and self.value == other.value and
+                                 self.size == other.size and self.name == other.name)
 
     def __str__(self):
         if self.name is not None:
@@ -243,7 +272,20 @@ class UCodeConstant(UCodeValue):
         return "0x%x" % self.value if self.value >= 0 else "-0x%x" % -self.value
 
 
+# Operands can be None (e.g. the destination of a call without a result).
+def same_value(a, b):
+    if a is None or b is None: return a is b
+    if not isinstance(a, UCodeValue): return a == b
+    return a.same_as(b)
+
+
+# All the IR classes below have __slots__, a function's ucode consists of a large number of these objects. Native
+# registers are interned per function by UCodeFunction, constants are not, because naming one (display_as_symbol)
+# changes it in place.
 class UCodeInstruction(metaclass=abc.ABCMeta):
+    __slots__ = ("addr", "pc_value", "bb", "operands", "size", "has_destination", "has_side_effects", "has_unknown_operands",
+                 "_uses", "_definitions")
+
     def __init__(self):
         self.addr = None
         self.pc_value = None
@@ -256,17 +298,16 @@ class UCodeInstruction(metaclass=abc.ABCMeta):
         self._uses = None
         self._definitions = None
 
+    # The def-use lists are not copied, they are recomputed for the copy.
     def __deepcopy__(self, memo):
         import copy
-        class AnyObject(object):
-            pass
-        result = AnyObject()
-        result.__metaclass__ = self.__metaclass__
-        result.__class__ = self.__class__
+        result = self.__class__.__new__(self.__class__)
         memo[id(self)] = result
-        for key, value in list(vars(self).items()):
-            if key not in ["_uses", "_definitions"]:
-                setattr(result, key, copy.deepcopy(value, memo))
+        for key in slot_names(self.__class__):
+            if key in ["_uses", "_definitions"]:
+                setattr(result, key, None)
+            elif hasattr(self, key):
+                setattr(result, key, copy.deepcopy(getattr(self, key), memo))
         return result
 
     def __str__(self):
@@ -276,6 +317,30 @@ class UCodeInstruction(metaclass=abc.ABCMeta):
     def __repr__(self):
         return str(self)
 
+    def mark_changed(self):
+        if self.bb is not None:
+            self.bb.mark_changed()
+
+    # Slots that same_as doesn't compare with ==, the position of the instruction and its def-use lists don't matter.
+    uncompared_slots = ("addr", "pc_value", "bb", "operands", "_uses", "_definitions")
+
+    # Same kind of instruction with equal operands and attributes, replace_with uses it to tell if a replacement changes
+    # anything.
+    def same_as(self, other):
+        if self.__class__ is not other.__class__: return False
+        if len(self.operands) != len(other.operands): return False
+        for (a, b) in zip(self.operands, other.operands):
+            if not same_value(a, b): return False
+        for key in slot_names(self.__class__):
+            if key in self.uncompared_slots: continue
+            if getattr(self, key, None) != getattr(other, key, None): return False
+        return True
+
+    def invalidate_aliases(self, other=None):
+        if isinstance(self, UCodeAddressOfLocal) or isinstance(other, UCodeAddressOfLocal):
+            if self.bb is not None and self.bb.function is not None:
+                self.bb.function.invalidate_aliases()
+
     def replace_with(self, i2):
         assert self.bb is not None
         idx = self.bb.instructions.index(self)
@@ -283,6 +348,9 @@ class UCodeInstruction(metaclass=abc.ABCMeta):
             i2.addr = self.addr
             i2.bb = self.bb
             self.bb.instructions[idx] = i2
+            self.invalidate_aliases(i2)
+            # Replacing an instruction with an identical one is not a change.
+            if not i2.same_as(self): i2.mark_changed()
             return i2
         assert False
 
@@ -293,14 +361,20 @@ class UCodeInstruction(metaclass=abc.ABCMeta):
             i2.addr = self.addr
             i2.bb = self.bb
             self.bb.instructions.insert(idx + 1, i2)
+            i2.invalidate_aliases()
+            i2.mark_changed()
             return i2
         assert False
 
     def replace_uses_of_register(self, r1, r2):
+        if r1 not in self.input_operands(): return
         if not self.has_destination:
             self.operands = [(r2 if r == r1 else r) for r in self.operands]
         else:
             self.operands = [self.operands[0]] + [(r2 if r == r1 else r) for r in self.operands[1:]]
+        if r1 != r2:
+            self.invalidate_aliases()
+            self.mark_changed()
 
     def uses(self, needs_all_uses=False):
         if needs_all_uses:
@@ -330,6 +404,8 @@ class UCodeInstruction(metaclass=abc.ABCMeta):
 
 
 class UCodeNop(UCodeInstruction):
+    __slots__ = ()
+
     def __init__(self):
         UCodeInstruction.__init__(self)
         self.size = 0
@@ -342,6 +418,8 @@ class UCodeNop(UCodeInstruction):
 
 
 class UCodeAsm(UCodeInstruction):
+    __slots__ = ("asm_instruction",)
+
     def __init__(self, asm_instruction):
         UCodeInstruction.__init__(self)
         self.asm_instruction = asm_instruction
@@ -355,6 +433,8 @@ class UCodeAsm(UCodeInstruction):
 
 
 class UCodeMov(UCodeInstruction):
+    __slots__ = ()
+
     def __init__(self, size, source, destination):
         UCodeInstruction.__init__(self)
         assert isinstance(source, UCodeValue)
@@ -378,6 +458,8 @@ class UCodeMov(UCodeInstruction):
 
 
 class UCodeAddressOfLocal(UCodeInstruction):
+    __slots__ = ()
+
     def __init__(self, size, source, offset, destination):
         UCodeInstruction.__init__(self)
         assert isinstance(source, UCodeRegister)
@@ -406,6 +488,8 @@ class UCodeAddressOfLocal(UCodeInstruction):
 
 
 class UCodeSetMember(UCodeInstruction):
+    __slots__ = ()
+
     def __init__(self, size, var, offset, value):
         UCodeInstruction.__init__(self)
         assert isinstance(var, UCodeRegister)
@@ -432,6 +516,8 @@ class UCodeSetMember(UCodeInstruction):
         return "%s[0x%x] := %s" % (self.destination(), self.offset(), self.value())
 
 class UCodeGetMember(UCodeInstruction):
+    __slots__ = ()
+
     def __init__(self, size, destination, value, offset):
         UCodeInstruction.__init__(self)
         assert isinstance(destination, UCodeRegister)
@@ -459,6 +545,8 @@ class UCodeGetMember(UCodeInstruction):
 
 
 class UCodeTruncate(UCodeInstruction):
+    __slots__ = ()
+
     def __init__(self, size, source, destination):
         super(UCodeTruncate, self).__init__()
         assert isinstance(source, UCodeRegister) or isinstance(source, UCodeConstant)
@@ -483,6 +571,8 @@ class UCodeTruncate(UCodeInstruction):
 
 
 class UCodeExtend(UCodeInstruction):
+    __slots__ = ()
+
     def __init__(self, size, source, destination):
         super(UCodeExtend, self).__init__()
         assert isinstance(source, UCodeRegister) or isinstance(source, UCodeConstant)
@@ -507,6 +597,8 @@ class UCodeExtend(UCodeInstruction):
 
 
 class UCodeSetFlag(UCodeInstruction):
+    __slots__ = ("operation", "type")
+
     OPERATION_NONE = 0
     OPERATION_ADD = 1
     OPERATION_SUB = 2
@@ -572,6 +664,8 @@ class UCodeSetFlag(UCodeInstruction):
 
 
 class UCodeArithmeticOperation(UCodeInstruction):
+    __slots__ = ()
+
     def __init__(self, size, source1, source2, destination):
         UCodeInstruction.__init__(self)
         assert isinstance(source1, UCodeValue)
@@ -605,40 +699,62 @@ class UCodeArithmeticOperation(UCodeInstruction):
 
 
 class UCodeAdd(UCodeArithmeticOperation):
+    __slots__ = ()
+
     def mnem(self): return "uADD"
     def operation_str(self): return "+"
 class UCodeSub(UCodeArithmeticOperation):
+    __slots__ = ()
+
     def mnem(self): return "uSUB"
     def operation_str(self): return "-"
 class UCodeMul(UCodeArithmeticOperation):
+    __slots__ = ()
+
     def mnem(self): return "uMUL"
     def operation_str(self): return "*"
 class UCodeDiv(UCodeArithmeticOperation):
+    __slots__ = ()
+
     def mnem(self): return "uDIV"
     def operation_str(self): return "/"
 class UCodeMod(UCodeArithmeticOperation):
+    __slots__ = ()
+
     def mnem(self): return "uMOD"
     def operation_str(self): return "%"
 
 
 class UCodeAnd(UCodeArithmeticOperation):
+    __slots__ = ()
+
     def mnem(self): return "uAND"
     def operation_str(self): return "&"
 class UCodeOr(UCodeArithmeticOperation):
+    __slots__ = ()
+
     def mnem(self): return "uOR"
     def operation_str(self): return "|"
 class UCodeXor(UCodeArithmeticOperation):
+    __slots__ = ()
+
     def mnem(self): return "uXOR"
     def operation_str(self): return "^"
 class UCodeShiftLeft(UCodeArithmeticOperation):
+    __slots__ = ()
+
     def mnem(self): return "uSHL"
     def operation_str(self): return "<<"
 class UCodeShiftRight(UCodeArithmeticOperation):
+    __slots__ = ()
+
     def mnem(self): return "uSHR"
     def operation_str(self): return ">>"
 
 
 class UCodeNeg(UCodeArithmeticOperation):
+    __slots__ = ()
+
     def mnem(self): return "uNEG"
     def operation_str(self): return "~"
     def operands_str(self):
@@ -646,10 +762,14 @@ class UCodeNeg(UCodeArithmeticOperation):
 
 
 class UCodeEquals(UCodeArithmeticOperation):
+    __slots__ = ()
+
     def mnem(self): return "uEQUALS"
     def operation_str(self): return "=="
 
 class UCodeLoad(UCodeInstruction):
+    __slots__ = ()
+
     def __init__(self, size, pointer, register):
         UCodeInstruction.__init__(self)
         assert isinstance(pointer, UCodeValue)
@@ -676,6 +796,8 @@ class UCodeLoad(UCodeInstruction):
 
 
 class UCodeStore(UCodeInstruction):
+    __slots__ = ()
+
     def __init__(self, size, pointer, source):
         UCodeInstruction.__init__(self)
         assert isinstance(pointer, UCodeValue)
@@ -699,6 +821,8 @@ class UCodeStore(UCodeInstruction):
 
 
 class UCodeCallStackParameter(UCodeValue):
+    __slots__ = ("base_register", "offset")
+
     def __init__(self, size, base_register, offset):
         UCodeValue.__init__(self, size)
         self.base_register = base_register
@@ -707,8 +831,25 @@ class UCodeCallStackParameter(UCodeValue):
     def __str__(self):
         return "[%s+0x%x]" % (self.base_register, self.offset)
 
+    def same_as(self, other):
+        return self is other or (self.__class__ is other.__class__ and self.size == other.size and
+                                 same_value(self.base_register, other.base_register) and self.offset == other.offset)
+
+
+# A call prototype for change tracking, the types compared by kind and name.
+def prototype_key(param_types, return_type):
+    def type_key(t):
+        return None if t is None else (t.__class__, t.name)
+
+    if param_types is None: return (None, type_key(return_type))
+    return (tuple([type_key(t) for t in param_types]), type_key(return_type))
+
 
 class UCodeCall(UCodeInstruction):
+    __slots__ = ("param_types", "return_type")
+
+    uncompared_slots = UCodeInstruction.uncompared_slots + ("param_types", "return_type")
+
     def __init__(self, callee, destination, params, full_operators=False, param_types=None, return_type=None):
         UCodeInstruction.__init__(self)
         self.size = 0
@@ -719,6 +860,10 @@ class UCodeCall(UCodeInstruction):
         self.param_types = param_types
         self.return_type = return_type
 
+    def same_as(self, other):
+        return UCodeInstruction.same_as(self, other) and \
+            prototype_key(self.param_types, self.return_type) == prototype_key(other.param_types, other.return_type)
+
     def all_operands_despilled(self):
         for p in self.params():
             if isinstance(p, UCodeCallStackParameter): return False
@@ -749,6 +894,8 @@ class UCodeCall(UCodeInstruction):
 
 
 class UCodeBranch(UCodeInstruction):
+    __slots__ = ()
+
     def __init__(self, target, condition):
         UCodeInstruction.__init__(self)
         assert isinstance(target, UCodeConstant)
@@ -771,6 +918,8 @@ class UCodeBranch(UCodeInstruction):
 
 
 class UCodeSwitch(UCodeInstruction):
+    __slots__ = ("targets",)
+
     def __init__(self, targets, value):
         UCodeInstruction.__init__(self)
         assert isinstance(targets, list)
@@ -791,6 +940,8 @@ class UCodeSwitch(UCodeInstruction):
 
 
 class UCodeRet(UCodeInstruction):
+    __slots__ = ()
+
     def __init__(self, operands):
         UCodeInstruction.__init__(self)
         self.size = 0
@@ -52,6 +52,7 @@ class UCodeBuilder:
         bb_to_ubb = {}
         for bb in self.function.bbs:
             ucode_bb = UCodeBasicBlock()
+            ucode_bb.function = ufunction
             ucode_bb.number = bb.number
             ucode_bb.addr = bb.addr
             bb_to_ubb[bb] = ucode_bb
@@ -76,3 +77,6 @@ class UCodeBuilder:
                         ucode.append(ucode_instr)
 
             ucode_bb.instructions = ucode
+
+        # The ucode is all the later passes look at, the capstone details aren't needed anymore.
+        self.function.release_capstone_instructions()
@@ -2,14 +2,50 @@ from copy import copy
 from analysis.ucode.ucode import UCodeSwitch
 
 
+# The nodes that are not part of any structured node yet, in insertion order. Behaves like the list it replaces, but
+# removal is O(1).
+class CFGRootList:
+    def __init__(self):
+        self.nodes = {}
+
+    def append(self, node):
+        self.nodes[node] = True
+
+    def remove(self, node):
+        del self.nodes[node]
+
+    def __contains__(self, node):
+        return node in self.nodes
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __iter__(self):
+        return iter(list(self.nodes.keys()))
+
+    def __getitem__(self, idx):
+        if idx == 0: return next(iter(self.nodes))
+        return list(self.nodes.keys())[idx]
+
+
 class CFGGraph:
+    # The full tree walk in sanity_check is quadratic when done after every conversion, only enable it for debugging.
+    check_invariants = False
+
     def __init__(self, function):
         self.function = function
         self.next_number = 0
 
         self.bb_to_node = {}
         # self.unassigned_bbs = []
-        self.unassigned_bbs_with_cfg_roots = []
+        self.unassigned_bbs_with_cfg_roots = CFGRootList()
+        self.entry_node = None
+        self.last_new_node = None
+
+        # Dominator tree, only kept up to date while structure() runs. Nodes collapsed into a structured node are
+        # mapped to it in collapsed_into instead of rewriting the tree.
+        self.idom = None
+        self.collapsed_into = None
 
         for bb in self.function.bbs:
             node = CFGNode(self, self.next_number)
@@ -24,6 +60,8 @@ class CFGGraph:
             for succ_bb in bb.succs: self.bb_to_node[bb].succs.add(self.bb_to_node[succ_bb])
             for pred_bb in bb.preds: self.bb_to_node[bb].preds.add(self.bb_to_node[pred_bb])
 
+        if len(self.function.bbs) > 0: self.entry_node = self.bb_to_node[self.function.bbs[0]]
+
         self.sanity_check()
 
     def n(self):
@@ -56,6 +94,7 @@ class CFGGraph:
             self.sanity_check_no_dups(node.children, found_nodes)
 
     def sanity_check(self):
+        if not self.check_invariants: return
         self.sanity_check_succs_preds()
         self.sanity_check_no_dups(self.unassigned_bbs_with_cfg_roots, set())
 
@@ -84,6 +123,172 @@ class CFGGraph:
 
         self.unassigned_bbs_with_cfg_roots.append(new_node)
 
+        if self.entry_node is entry_node or self.entry_node in nodes: self.entry_node = new_node
+        if self.idom is not None: self.collapse_in_dominator_tree(entry_node, nodes, new_node)
+        self.last_new_node = new_node
+
+    # Structures the whole graph. Regions are reduced innermost first by walking the dominator tree in post-order, at
+    # every node the matchers are retried on the new node until nothing matches anymore, and loop matchers are only
+    # tried on loop headers. Another walk is only needed when a walk made no progress and one of the aggressive
+    # transforms (early return, exit node duplication) had to be applied to unblock the graph.
+    # 'between_rounds' (optional) is called before every round of reductions after the first one.
+    def structure(self, single_step=False, between_rounds=None):
+        changed = False
+        first_round = True
+        while len(self.unassigned_bbs_with_cfg_roots) > 1:
+            if between_rounds is not None and not first_round: between_rounds()
+            first_round = False
+            if self.reduce_regions(single_step):
+                changed = True
+            elif self.reduce_aggressively():
+                changed = True
+            else:
+                break
+            if single_step: break
+
+        self.idom = None
+        self.collapsed_into = None
+        return changed
+
+    def reduce_regions(self, single_step=False):
+        # (matcher, only on loop headers), in order of preference.
+        matchers = [
+            (self.convert_if, False),
+            (self.convert_if_else, False),
+            (self.convert_sequence, False),
+            (self.convert_while, True),
+            (self.convert_single_bb_while, True),
+            (self.convert_do_while, True),
+            (self.convert_multi_if, False),
+            (self.convert_infinite_loop, True),
+            (self.convert_switch, False),
+        ]
+
+        changed = False
+        for node in self.compute_dominators():
+            while node in self.unassigned_bbs_with_cfg_roots:
+                is_loop_header = self.is_loop_header(node)
+                for (matcher, only_on_loop_headers) in matchers:
+                    if only_on_loop_headers and not is_loop_header: continue
+                    if matcher(node): break
+                else:
+                    break
+
+                changed = True
+                if single_step: return True
+                node = self.last_new_node
+
+        return changed
+
+    def reduce_aggressively(self):
+        order = self.compute_dominators()
+        for matcher in [self.convert_early_return, self.convert_duplicate_exit_node]:
+            for node in order:
+                if node not in self.unassigned_bbs_with_cfg_roots: continue
+                if matcher(node): return True
+        return False
+
+    # Computes the immediate dominators of all root nodes (Cooper, Harvey, Kennedy), starting from the entry node.
+    # Nodes unreachable from the entry get their own trees. Returns the nodes in post-order of the dominator tree.
+    def compute_dominators(self):
+        roots = list(self.unassigned_bbs_with_cfg_roots)
+        starts = ([self.entry_node] if self.entry_node in self.unassigned_bbs_with_cfg_roots else []) + \
+                 [n for n in roots if len(n.preds) == 0] + roots
+
+        postorder = []
+        number = {}
+        tree_roots = []
+        for start in starts:
+            if start in number: continue
+            tree_roots.append(start)
+            number[start] = -1
+            stack = [(start, iter(start.succs))]
+            while len(stack) > 0:
+                (node, succs) = stack[-1]
+                for succ_node in succs:
+                    if succ_node not in number:
+                        number[succ_node] = -1
+                        stack.append((succ_node, iter(succ_node.succs)))
+                        break
+                else:
+                    stack.pop()
+                    number[node] = len(postorder)
+                    postorder.append(node)
+
+        top = len(postorder)  # number of the virtual root above all trees
+        idom = dict([(r, None) for r in tree_roots])
+
+        def intersect(a, b):
+            while a is not b:
+                while (number[a] if a is not None else top) < (number[b] if b is not None else top): a = idom[a]
+                while (number[b] if b is not None else top) < (number[a] if a is not None else top): b = idom[b]
+            return a
+
+        changing = True
+        while changing:
+            changing = False
+            for node in reversed(postorder):
+                if node in tree_roots: continue
+                new_idom = None
+                first = True
+                for pred_node in node.preds:
+                    if pred_node not in idom: continue
+                    new_idom = pred_node if first else intersect(pred_node, new_idom)
+                    first = False
+                if first: continue
+                if node not in idom or idom[node] is not new_idom:
+                    idom[node] = new_idom
+                    changing = True
+
+        children = dict([(n, []) for n in postorder])
+        top_level = []
+        for node in reversed(postorder):
+            parent = idom.get(node)
+            if parent is None: top_level.append(node)
+            else: children[parent].append(node)
+
+        order = []
+        for tree_root in top_level:
+            stack = [(tree_root, iter(children[tree_root]))]
+            while len(stack) > 0:
+                (node, it) = stack[-1]
+                child = next(it, None)
+                if child is not None:
+                    stack.append((child, iter(children[child])))
+                else:
+                    stack.pop()
+                    order.append(node)
+
+        self.idom = idom
+        self.collapsed_into = {}
+        return order
+
+    def current_node(self, node):
+        while node in self.collapsed_into:
+            node = self.collapsed_into[node]
+        return node
+
+    def dominates(self, a, b):
+        if self.idom is None: self.compute_dominators()
+        node = b
+        while node is not None:
+            if node is a: return True
+            node = self.current_node(self.idom.get(node))
+        return False
+
+    def is_loop_header(self, node):
+        for pred_node in node.preds:
+            if pred_node is node or self.dominates(node, pred_node): return True
+        return False
+
+    def collapse_in_dominator_tree(self, entry_node, nodes, new_node):
+        collapsed = set(nodes) | set([entry_node])
+        parent = self.current_node(self.idom.get(entry_node))
+        if parent in collapsed: parent = None
+        for n in collapsed:
+            self.collapsed_into[n] = new_node
+        self.idom[new_node] = parent
+
     # (any)* => test_node
     # test_node => detour_node => exit_node
     # test_node => exit_node
@@ -310,13 +515,7 @@ class CFGGraph:
         new_node.bb = None
         new_node.assigned = True
 
-        for node in nodes[1:-1]:
-            node.succs = None
-            node.preds = None
-            # self.unassigned_bbs.remove(node)
-            self.unassigned_bbs_with_cfg_roots.remove(node)
-
-        self.replace_nodes_with_new_node(first_node, set([last_node]), exit_node, new_node)
+        self.replace_nodes_with_new_node(first_node, set(nodes[1:]), exit_node, new_node)
         self.sanity_check()
 
         return True
@@ -445,6 +644,8 @@ class CFGGraph:
             self.unassigned_bbs_with_cfg_roots.append(new_node)
 
         self.unassigned_bbs_with_cfg_roots.remove(exit_node)
+        if self.entry_node is exit_node: self.entry_node = None
+        self.idom = None
         self.sanity_check()
 
         return True
@@ -0,0 +1,181 @@
+import collections
+
+
+# Reaching definitions and def-use chains for a UCodeFunction. The dataflow is solved with a worklist in reverse
+# postorder over per-register sets of definitions. The analysis remembers what each basic block looked like when it was
+# last computed, so a recomputation only redoes the blocks where an instruction was replaced, inserted, removed or had
+# its operands rewritten (and everything reachable from them), the chains everywhere else are kept as they are.
+class UCodeDefUseAnalysis:
+    def __init__(self, function):
+        self.function = function
+        self.cfg_signature = None
+        self.snapshots = {}
+
+    def invalidate(self):
+        self.cfg_signature = None
+        self.snapshots = {}
+
+    def compute(self):
+        bbs = self.function.bbs
+        bb_set = set(bbs)
+
+        signature = [(bb, frozenset(bb.succs)) for bb in bbs]
+        if signature != self.cfg_signature:
+            dirty = bb_set
+        else:
+            dirty = set([bb for bb in bbs if not self.is_unchanged(bb)])
+        if len(dirty) == 0: return
+
+        region = self.reachable_from(dirty, bb_set)
+        self.unlink_region(region)
+
+        position = {}
+        for (bb_idx, bb) in enumerate(bbs):
+            for (idx, instr) in enumerate(bb.instructions):
+                position[instr] = (bb_idx, idx)
+
+        self.solve_reaching_definitions(bbs, region)
+        touched_defs = self.link_region(bbs, region, position)
+        for d in touched_defs:
+            d._uses.sort(key=position.get)
+
+        for bb in region:
+            self.snapshots[bb] = self.snapshot(bb)
+        for bb in list(self.snapshots.keys()):
+            if bb not in bb_set: del self.snapshots[bb]
+        self.cfg_signature = signature
+
+    def snapshot(self, bb):
+        return [(instr, instr.has_destination, tuple(instr.operands)) for instr in bb.instructions]
+
+    def is_unchanged(self, bb):
+        old = self.snapshots.get(bb)
+        if old is None or len(old) != len(bb.instructions): return False
+
+        for (instr, (old_instr, has_destination, operands)) in zip(bb.instructions, old):
+            if instr is not old_instr: return False
+            if instr.has_destination != has_destination: return False
+            # Deep copies (e.g. from the undo stack) don't carry the chains over.
+            if getattr(instr, "_uses", None) is None or getattr(instr, "_definitions", None) is None: return False
+            if len(instr.operands) != len(operands): return False
+            for (op, old_op) in zip(instr.operands, operands):
+                if op is not old_op: return False
+
+        return True
+
+    def reachable_from(self, dirty, bb_set):
+        region = set(dirty)
+        stack = list(dirty)
+        while len(stack) > 0:
+            bb = stack.pop()
+            for succ_bb in bb.succs:
+                if succ_bb in bb_set and succ_bb not in region:
+                    region.add(succ_bb)
+                    stack.append(succ_bb)
+        return region
+
+    def reverse_postorder(self, bbs):
+        bb_set = set(bbs)
+        has_preds = set()
+        for bb in bbs:
+            for succ_bb in bb.succs: has_preds.add(succ_bb)
+        roots = [bb for bb in bbs if bb not in has_preds] + bbs
+
+        visited = set()
+        postorder = []
+        for root in roots:
+            if root in visited: continue
+            visited.add(root)
+            stack = [(root, iter(root.succs))]
+            while len(stack) > 0:
+                (bb, succs) = stack[-1]
+                for succ_bb in succs:
+                    if succ_bb in bb_set and succ_bb not in visited:
+                        visited.add(succ_bb)
+                        stack.append((succ_bb, iter(succ_bb.succs)))
+                        break
+                else:
+                    stack.pop()
+                    postorder.append(bb)
+
+        postorder.reverse()
+        return postorder
+
+    # Drops all chains that start or end in the region. Definitions outside of the region can't reach into it through
+    # anything but their uses, so those are the only links that cross the border.
+    def unlink_region(self, region):
+        region_instrs = set()
+        for bb in region:
+            for (instr, _, _) in self.snapshots.get(bb, []): region_instrs.add(instr)
+            for instr in bb.instructions: region_instrs.add(instr)
+
+        touched_defs = set()
+        for instr in region_instrs:
+            for d in getattr(instr, "_definitions", None) or []:
+                if d not in region_instrs: touched_defs.add(d)
+        for d in touched_defs:
+            d._uses = [u for u in d._uses if u not in region_instrs]
+
+        for bb in region:
+            for instr in bb.instructions:
+                instr._definitions = []
+                instr._uses = []
+            bb._ins = {}
+            bb._outs = {}
+
+    def solve_reaching_definitions(self, bbs, region):
+        preds = dict([(bb, []) for bb in bbs])
+        for bb in bbs:
+            for succ_bb in bb.succs:
+                if succ_bb in preds: preds[succ_bb].append(bb)
+
+        gen = {}
+        for bb in region:
+            last_defs = {}
+            for instr in bb.instructions:
+                if instr.has_destination: last_defs[instr.destination()] = instr
+            gen[bb] = last_defs
+
+        order = [bb for bb in self.reverse_postorder(bbs) if bb in region]
+        worklist = collections.deque(order)
+        queued = set(order)
+        while len(worklist) > 0:
+            bb = worklist.popleft()
+            queued.discard(bb)
+
+            ins = {}
+            for pred_bb in preds[bb]:
+                for (reg, defs) in pred_bb._outs.items():
+                    if reg in ins: ins[reg] |= defs
+                    else: ins[reg] = set(defs)
+            bb._ins = ins
+
+            outs = dict(ins)
+            for (reg, d) in gen[bb].items(): outs[reg] = set([d])
+            if outs != bb._outs:
+                bb._outs = outs
+                for succ_bb in bb.succs:
+                    if succ_bb in region and succ_bb not in queued:
+                        worklist.append(succ_bb)
+                        queued.add(succ_bb)
+
+    def link_region(self, bbs, region, position):
+        touched_defs = set()
+        for bb in bbs:
+            if bb not in region: continue
+
+            defs = dict(bb._ins)
+            for instr in bb.instructions:
+                for operand in instr.input_operands():
+                    reaching = defs.get(operand)
+                    if not reaching: continue
+                    for d in sorted(reaching, key=position.get):
+                        if d in instr._definitions: continue
+                        instr._definitions.append(d)
+                        d._uses.append(instr)
+                        if d.bb not in region: touched_defs.add(d)
+
+                if instr.has_destination:
+                    defs[instr.destination()] = set([instr])
+
+        return touched_defs
@@ -0,0 +1,72 @@
+import time
+
+from analysis.ucode.ucode_transformsfunction import UCodeApplyBasicBlockTransformToAll, UCodeApplyInstructionTransformToAll
+
+
+class UCodePassStatistics:
+    def __init__(self, name):
+        self.name = name
+        self.runs = 0
+        self.skipped = 0
+        self.changes = 0
+        self.seconds = 0.0
+
+
+# Runs ucode transforms over a whole function and keeps track of which of them can possibly do something. Every change
+# to the ucode bumps UCodeFunction.version, so a pass whose last run didn't change anything doesn't need to run again
+# until some other pass has changed the function. Also collects per-pass statistics (runs, skips, changes, time).
+class UCodePassManager:
+    def __init__(self, function, binary):
+        self.function = function
+        ":type: UCodeFunction"
+        self.binary = binary
+        self.statistics = {}
+        self.idle_at = {}  # pass -> state in which its last run found nothing to do
+
+    def state(self):
+        return (self.function.version, self.function.def_use_version)
+
+    def statistics_for(self, name):
+        if name not in self.statistics:
+            self.statistics[name] = UCodePassStatistics(name)
+        return self.statistics[name]
+
+    def run(self, key, name, transform):
+        stats = self.statistics_for(name)
+        if self.idle_at.get(key) == self.state():
+            stats.skipped += 1
+            return 0
+
+        start = time.time()
+        transform.binary = self.binary
+        changes = transform.perform()
+        stats.seconds += time.time() - start
+        stats.runs += 1
+        stats.changes += changes
+
+        if changes == 0:
+            self.idle_at[key] = self.state()
+        elif key in self.idle_at:
+            del self.idle_at[key]
+        return changes
+
+    def run_instruction_transform(self, instruction_transform):
+        t = UCodeApplyInstructionTransformToAll(self.function, instruction_transform)
+        return self.run(instruction_transform, instruction_transform.__name__, t)
+
+    def run_basic_block_transform(self, basic_block_transform):
+        t = UCodeApplyBasicBlockTransformToAll(self.function, basic_block_transform)
+        return self.run(basic_block_transform, basic_block_transform.__name__, t)
+
+    def compute_def_use_chains(self):
+        stats = self.statistics_for("DefUseChains")
+        start = time.time()
+        self.function.compute_def_use_chains()
+        stats.seconds += time.time() - start
+        stats.runs += 1
+
+    def print_statistics(self):
+        lines = ["%-45s %6s %8s %8s %10s" % ("pass", "runs", "skipped", "changes", "ms")]
+        for stats in sorted(self.statistics.values(), key=lambda s: -s.seconds):
+            lines.append("%-45s %6d %8d %8d %10.2f" % (stats.name, stats.runs, stats.skipped, stats.changes, stats.seconds * 1000.0))
+        return "\n".join(lines)
@@ -1,20 +1,28 @@
+from analysis.tools.textbuilder import TextBuilder
+
+
+# The last rendering of every basic block of a function, {bb: (key, lines, line_objects)}. Copies of the function
+# (undo snapshots) start with an empty cache.
+class UCodeRenderCache:
+    def __init__(self):
+        self.blocks = {}
+
+    def __deepcopy__(self, memo):
+        return UCodeRenderCache()
+
+
 class UCodePrinter:
     def __init__(self, function):
         self.function = function
         self.text = ""
-        self.line_number = 0
+        self.builder = None
         self.line_to_object_map = {}
 
     def line(self, s, o=None):
-        self.text += s + "\n"
-        if o is not None:
-            self.line_to_object_map[self.line_number] = o
-        self.line_number += 1
+        self.builder.line(s, o)
 
     def print_to_text(self, show_ucode_details=False, main_function=None):
-        self.text = ""
-        self.line_number = 0
-        self.line_to_object_map = {}
+        self.builder = TextBuilder()
 
         addr_to_asm_instr_map = {}
         if show_ucode_details:
@@ -22,7 +30,7 @@ class UCodePrinter:
                 for instr in bb.instructions:
                     addr_to_asm_instr_map[instr.addr] = instr
 
-        l = self.line
+        l = self.builder.line
 
         l(";")
         l("; uCode for function " + self.function.name)
@@ -42,22 +50,42 @@ class UCodePrinter:
         l("")
         l("")
 
-        if self.function.bbs is None: return (self.text, self.line_to_object_map)
+        if self.function.bbs is not None:
+            # Only the basic blocks that changed since the last time the function was printed are rendered again.
+            cache = self.function.render_cache.blocks
+            new_cache = {}
+            last_addr = -1
+            for bb in self.function.bbs:
+                # Operands are shared between instructions and constants are named in place (display_as_symbol) without
+                # marking every block holding them as changed, so the operand names are part of the key.
+                names = tuple([getattr(op, "name", None) for instr in bb.instructions for op in instr.operands])
+                key = (bb.version, tuple([id(instr) for instr in bb.instructions]), names, str(bb), show_ucode_details, last_addr if show_ucode_details else None)
+                entry = cache.get(bb)
+                if entry is None or entry[0] != key:
+                    block_builder = TextBuilder()
+                    self.print_basic_block(block_builder, bb, show_ucode_details, addr_to_asm_instr_map, last_addr)
+                    entry = (key, block_builder.lines(), block_builder.line_objects)
+                new_cache[bb] = entry
+                self.builder.extend(entry[1], entry[2])
+                if len(bb.instructions) > 0: last_addr = bb.instructions[-1].addr
+            self.function.render_cache.blocks = new_cache
 
-        last_addr = -1
-        for bb in self.function.bbs:
-            l("")
-            l("0x%x:        ; %s" % (bb.addr, str(bb)))
+        self.text = self.builder.text()
+        self.line_to_object_map = self.builder.line_map()
+        return (self.text, self.line_to_object_map)
 
-            if len(bb.instructions) == 0:
-                l("        ; empty basic block")
-                continue
+    def print_basic_block(self, builder, bb, show_ucode_details, addr_to_asm_instr_map, last_addr):
+        l = builder.line
+        l("")
+        l("0x%x:        ; %s" % (bb.addr, str(bb)))
 
-            for instr in bb.instructions:
-                if show_ucode_details and instr.addr != last_addr:
-                    l("")
-                    l("    ; uCode for instruction: %s" % addr_to_asm_instr_map[instr.addr])
-                l("        " + str(instr), instr)
-                last_addr = instr.addr
+        if len(bb.instructions) == 0:
+            l("        ; empty basic block")
+            return
 
-        return (self.text, self.line_to_object_map)
+        for instr in bb.instructions:
+            if show_ucode_details and instr.addr != last_addr:
+                l("")
+                l("    ; uCode for instruction: %s" % addr_to_asm_instr_map[instr.addr])
+            l("        " + str(instr), instr)
+            last_addr = instr.addr
@@ -12,8 +12,12 @@ class UCodeBasicBlockTransform:
     def can_be_performed(self):
         return self.can_be_performed_on_bb(self.bb, self.function, self.idx)
 
+    # Returns whether the transform changed anything, see UCodeInstructionTransform.perform.
     def perform(self):
-        self.perform_on_bb(self.bb, self.function, self.idx)
+        version = self.function.version
+        changed = self.perform_on_bb(self.bb, self.function, self.idx)
+        if changed is True and self.function.version == version: self.bb.mark_changed()
+        return self.function.version != version
 
     @abc.abstractmethod
     def can_be_performed_on_bb(self, bb, function, idx):
@@ -43,7 +47,10 @@ class UCodeRemoveNopsFromBasicBlock(UCodeBasicBlockTransform):
         return True
 
     def perform_on_bb(self, bb, function, idx):
-        bb.instructions = [instr for instr in bb.instructions if not isinstance(instr, UCodeNop)]
+        instructions = [instr for instr in bb.instructions if not isinstance(instr, UCodeNop)]
+        changed = len(instructions) != len(bb.instructions)
+        bb.instructions = instructions
+        return changed
 
 
 """
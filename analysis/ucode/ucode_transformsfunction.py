@@ -1,4 +1,5 @@
 import abc
+import heapq
 
 
 class UCodeFunctionTransform:
@@ -10,7 +11,7 @@ class UCodeFunctionTransform:
         return self.can_be_performed_on_function(self.function)
 
     def perform(self):
-        self.perform_on_function(self.function)
+        return self.perform_on_function(self.function)
 
     @abc.abstractmethod
     def can_be_performed_on_function(self, function):
@@ -29,11 +30,14 @@ class UCodeApplyBasicBlockTransformToAll(UCodeFunctionTransform):
     def can_be_performed_on_function(self, function):
         return True  # TODO
 
+    # Returns the number of basic blocks that were changed.
     def perform_on_function(self, function):
+        changes = 0
         for bb in function.bbs:
             transform = self.basic_block_transform(self.function, bb)
             transform.binary = self.binary
-            transform.perform()
+            if transform.perform(): changes += 1
+        return changes
 
 
 class UCodeApplyInstructionTransformToAll(UCodeFunctionTransform):
@@ -44,9 +48,27 @@ class UCodeApplyInstructionTransformToAll(UCodeFunctionTransform):
     def can_be_performed_on_function(self, function):
         return True  # TODO
 
+    def candidates(self, function):
+        index = function.instructions_by_class()
+        classes = self.instruction_transform.instruction_classes
+        if classes is None:
+            lists = list(index.values())
+        else:
+            lists = [entries for (cls, entries) in index.items() if issubclass(cls, classes)]
+        if len(lists) == 1: return lists[0]
+        return heapq.merge(*lists, key=lambda entry: entry[0])
+
+    # Returns the number of instructions that were changed. Only instructions of the classes the transform declares are
+    # visited, and a single transform object is used for all of them. Instructions replaced or removed by an earlier
+    # step of the same pass are skipped.
     def perform_on_function(self, function):
-        for bb in function.bbs:
-            for instr in bb.instructions:
-                transform = self.instruction_transform(self.function, instr)
-                transform.binary = self.binary
-                transform.perform()
+        changes = 0
+        transform = self.instruction_transform(self.function, None)
+        transform.binary = self.binary
+        for (_, bb, idx, instr) in list(self.candidates(function)):
+            instructions = bb.instructions
+            if idx >= len(instructions) or instructions[idx] is not instr:
+                idx = next((i for (i, other) in enumerate(instructions) if other is instr), -1)
+                if idx < 0: continue
+            if transform.perform_at(instr, bb, idx): changes += 1
+        return changes
@@ -6,6 +6,10 @@ FAKE_FUNCTION_ADDR = 0xdeadbabe
 
 
 class UCodeInstructionTransform:
+    # UCode instruction classes (and their subclasses) the transform can apply to, None means any instruction.
+    # UCodeApplyInstructionTransformToAll only visits instructions of these classes.
+    instruction_classes = None
+
     def __init__(self, function, instruction, binary=None):
         self.function = function
         self.instruction = instruction
@@ -16,10 +20,19 @@ class UCodeInstructionTransform:
         return self.can_be_performed_on_instruction(self.instruction, self.instruction.bb, idx)
 
     def perform(self):
-        if not self.can_be_performed(): return
-
         idx = self.instruction.bb.instructions.index(self.instruction)
-        self.perform_on_instruction(self.instruction, self.instruction.bb, idx)
+        return self.perform_at(self.instruction, self.instruction.bb, idx)
+
+    # Returns whether the transform changed anything. Changes done through the UCodeInstruction methods are tracked by
+    # the function, perform_on_instruction only needs to return True for changes made in place (e.g. symbol names).
+    def perform_at(self, instruction, bb, idx):
+        self.instruction = instruction
+        if not self.can_be_performed_on_instruction(instruction, bb, idx): return False
+
+        version = self.function.version
+        changed = self.perform_on_instruction(instruction, bb, idx)
+        if changed is True and self.function.version == version: bb.mark_changed()
+        return self.function.version != version
 
     @abc.abstractmethod
     def can_be_performed_on_instruction(self, instruction, bb, idx):
@@ -32,6 +45,7 @@ class UCodeInstructionTransform:
 
 class UCodeCopyPropagateInstruction(UCodeInstructionTransform):
     name = "Copy Propagate Instruction"
+    instruction_classes = (UCodeMov,)
 
     def can_be_performed_on_instruction(self, instruction, bb, idx):
         if not isinstance(instruction, UCodeMov): return False
@@ -87,6 +101,7 @@ class UCodeCopyPropagateInstruction(UCodeInstructionTransform):
 
 class UCodeConstantFoldInstruction(UCodeInstructionTransform):
     name = "Fold Constants on Instruction"
+    instruction_classes = (UCodeAdd, UCodeMul, UCodeOr, UCodeAnd, UCodeXor, UCodeExtend, UCodeTruncate)
 
     def try_fold(self, instruction, for_real=False):
         replacer = instruction.replace_with if for_real else lambda x: None
@@ -205,6 +220,7 @@ class UCodeRemovePCReferences(UCodeInstructionTransform):
 
 class UCodeResolveIVars(UCodeInstructionTransform):
     name = "Resolve ivars"
+    instruction_classes = (UCodeLoad,)
 
     def can_be_performed_on_instruction(self, instruction, bb, idx):
         if not isinstance(instruction, UCodeLoad): return False
@@ -225,6 +241,7 @@ class UCodeResolveIVars(UCodeInstructionTransform):
 
 class UCodeResolveOffsetCalls(UCodeInstructionTransform):
     name = "Resolve Offset Calls"
+    instruction_classes = (UCodeLoad,)
 
     def can_be_performed_on_instruction(self, instruction, bb, idx):
         if not isinstance(instruction, UCodeLoad): return False
@@ -245,6 +262,7 @@ class UCodeResolveOffsetCalls(UCodeInstructionTransform):
 
 class UCodeResolveCCalls(UCodeInstructionTransform):
     name = "Resolve C Calls"
+    instruction_classes = (UCodeCall,)
 
     def can_be_performed_on_instruction(self, instruction, bb, idx):
         if not isinstance(instruction, UCodeCall): return False
@@ -255,13 +273,13 @@ class UCodeResolveCCalls(UCodeInstructionTransform):
     def perform_on_instruction(self, instruction, bb, idx):
         value = instruction.callee().value
         binary = self.binary
-        mymap = dict([(f.addr, f.name) for f in self.binary.functions])
-        if value in list(mymap.keys()):
-            func_name = mymap[value]
-            instruction.callee().display_as_symbol(func_name)
+        if value in binary.addr_to_func_map:
+            func_name = binary.addr_to_func_map[value].name
+            return instruction.callee().display_as_symbol(func_name)
 
 class UCodeResolveCalls(UCodeInstructionTransform):
     name = "Resolve Calls"
+    instruction_classes = (UCodeCall,)
 
     def can_be_performed_on_instruction(self, instruction, bb, idx):
         if not isinstance(instruction, UCodeCall): return False
@@ -275,15 +293,17 @@ class UCodeResolveCalls(UCodeInstructionTransform):
         binary = self.binary
         if value in list(binary.stubs.keys()):
             func_name = binary.stubs[value]
-            instruction.callee().display_as_symbol(func_name)
+            changed = instruction.callee().display_as_symbol(func_name)
             binary.call_resolver.resolve_call(self.function, instruction)
+            return changed
         else:
-            if instruction.callee().name is not None:
+            if instruction.callee().name is not None or value in binary.function_summaries:
                 binary.call_resolver.resolve_call(self.function, instruction)
 
 
 class UCodeResolveUnknownCalls(UCodeInstructionTransform):
     name = "Heuristically Resolve Unknown Calls"
+    instruction_classes = (UCodeCall,)
 
     def can_be_performed_on_instruction(self, instruction, bb, idx):
         if not isinstance(instruction, UCodeCall): return False
@@ -305,6 +325,7 @@ class UCodeResolveUnknownCalls(UCodeInstructionTransform):
 
 class UCodeResolveSelectors(UCodeInstructionTransform):
     name = "Resolve Selectors"
+    instruction_classes = (UCodeLoad,)
 
     def can_be_performed_on_instruction(self, instruction, bb, idx):
         if not isinstance(instruction, UCodeLoad): return False
@@ -325,6 +346,7 @@ class UCodeResolveSelectors(UCodeInstructionTransform):
 
 class UCodeResolveClassRefs(UCodeInstructionTransform):
     name = "Resolve Class References"
+    instruction_classes = (UCodeLoad,)
 
     def can_be_performed_on_instruction(self, instruction, bb, idx):
         if not isinstance(instruction, UCodeLoad): return False
@@ -345,26 +367,30 @@ class UCodeResolveClassRefs(UCodeInstructionTransform):
 
 class UCodeResolveCFStrings(UCodeInstructionTransform):
     name = "Resolve CFString References"
+    instruction_classes = (UCodeMov, UCodeCall)
 
     def can_be_performed_on_instruction(self, instruction, bb, idx):
         return True
 
     def perform_on_instruction(self, instruction, bb, idx):
+        changed = False
         if isinstance(instruction, UCodeMov):
             if isinstance(instruction.source(), UCodeConstant):
                 value = instruction.source().value
                 if value in list(self.binary.cfstrings.keys()):
-                    instruction.source().display_as_symbol(self.binary.cfstrings[value].name)
+                    changed |= instruction.source().display_as_symbol(self.binary.cfstrings[value].name)
         elif isinstance(instruction, UCodeCall):
             for p in instruction.params():
                 if isinstance(p, UCodeConstant):
                     value = p.value
                     if value in list(self.binary.cfstrings.keys()):
-                        p.display_as_symbol(self.binary.cfstrings[value].name)
+                        changed |= p.display_as_symbol(self.binary.cfstrings[value].name)
+        return changed
 
 
 class UCodeRemoveUselessMoves(UCodeInstructionTransform):
     name = "Remove Useless Moves"
+    instruction_classes = (UCodeMov,)
 
     def can_be_performed_on_instruction(self, instruction, bb, idx):
         if not isinstance(instruction, UCodeMov): return False
@@ -377,6 +403,7 @@ class UCodeRemoveUselessMoves(UCodeInstructionTransform):
 
 class UCodeFoldArithmeticChains(UCodeInstructionTransform):
     name = "Fold Arithmetic Chains"
+    instruction_classes = (UCodeAdd,)
 
     def can_be_performed_on_instruction(self, instruction, bb, idx):
         if not isinstance(instruction, UCodeAdd): return False
@@ -397,6 +424,7 @@ class UCodeFoldArithmeticChains(UCodeInstructionTransform):
 
 class UCodeNormalizeArithmetics(UCodeInstructionTransform):
     name = "Normalize Arithmetic Operations"
+    instruction_classes = (UCodeAdd, UCodeMul)
 
     def can_be_performed_on_instruction(self, instruction, bb, idx):
         if not isinstance(instruction, UCodeAdd) and not isinstance(instruction, UCodeMul): return False
@@ -417,6 +445,7 @@ class UCodeNormalizeArithmetics(UCodeInstructionTransform):
 
 class UCodeRemoveUnusedCallResults(UCodeInstructionTransform):
     name = "Remove Unused Call Results"
+    instruction_classes = (UCodeCall,)
 
     def can_be_performed_on_instruction(self, instruction, bb, idx):
         if not isinstance(instruction, UCodeCall): return False
@@ -435,6 +464,7 @@ class UCodeRemoveUnusedCallResults(UCodeInstructionTransform):
 
 class UCodeStackArgumentsToRegisters(UCodeInstructionTransform):
     name = "Convert Stack Arguments to Registers"
+    instruction_classes = (UCodeCall,)
 
     def can_be_performed_on_instruction(self, instruction, bb, idx):
         if not isinstance(instruction, UCodeCall): return False
@@ -496,6 +526,7 @@ class UCodeStackArgumentsToRegisters(UCodeInstructionTransform):
 
 class UCodeRemoveRetainRelease(UCodeInstructionTransform):
     name = "Remove ARC Retain-Release"
+    instruction_classes = (UCodeCall,)
 
     def can_be_performed_on_instruction(self, instruction, bb, idx):
         if not isinstance(instruction, UCodeCall): return False
@@ -534,4 +565,6 @@ class UCodeRemoveInstruction(UCodeInstructionTransform):
         return True
 
     def perform_on_instruction(self, instruction, bb, idx):
+        instruction.invalidate_aliases()
         del bb.instructions[idx]
+        return True
@@ -0,0 +1,62 @@
+import bisect
+import struct
+
+
+# Read-only view of a Mach-O file's memory image addressed by VM addresses. Reads go straight to the mmap of the file
+# (no seek/read, no intermediate copies) and VM addresses are resolved to file offsets with a binary search over the
+# sorted segment mappings.
+class VMReader:
+    def __init__(self, macho, arch):
+        self.macho = macho
+        self.arch = arch
+        ":type: Architecture"
+        self.data = macho.file
+        ":type: mmap"
+        self.view = memoryview(macho.file)
+        self.origin = macho.origin
+
+        self.mapping_starts = []
+        self.mappings = []
+        for m in sorted(macho.mappings, key=lambda m: m.address):
+            if m.offset < 0: continue  # zero fill
+            self.mapping_starts.append(m.address)
+            self.mappings.append((m.address, m.address + m.size, m.offset + self.origin))
+
+        self.pointer_struct = struct.Struct("<L" if arch.bytes() == 4 else "<Q")
+        self.uint64_struct = struct.Struct("<Q")
+
+    def file_offset(self, vm_addr):
+        idx = bisect.bisect_right(self.mapping_starts, vm_addr) - 1
+        if idx < 0: return -1
+        (start, end, offset) = self.mappings[idx]
+        if vm_addr >= end: return -1
+        return vm_addr - start + offset
+
+    def is_mapped(self, vm_addr):
+        return self.file_offset(vm_addr) >= 0
+
+    def read_pointer(self, vm_addr):
+        offset = self.file_offset(vm_addr)
+        if offset < 0: return 0
+        return self.pointer_struct.unpack_from(self.data, offset)[0]
+
+    def read_uint64_at_file_addr(self, file_addr):
+        return self.uint64_struct.unpack_from(self.data, self.origin + file_addr)[0]
+
+    # Zero-copy access to the file contents, the returned memoryview must not outlive the binary.
+    def view_at_vm(self, vm_addr, num_bytes):
+        offset = self.file_offset(vm_addr)
+        if offset < 0: return memoryview(bytes(num_bytes))
+        return self.view[offset:offset + num_bytes]
+
+    def read_bytes(self, vm_addr, num_bytes):
+        offset = self.file_offset(vm_addr)
+        if offset < 0: return bytes(num_bytes)
+        return self.data[offset:offset + num_bytes]
+
+    def read_c_string(self, vm_addr):
+        offset = self.file_offset(vm_addr)
+        if offset < 0: return ""
+        end = self.data.find(b'\0', offset)
+        if end < 0: end = len(self.data)
+        return str(self.data[offset:end], 'utf-8')
@@ -0,0 +1,137 @@
+import bisect
+from array import array
+
+
+# Whole-binary cross-reference index. Every reference is a (source, target, kind) triple, where the source is an
+# instruction address (or the address of a pointer in a data section) and the target is the referenced address. The
+# triples are kept in three parallel arrays sorted by source, plus a permutation of the indexes sorted by target, so
+# both directions are answered by bisection without any per-reference objects.
+class XrefIndex:
+    KIND_CALL = 0
+    KIND_TAIL_JUMP = 1
+    KIND_SELECTOR = 2
+    KIND_CLASS_REF = 3
+    KIND_CFSTRING = 4
+    KIND_IVAR = 5
+    KIND_BLOCK_DESCRIPTOR = 6
+    KIND_GLOBAL_BLOCK_LITERAL = 7
+    KIND_FUNCTION_POINTER = 8
+    KIND_DATA_POINTER = 9
+    KIND_NAMES = ["call", "tail jump", "selector", "class ref", "cfstring", "ivar", "block descriptor",
+                  "global block literal", "function pointer", "data pointer"]
+
+    CODE_KINDS = (KIND_CALL, KIND_TAIL_JUMP)
+
+    def __init__(self):
+        self.sources = array('Q')
+        self.targets = array('Q')
+        self.kinds = array('B')
+        self.target_order = array('L')
+        ":type: array"
+        self.sorted_targets = array('Q')
+
+    # 'refs' is any iterable of (source, target, kind) triples, duplicates are dropped.
+    @staticmethod
+    def from_references(refs):
+        index = XrefIndex()
+        for (source, target, kind) in sorted(set(refs)):
+            index.sources.append(source)
+            index.targets.append(target)
+            index.kinds.append(kind)
+        index.build_target_order()
+        return index
+
+    def build_target_order(self):
+        targets = self.targets
+        self.target_order = array('L', sorted(range(len(targets)), key=lambda i: targets[i]))
+        self.sorted_targets = array('Q', [targets[i] for i in self.target_order])
+
+    def __len__(self):
+        return len(self.sources)
+
+    def reference(self, i):
+        return (self.sources[i], self.targets[i], self.kinds[i])
+
+    # References made by the instructions (or pointers) in [start, end).
+    def references_from(self, start, end=None, kinds=None):
+        if end is None: end = start + 1
+        lo = bisect.bisect_left(self.sources, start)
+        hi = bisect.bisect_left(self.sources, end)
+        return [self.reference(i) for i in range(lo, hi) if kinds is None or self.kinds[i] in kinds]
+
+    # References to the addresses in [start, end).
+    def references_to(self, start, end=None, kinds=None):
+        if end is None: end = start + 1
+        lo = bisect.bisect_left(self.sorted_targets, start)
+        hi = bisect.bisect_left(self.sorted_targets, end)
+        result = [self.reference(i) for i in self.target_order[lo:hi]]
+        return [r for r in result if kinds is None or r[2] in kinds]
+
+    # Serialized form for the analysis cache.
+    def to_bytes(self):
+        return (self.sources.tobytes(), self.targets.tobytes(), self.kinds.tobytes())
+
+    @staticmethod
+    def from_bytes(data):
+        index = XrefIndex()
+        index.sources.frombytes(data[0])
+        index.targets.frombytes(data[1])
+        index.kinds.frombytes(data[2])
+        index.build_target_order()
+        return index
+
+
+# Function level queries over the Binary's XrefIndex.
+class BinaryXrefs:
+    def __init__(self, binary, index):
+        self.binary = binary
+        ":type: Binary"
+        self.index = index
+        ":type: XrefIndex"
+
+    def functions_containing(self, refs):
+        result = []
+        seen = set()
+        for (source, _, _) in refs:
+            f = self.binary.addr_to_function(source)
+            if f is not None and f.addr not in seen:
+                seen.add(f.addr)
+                result.append(f)
+        return result
+
+    # Functions that call (or tail jump to) 'func'.
+    def callers(self, func):
+        return self.functions_containing(self.index.references_to(func.addr, kinds=XrefIndex.CODE_KINDS))
+
+    # Call and tail jump targets of 'func', as addresses (targets outside the code section are stubs).
+    def callees(self, func):
+        refs = self.index.references_from(func.addr, func.addr + func.len, kinds=XrefIndex.CODE_KINDS)
+        result = []
+        for (_, target, _) in refs:
+            if target not in result:
+                result.append(target)
+        return result
+
+    # Functions referencing the given address, e.g. the selector reference of a selector or the offset of an ivar.
+    def functions_referencing(self, addr, kinds=None):
+        return self.functions_containing(self.index.references_to(addr, kinds=kinds))
+
+    def selector_users(self, selector):
+        return self.functions_referencing(selector.addr, (XrefIndex.KIND_SELECTOR,))
+
+    def class_ref_users(self, class_ref):
+        return self.functions_referencing(class_ref.addr, (XrefIndex.KIND_CLASS_REF,))
+
+    def ivar_users(self, ivar):
+        return self.functions_referencing(ivar.addr, (XrefIndex.KIND_IVAR,))
+
+    def cfstring_users(self, cfstring):
+        return self.functions_referencing(cfstring.addr, (XrefIndex.KIND_CFSTRING,))
+
+    # Functions taking the address of 'func' (block invoke functions, callbacks...).
+    def function_pointer_users(self, func):
+        return self.functions_referencing(func.addr, (XrefIndex.KIND_FUNCTION_POINTER,))
+
+    # Addresses of data pointing at the function (method lists, vtables, block literals...).
+    def data_pointers_to(self, func):
+        return [source for (source, _, _) in self.index.references_to(func.addr, kinds=(XrefIndex.KIND_DATA_POINTER,))]
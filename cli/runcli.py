@@ -1,10 +1,249 @@
+import os
 import re
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 
 from analysis.arch.architecture import Architecture
 from analysis.binary import Binary
+from analysis.sharedcache import get_shared_cache
+from analysis.summaries import BottomUpSchedule, FunctionSummary, call_graph_sccs, compute_function_summary
 from analysis.transforms import *
 
 
+def decompile_function(func, verbose=False):
+    def step(s):
+        if verbose: print(s)
+
+    func.load()
+    step("Loaded func")
+    auto_build_bbs(func)
+    step("built bbs")
+    auto_transform_bbs(func)
+    step("transformed bbs")
+    builder = UCodeBuilder(func)
+    step("instantiated ucodebuilder")
+    builder.build_ucode()
+    step("built ucode")
+    summary = compute_function_summary(func)
+    if summary is not None: func.binary.function_summaries[func.addr] = summary
+    step("computed summary")
+    auto_transform_ucode(func, single_step=False)
+    step("transformed ucode")
+    func.ufunction.cfg = CFGGraph(func.ufunction)
+    step("created cfg")
+    auto_match_cfg(func, single_step=False)
+    step("matched cfg")
+    func.build_ast()
+    step("built ast")
+    auto_optimize_ast(func)
+    step("optimized ast")
+
+    ast_string, _ = func.print_ast()
+    return ast_string
+
+
+# Binary shared by the batch workers. With the "fork" start method the workers inherit the parent's already loaded
+# binary, otherwise each worker loads it once in batch_worker_init.
+batch_binary = None
+
+
+def batch_worker_init(path, archvalue, image_name, use_function_starts, supplement_function_starts):
+    global batch_binary
+    if batch_binary is None:
+        batch_binary = Binary(path, Architecture.get_arch_from_archvalue(archvalue), image_name)
+        batch_binary.use_function_starts = use_function_starts
+        batch_binary.supplement_function_starts = supplement_function_starts
+        batch_binary.load()
+
+
+# Decompiles one component of the call graph. 'summaries' are the summaries of the functions it calls, as tuples.
+# Returns (addr, ok, text, summary tuple or None) for every function in the component.
+def batch_decompile_component(addrs, summaries):
+    for t in summaries:
+        batch_binary.function_summaries[t[0]] = FunctionSummary.from_tuple(t)
+
+    results = []
+    for addr in addrs:
+        func = batch_binary.addr_to_func_map[addr]
+        try:
+            ok, text = True, decompile_function(func)
+        except:
+            ok, text = False, traceback.format_exc()
+        summary = batch_binary.function_summaries.get(addr)
+        results.append((addr, ok, text, summary.to_tuple() if summary is not None else None))
+        # Workers decompile many functions, don't keep the finished ones around.
+        func.unload()
+    return results
+
+
+def batch_output_filename(func):
+    name = re.sub(r'[^A-Za-z0-9_.+-]', '_', func.name)
+    return "%x_%s" % (func.addr, name[:128])
+
+
+def batch_select_functions(binary, args):
+    if args.all:
+        return list(binary.functions)
+
+    funcs = []
+    seen = set()
+    if args.classes is not None:
+        regexp = re.compile(args.classes)
+        for c in binary.classes:
+            if not regexp.match(c.name): continue
+            for m in c.methods:
+                if m.function is not None and m.function not in seen:
+                    seen.add(m.function)
+                    funcs.append(m.function)
+    if args.functions is not None:
+        regexp = re.compile(args.functions)
+        for f in binary.functions:
+            if regexp.match(f.name) and f not in seen:
+                seen.add(f)
+                funcs.append(f)
+    return funcs
+
+
+# Functions are decompiled bottom-up along the call graph, so that calls to already decompiled functions use their
+# summaries instead of guessed prototypes. Independent components of the call graph run in parallel.
+def batch_main(binary, args):
+    global batch_binary
+    batch_binary = binary
+
+    funcs = batch_select_functions(binary, args)
+    output_dir = args.output_dir
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    (sccs, callees) = call_graph_sccs(binary, funcs)
+    schedule = BottomUpSchedule(sccs, callees)
+    print(("Decompiling %d functions (%d call graph components) into %s..." % (len(funcs), len(sccs), output_dir)))
+
+    filenames = {}
+    for f in funcs:
+        filenames[f.addr] = batch_output_filename(f)
+
+    succeeded = 0
+    failed = 0
+    index = open(os.path.join(output_dir, "index.txt"), "w")
+
+    def make_pool():
+        return ProcessPoolExecutor(max_workers=args.jobs, initializer=batch_worker_init,
+                                   initargs=(binary.path, binary.arch.archvalue, binary.image_name,
+                                             binary.use_function_starts, binary.supplement_function_starts))
+
+    pool = make_pool()
+    futures = {}
+    # Components that were running when a worker died. A dead worker breaks the whole pool, so it's recreated and these
+    # are retried one at a time: a component that kills its worker while running alone is reported as failed.
+    suspects = []
+
+    def submit(scc):
+        needed = set([t for addr in scc for t in callees[addr]])
+        summaries = [binary.function_summaries[a].to_tuple() for a in needed if a in binary.function_summaries]
+        futures[pool.submit(batch_decompile_component, scc, summaries)] = scc
+
+    def submit_ready():
+        if len(suspects) > 0:
+            if len(futures) == 0: submit(suspects.pop(0))
+            return
+        for scc in schedule.take_ready():
+            submit(scc)
+
+    def record(scc, results):
+        nonlocal succeeded, failed
+        for (addr, ok, text, summary) in results:
+            if summary is not None: binary.function_summaries[addr] = FunctionSummary.from_tuple(summary)
+            f = binary.addr_to_func_map[addr]
+
+            filename = filenames[f.addr] + (".c" if ok else ".error")
+            with open(os.path.join(output_dir, filename), "w") as out:
+                out.write(text)
+            index.write("%s 0x%x %s %s\n" % ("ok" if ok else "FAILED", f.addr, filename, f.name))
+            index.flush()
+
+            if ok: succeeded += 1
+            else: failed += 1
+            if not args.quiet:
+                print(("[%d/%d] %s %s" % (succeeded + failed, len(funcs), "ok" if ok else "FAILED", f.name)))
+
+        schedule.complete(scc)
+
+    # Records the component of a finished future, returns the traceback instead if the future's worker died.
+    def collect(future):
+        scc = futures.pop(future)
+        try:
+            results = future.result()
+        except BrokenProcessPool:
+            return traceback.format_exc()
+        except:
+            text = traceback.format_exc()
+            results = [(addr, False, text, None) for addr in scc]
+        record(scc, results)
+        return None
+
+    try:
+        submit_ready()
+        while len(futures) > 0:
+            (done, _) = wait(list(futures.keys()), return_when=FIRST_COMPLETED)
+            broken = []
+            for future in done:
+                scc = futures[future]
+                text = collect(future)
+                if text is not None: broken.append((scc, text))
+
+            if len(broken) > 0:
+                # Everything else still running in the broken pool fails too (or has just finished), wait for it.
+                (rest, _) = wait(list(futures.keys()))
+                for future in rest:
+                    scc = futures[future]
+                    text = collect(future)
+                    if text is not None: broken.append((scc, text))
+
+                pool.shutdown(wait=False)
+                pool = make_pool()
+                if len(broken) == 1:
+                    # The component ran alone, so it's the one that crashed the worker (e.g. in capstone).
+                    (scc, text) = broken[0]
+                    record(scc, [(addr, False, text, None) for addr in scc])
+                else:
+                    suspects.extend([scc for (scc, _) in broken])
+
+            submit_ready()
+    finally:
+        pool.shutdown()
+    index.close()
+
+    # Keep the summaries for the next run and for the IDE.
+    if binary.analysis_cache is not None: binary.analysis_cache.save()
+
+    print(("Done: %d succeeded, %d failed." % (succeeded, failed)))
+
+
+# Prints everything referencing the functions, selectors, class refs, ivars and cfstrings whose name matches 'pattern'.
+def xrefs_main(binary, pattern):
+    from analysis.xrefs import XrefIndex
+
+    regexp = re.compile(pattern)
+    targets = []
+    for f in binary.functions:
+        if regexp.search(f.name): targets.append((f.name, f.addr))
+    for objects in [binary.selectors, binary.class_refs, binary.ivars]:
+        for o in objects.values():
+            name = o.symbol_name if hasattr(o, "symbol_name") else o.name
+            if regexp.search(name): targets.append((name, o.addr))
+    for s in binary.cfstrings.values():
+        if regexp.search(s.string): targets.append((s.name, s.addr))
+
+    for (name, addr) in targets:
+        refs = binary.xrefs.index.references_to(addr)
+        print(("%s (0x%x): %d references" % (name, addr, len(refs))))
+        for (source, _, kind) in refs:
+            f = binary.addr_to_function(source)
+            print(("  0x%x %-20s %s" % (source, XrefIndex.KIND_NAMES[kind], f.name if f is not None else "(data)")))
+
+
 if __name__ == "__main__":
     import argparse
 
@@ -13,6 +252,17 @@ if __name__ == "__main__":
     parser.add_argument('--arch', type=str, help='architecture to select from fat binaries')
     parser.add_argument('--select-class', type=str, help='Objective-C class to select')
     parser.add_argument('--select-method', type=str, help='Objective-C method to select (regexp allowed, first match wins)')
+    parser.add_argument('--all', action='store_true', help='decompile all functions in the binary')
+    parser.add_argument('--classes', type=str, help='decompile all methods of Objective-C classes matching this regexp')
+    parser.add_argument('--functions', type=str, help='decompile all functions whose name matches this regexp')
+    parser.add_argument('--output-dir', type=str, default='cricket-output', help='directory for batch mode results')
+    parser.add_argument('--jobs', type=int, default=None, help='number of worker processes for batch mode')
+    parser.add_argument('--quiet', action='store_true', help='do not print per-function progress in batch mode')
+    parser.add_argument('--xrefs', type=str, help='list references to functions, selectors, classes, ivars and strings matching this regexp')
+    parser.add_argument('--no-cache', action='store_true', help='do not use or update the on-disk analysis cache')
+    parser.add_argument('--no-function-starts', action='store_true', help='ignore LC_FUNCTION_STARTS and discover functions heuristically')
+    parser.add_argument('--scan-functions', action='store_true', help='also scan for functions missing from LC_FUNCTION_STARTS')
+    parser.add_argument('--image', type=str, help='with a dyld shared cache as --binary, the image to analyze (install path or short name, "list" to list them)')
 
     args = parser.parse_args()
     if args.binary is None:
@@ -21,6 +271,15 @@ if __name__ == "__main__":
 
     print(("Using binary: %s" % args.binary))
 
+    if args.image is not None:
+        cache = get_shared_cache(args.binary)
+        if args.image == "list":
+            for path in cache.image_names():
+                print(("  " + path))
+            exit(0)
+        print(("Using image: %s" % args.image))
+        if args.arch is None: args.arch = cache.archvalue()
+
     if args.arch is None:
         archs = Binary.list_architectures_from_file(args.binary)
         if len(archs) < 0:
@@ -36,9 +295,20 @@ if __name__ == "__main__":
         args.arch = archs[0].archvalue
 
     print(("Using architecture: %s" % args.arch))
-    binary = Binary(args.binary, Architecture.get_arch_from_archvalue(args.arch))
+    binary = Binary(args.binary, Architecture.get_arch_from_archvalue(args.arch), args.image)
+    binary.use_analysis_cache = not args.no_cache
+    binary.use_function_starts = not args.no_function_starts
+    binary.supplement_function_starts = args.scan_functions
     binary.load()
 
+    if args.xrefs is not None:
+        xrefs_main(binary, args.xrefs)
+        exit(0)
+
+    if args.all or args.classes is not None or args.functions is not None:
+        batch_main(binary, args)
+        exit(0)
+
     if args.select_class is None:
         print("Select class with '--select-class'. Available:")
         for c in binary.classes:
@@ -79,27 +349,4 @@ if __name__ == "__main__":
     print("")
 
     func = method.function
-    
-    func.load()
-    print("Loaded func")
-    auto_build_bbs(func)
-    print("built bbs")
-    auto_transform_bbs(func)
-    print("transformed bbs")
-    builder = UCodeBuilder(func)
-    print("instantiated ucodebuilder")
-    builder.build_ucode()
-    print("built ucode")
-    auto_transform_ucode(func, single_step=False)
-    print("transformed ucode")
-    func.ufunction.cfg = CFGGraph(func.ufunction)
-    print("created cfg")
-    auto_match_cfg(func, single_step=False)
-    print("matched cfg")
-    func.build_ast()
-    print("built ast")
-    auto_optimize_ast(func)
-    print("optimized ast")
-
-    ast_string, _ = func.print_ast()
-    print(ast_string)
+    print(decompile_function(func, verbose=True))
@@ -0,0 +1,91 @@
+#	
+#	function_starts.py ... LC_FUNCTION_STARTS load command.
+#	
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#	
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#	
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#	
+
+from macho.loadcommands.loadcommand import LoadCommand, LC_FUNCTION_STARTS
+from macho.macho import MachO
+from monkey_patching import patch
+
+
+def decodeFunctionStarts(data):
+	"""Decode the function starts table, a zero-terminated sequence of ULEB128
+	deltas. The first delta is relative to the start of the ``__TEXT`` segment,
+	every following one to the previous function start. Returns the offsets of
+	all function starts from the start of ``__TEXT``."""
+	
+	offsets = []
+	offset = 0
+	value = 0
+	bit = 0
+	for c in data:
+		value |= (c & 0x7f) << bit
+		if c & 0x80:
+			bit += 7
+			continue
+		if value == 0:
+			break
+		offset += value
+		offsets.append(offset)
+		value = 0
+		bit = 0
+	return offsets
+
+
+class FunctionStartsCommand(LoadCommand):
+	"""The function starts load command. It points to a table in the
+	``__LINKEDIT`` segment listing the start addresses of all functions in the
+	binary, including the ones without symbols.
+	
+	.. attribute:: dataoff
+	
+		The file offset of the table.
+
+	.. attribute:: datasize
+	
+		The size of the table.
+	
+	.. attribute:: offsets
+	
+		The offsets of the function starts from the start of the ``__TEXT``
+		segment, in increasing order.
+	
+	"""
+
+	def analyze(self, machO):
+		(self.dataoff, self.datasize) = machO.readFormatStruct('2L')
+		start = self.dataoff + machO.origin
+		self.offsets = decodeFunctionStarts(machO.file[start:start + self.datasize])
+			
+	def __str__(self):
+		return "<FunctionStarts {} functions>".format(len(self.offsets))
+
+
+LoadCommand.registerFactory(LC_FUNCTION_STARTS, FunctionStartsCommand)
+
+@patch
+class MachO_FunctionStartsPatches(MachO):
+	"""This patch defines a single convenient function :meth:`functionStarts`
+	which returns the VM addresses of the function starts."""
+
+	def functionStarts(self):
+		"""Returns the sorted VM addresses from the function starts table, or
+		``None`` if the binary doesn't have one."""
+		lc = self.loadCommands.any('cmd', LC_FUNCTION_STARTS)
+		if lc is None:
+			return None
+		base = self.segment('__TEXT').vmaddr
+		return [base + offset for offset in lc.offsets]
+
@@ -120,7 +120,7 @@ def readSLeb128(f):
     maxpos = len(f)
     
     while maxpos > pos:
-        c = ord(f[pos])
+        c = f[pos]
         pos += 1
         s = c & 0x7f
         res |= s << bit
@@ -1,11 +1,14 @@
+import bisect
+import copy
 import pstats
 
 import io
+from functools import partial
 
-from PyQt5.QtCore import QCoreApplication
+from PyQt5.QtCore import QCoreApplication, Qt
 from PyQt5.QtCore import QEventLoop
 from PyQt5.QtGui import QFont
-from PyQt5.QtWidgets import QWidgetAction, QAction, QWidget, QSizePolicy, QToolBar, QProgressDialog
+from PyQt5.QtWidgets import QWidgetAction, QAction, QWidget, QSizePolicy, QToolBar, QProgressDialog, QMessageBox
 
 from analysis import transforms
 from analysis.asm.functionpass import StripNops, RemoveUnreachableBasicBlocks, JoinLinearBasicBlocks
@@ -21,6 +24,7 @@ from analysis.ucode.ucode_cfg import CFGGraph
 from analysis.ucode.ucode_transformsfunction import *
 from analysis.ucode.ucode_transformsinstruction import *
 from analysis.ucode.ucode_transformsbb import *
+from ide.worker import AnalysisJob
 
 menu_action_methods = []
 
@@ -46,6 +50,11 @@ class ActionManager:
         self.original_actions = self.toolbar.actions()
         self.auto_action = self.main_window.actionAuto
 
+        # Results of functions decompiled speculatively in the background (by address), see prefetch_around.
+        self.prefetch_count = 2
+        self.prefetched = {}
+        self.main_window.app.worker.job_finished.connect(self.prefetch_finished)
+
     def setup_toolbar(self):
         # Replace the last separator with a spacer (expanding widget).
         actions = self.toolbar.findChildren(QAction)
@@ -62,48 +71,56 @@ class ActionManager:
         self.toolbar.setFont(font)
 
     def setup_actions(self):
+        # auto() waits for the worker, which needs the binary's lock, so it takes the lock itself where it needs it.
         self.main_window.actionAuto.triggered.connect(self.auto)
-        self.main_window.actionMove_Up.triggered.connect(self.move_up)
-        self.main_window.actionMove_Down.triggered.connect(self.move_down)
-        self.main_window.actionDetect_Patterns.triggered.connect(self.detect_patterns)
-        self.main_window.actionEliminate.triggered.connect(self.eliminate)
-        self.main_window.actionGenerate_Basic_Blocks.triggered.connect(self.generate_bbs)
-        self.main_window.actionGenerate_uCode.triggered.connect(self.generate_ucode)
-        self.main_window.actionGenerate_CFG.triggered.connect(self.generate_cfg)
-        self.main_window.actionGenerate_Source.triggered.connect(self.generate_source)
-        self.main_window.actionStrip_NOPs.triggered.connect(self.strip_nops)
-        self.main_window.actionRemove_Unreachable_Basic_Blocks.triggered.connect(self.strip_bbs)
-        self.main_window.actionDe_Spill.triggered.connect(self.de_spill)
-        self.main_window.actionPropagate.triggered.connect(self.propagate)
-        self.main_window.actionSimplify.triggered.connect(self.simplify)
-        self.main_window.actionResolve_Symbols.triggered.connect(self.resolve)
-        self.main_window.actionApply_ARC.triggered.connect(self.arc)
-
-        self.main_window.actionRemove_Instruction.triggered.connect(self.instruction_action(UCodeRemoveInstruction))
-        self.main_window.actionPropagate_Instruction.triggered.connect(self.instruction_action(UCodeCopyPropagateInstruction))
-        self.main_window.actionFold_Constants_on_Instruction.triggered.connect(self.instruction_action(UCodeConstantFoldInstruction))
-        self.main_window.actionDead_Code_Elimination_on_Instruction.triggered.connect(self.instruction_action(UCodeDeadCodeEliminateInstruction))
-
-        self.main_window.actionDisable_Undo_Redo.triggered.connect(self.disable_undo_redo)
-
-        self.main_window.actionShow_Def_Use_Chains.triggered.connect(self.ucode_show_def_use)
-        self.main_window.actionShow_uCode_Generation_Details.triggered.connect(self.ucode_show_details)
-
-        self.main_window.actionMatch_If.triggered.connect(self.cfg_convert_if)
-        self.main_window.actionMatch_If_Else.triggered.connect(self.cfg_convert_if_else)
-        self.main_window.actionMatch_Sequence.triggered.connect(self.cfg_convert_sequence)
-        self.main_window.actionMatch_While.triggered.connect(self.cfg_convert_while)
-        self.main_window.actionMatch_Single_BB_While.triggered.connect(self.cfg_convert_single_bb_while)
-        self.main_window.actionMatch_Do_While.triggered.connect(self.cfg_convert_do_while)
-        self.main_window.actionMatch_Early_Return.triggered.connect(self.cfg_convert_early_return)
-        self.main_window.actionMatch_Multi_If.triggered.connect(self.cfg_convert_multi_if)
-        self.main_window.actionDuplicate_Exit_Node.triggered.connect(self.cfg_convert_duplicate_exit_node)
-        self.main_window.actionMatch_Infinite_Loop.triggered.connect(self.cfg_convert_infinite_loop)
-        self.main_window.actionMatch_Switch.triggered.connect(self.cfg_convert_switch)
+        self.main_window.actionMove_Up.triggered.connect(self.locked(self.move_up))
+        self.main_window.actionMove_Down.triggered.connect(self.locked(self.move_down))
+        self.main_window.actionDetect_Patterns.triggered.connect(self.locked(self.detect_patterns))
+        self.main_window.actionEliminate.triggered.connect(self.locked(self.eliminate))
+        self.main_window.actionGenerate_Basic_Blocks.triggered.connect(self.locked(self.generate_bbs))
+        self.main_window.actionGenerate_uCode.triggered.connect(self.locked(self.generate_ucode))
+        self.main_window.actionGenerate_CFG.triggered.connect(self.locked(self.generate_cfg))
+        self.main_window.actionGenerate_Source.triggered.connect(self.locked(self.generate_source))
+        self.main_window.actionStrip_NOPs.triggered.connect(self.locked(self.strip_nops))
+        self.main_window.actionRemove_Unreachable_Basic_Blocks.triggered.connect(self.locked(self.strip_bbs))
+        self.main_window.actionDe_Spill.triggered.connect(self.locked(self.de_spill))
+        self.main_window.actionPropagate.triggered.connect(self.locked(self.propagate))
+        self.main_window.actionSimplify.triggered.connect(self.locked(self.simplify))
+        self.main_window.actionResolve_Symbols.triggered.connect(self.locked(self.resolve))
+        self.main_window.actionApply_ARC.triggered.connect(self.locked(self.arc))
+
+        self.main_window.actionRemove_Instruction.triggered.connect(self.locked(self.instruction_action(UCodeRemoveInstruction)))
+        self.main_window.actionPropagate_Instruction.triggered.connect(self.locked(self.instruction_action(UCodeCopyPropagateInstruction)))
+        self.main_window.actionFold_Constants_on_Instruction.triggered.connect(self.locked(self.instruction_action(UCodeConstantFoldInstruction)))
+        self.main_window.actionDead_Code_Elimination_on_Instruction.triggered.connect(self.locked(self.instruction_action(UCodeDeadCodeEliminateInstruction)))
+
+        self.main_window.actionDisable_Undo_Redo.triggered.connect(self.locked(self.disable_undo_redo))
+
+        self.main_window.actionShow_Def_Use_Chains.triggered.connect(self.locked(self.ucode_show_def_use))
+        self.main_window.actionShow_uCode_Generation_Details.triggered.connect(self.locked(self.ucode_show_details))
+
+        self.main_window.actionMatch_If.triggered.connect(self.locked(self.cfg_convert_if))
+        self.main_window.actionMatch_If_Else.triggered.connect(self.locked(self.cfg_convert_if_else))
+        self.main_window.actionMatch_Sequence.triggered.connect(self.locked(self.cfg_convert_sequence))
+        self.main_window.actionMatch_While.triggered.connect(self.locked(self.cfg_convert_while))
+        self.main_window.actionMatch_Single_BB_While.triggered.connect(self.locked(self.cfg_convert_single_bb_while))
+        self.main_window.actionMatch_Do_While.triggered.connect(self.locked(self.cfg_convert_do_while))
+        self.main_window.actionMatch_Early_Return.triggered.connect(self.locked(self.cfg_convert_early_return))
+        self.main_window.actionMatch_Multi_If.triggered.connect(self.locked(self.cfg_convert_multi_if))
+        self.main_window.actionDuplicate_Exit_Node.triggered.connect(self.locked(self.cfg_convert_duplicate_exit_node))
+        self.main_window.actionMatch_Infinite_Loop.triggered.connect(self.locked(self.cfg_convert_infinite_loop))
+        self.main_window.actionMatch_Switch.triggered.connect(self.locked(self.cfg_convert_switch))
 
         for (qt_action_name, method, enabled_method) in menu_action_methods:
-            getattr(self.main_window, qt_action_name).triggered.connect(method.__get__(self))
-
+            getattr(self.main_window, qt_action_name).triggered.connect(self.locked(method.__get__(self)))
+
+    # Wraps a slot to hold the binary's lock while it runs, so it never touches the binary in the middle of a step of a
+    # background decompilation (see auto_on_function).
+    def locked(self, method):
+        def f(*args):
+            with self.main_window.binary.lock:
+                return method()
+        return f
 
     def disable_undo_redo(self):
         self.main_window.undo_manager.disable()
@@ -357,64 +374,144 @@ class ActionManager:
             self.main_window.reload_ucode()
         return f
 
-    def set_progress(self, s, value=None):
-        if value is not None:
-            s += " %.2f%%" % (value * 100)
-            self.progress_dialog.setValue(int(value * 100))
-        else:
-            # Some super fake progress
-            v = self.progress_dialog.value()
-            v = int((v + 99) / 2)
-            self.progress_dialog.setValue(v)
-
-        self.progress_dialog.setLabelText(s)
-        QCoreApplication.processEvents(QEventLoop.ExcludeUserInputEvents)
-        QCoreApplication.processEvents(QEventLoop.ExcludeUserInputEvents)
-
-    def auto_on_function(self, func):
-        self.set_progress("Disassembling...", 0.00)
-        func.load()
-        self.set_progress("Building basic blocks...", 0.10)
-        auto_build_bbs(func)
-        self.set_progress("Transforming low-level architecture idioms...", 0.20)
-        auto_transform_bbs(func)
-        self.set_progress("Generating uCode...", 0.30)
-        builder = UCodeBuilder(func)
-        builder.build_ucode()
-        self.set_progress("Optimizing uCode...", 0.40)
-        auto_transform_ucode(func, single_step=False)
-        func.ufunction.cfg = CFGGraph(func.ufunction)
-        self.set_progress("Generating CFG...", 0.60)
-        auto_match_cfg(func, single_step=False)
-        self.set_progress("Building AST...", 0.80)
-        func.build_ast()
-        self.set_progress("Optimizing AST...", 0.90)
-        auto_optimize_ast(func)
+    # Runs on the worker thread. Each step holds the binary's lock, which the GUI thread takes as well before it touches
+    # the binary, and the progress callback is only installed on the binary while a step runs. Cancellation is checked
+    # between the steps without the lock, and between the rounds of the uCode optimization and CFG matching (see
+    # report_round), where AnalysisCancelled releases the lock right away.
+    def auto_on_function(self, func, progress=None):
+        binary = func.binary
+
+        def step(s, value, fn):
+            if progress: progress.progress(s, value)
+            with binary.lock:
+                binary.load_progress_callback = progress
+                try:
+                    fn()
+                finally:
+                    binary.load_progress_callback = None
+
+        def build_ucode():
+            UCodeBuilder(func).build_ucode()
+
+        def transform_ucode():
+            auto_transform_ucode(func, single_step=False)
+            func.ufunction.cfg = CFGGraph(func.ufunction)
+
+        step("Disassembling...", 0.00, func.load)
+        step("Building basic blocks...", 0.10, partial(auto_build_bbs, func))
+        step("Transforming low-level architecture idioms...", 0.20, partial(auto_transform_bbs, func))
+        step("Generating uCode...", 0.30, build_ucode)
+        step("Optimizing uCode...", 0.40, transform_ucode)
+        step("Generating CFG...", 0.60, partial(auto_match_cfg, func, single_step=False))
+        step("Building AST...", 0.80, func.build_ast)
+        step("Optimizing AST...", 0.90, partial(auto_optimize_ast, func))
+
+    # Runs on the worker thread.
+    def auto_job(self, func, progress):
+        bd = func.binary.find_block_descriptor_for_function(func)
+        if bd is not None:
+            progress.progress("Decompiling block 1 of 1...", 0.20)
+            block_func = bd.uses[0].invoke_func
+            self.auto_on_function(block_func, progress)
+
+        self.auto_on_function(func, progress)
+        return func
+
+    # Runs on the worker thread. Decompiles 'detached' (a copy of 'func') and returns its attributes copied again with
+    # all references to the copy pointing back at 'func', ready to be swapped in by prefetch_finished.
+    def prefetch_job(self, func, detached, progress):
+        self.auto_on_function(detached, progress)
+        progress.progress("Finishing...")
+        memo = self.shared_memo(func)
+        memo[id(detached)] = func
+        with func.binary.lock:
+            return copy.deepcopy(dict(vars(detached)), memo)
+
+    def shared_memo(self, func):
+        return {id(func.binary): func.binary, id(func.arch): func.arch, id(func.method): func.method,
+                id(func.block_descriptor): func.block_descriptor}
 
     def auto(self):
         func = self.main_window.selected_func
         if func is None: return
+        worker = self.main_window.app.worker
 
-        self.progress_dialog = QProgressDialog("                    Decompiling function...                ", None, 0, 100)
+        self.progress_dialog = QProgressDialog("                    Decompiling function...                ", "Cancel", 0, 100)
+        self.progress_dialog.setWindowModality(Qt.ApplicationModal)
         self.progress_dialog.forceShow()
-        QCoreApplication.processEvents(QEventLoop.ExcludeUserInputEvents)
-
-        self.main_window.undo_manager.pre_action(func, "Auto")
-
-        bd = func.binary.find_block_descriptor_for_function(func)
-        if bd is not None:
-            self.set_progress("Decompiling block 1 of 1...", 0.20)
-            block_func = bd.uses[0].invoke_func
-            self.auto_on_function(block_func)
 
-        self.auto_on_function(func)
+        prefetch_job = worker.find(func.addr)
+        if prefetch_job is not None:
+            # Already being decompiled in the background, just wait for it.
+            worker.promote(prefetch_job)
+            worker.wait_for(prefetch_job, self.progress_dialog)
+            if prefetch_job.cancelled:
+                self.progress_dialog.close()
+                return
+            QCoreApplication.processEvents(QEventLoop.ExcludeUserInputEvents)  # deliver prefetch_finished
+
+        # The worker needs the binary's lock, so it's not held while waiting for the job.
+        binary = func.binary
+        with binary.lock:
+            self.main_window.undo_manager.pre_action(func, "Auto")
+            prefetched = self.prefetched.pop(func.addr, None)
+            swapped = prefetched is not None and self.is_untouched(func)
+            if swapped:
+                for (key, value) in prefetched.items():
+                    setattr(func, key, value)
+        if swapped:
+            job = None
+        else:
+            job = AnalysisJob("Decompiling function", partial(self.auto_job, func), key=func.addr)
+            job = worker.wait_for(worker.submit(job), self.progress_dialog)
 
-        self.main_window.undo_manager.post_action()
+        with binary.lock:
+            if job is not None and (job.cancelled or job.error is not None):
+                self.main_window.undo_manager.abort_action()
+            else:
+                self.main_window.undo_manager.post_action()
+        self.progress_dialog.close()
 
         self.main_window.reload_func()
+        if job is not None and job.error is not None:
+            QMessageBox.critical(None, "Decompilation failed", job.error)
+        if job is not None and (job.cancelled or job.error is not None):
+            return
+
         self.main_window.goto_tab(self.main_window.TAB_SOURCE)
+        self.prefetch_around(func)
+
+    # Speculatively decompiles the functions following (and the one preceding) 'func' in the background. The pipeline
+    # runs on a detached copy, which auto() only swaps in if the function hasn't been touched in the meantime, so
+    # cancelling a prefetch never leaves a half-decompiled function behind.
+    def prefetch_around(self, func):
+        worker = self.main_window.app.worker
+        worker.cancel_speculative()
+
+        binary = func.binary
+        idx = bisect.bisect_left(binary.function_starts, func.addr)
+        if idx >= len(binary.function_starts) or binary.function_by_start[idx] is not func: return
+        candidates = binary.function_by_start[idx + 1:idx + 1 + self.prefetch_count] + binary.function_by_start[max(idx - 1, 0):idx]
+        for f in candidates:
+            if f.addr in self.prefetched: continue
+            if not self.is_untouched(f): continue
+            with binary.lock:
+                if binary.find_block_descriptor_for_function(f) is not None: continue  # would touch the block's function
+                detached = copy.deepcopy(f, self.shared_memo(f))
+            job = AnalysisJob("Prefetching %s" % f.name, partial(self.prefetch_job, f, detached), key=f.addr, speculative=True)
+            job.func = f
+            worker.submit(job)
+
+    def is_untouched(self, func):
+        return func.bbs is None and func.ufunction is None and func.ast is None
+
+    def prefetch_finished(self, job):
+        func = getattr(job, "func", None)
+        if func is None: return
+        if job.cancelled or job.error is not None or job.result is None: return
+        if not self.is_untouched(func): return
 
-        self.progress_dialog.close()
+        self.prefetched[func.addr] = job.result
 
     def auto_step(self):
         if self.main_window.current_tab() == self.main_window.TAB_UCODE:
@@ -14,6 +14,7 @@ from PyQt5.QtGui import *
 from analysis.binary import Binary
 from ide.welcome import WelcomeDialog
 from ide.window import MainWindow
+from ide.worker import AnalysisJob, AnalysisWorker
 
 
 class App:
@@ -26,6 +27,8 @@ class App:
         self.profiling_has_results = False
         self.welcome_dialog = None
         self.open_windows = []
+        self.worker = None
+        ":type: AnalysisWorker"
 
     def start_profiling(self):
         if not self.profiling_enabled:
@@ -73,20 +76,6 @@ class App:
         for el in xml.getroot().findall(".//widget[@class='QToolButton']"):
             process_element(el)
 
-    def progress(self, s, value=None):
-        if value is not None:
-            s += " %.2f%%" % (value * 100)
-            self.progress_dialog.setValue(int(value * 100))
-        else:
-            # Some super fake progress
-            v = self.progress_dialog.value()
-            v = int((v + 99) / 2)
-            self.progress_dialog.setValue(v)
-
-        self.progress_dialog.setLabelText(s)
-        QCoreApplication.processEvents(QEventLoop.ExcludeUserInputEvents)
-        QCoreApplication.processEvents(QEventLoop.ExcludeUserInputEvents)
-
     def open_binary(self, filename, arch=None):
         if arch is None:
             archs = Binary.list_architectures_from_file(filename)
@@ -107,13 +96,25 @@ class App:
             QMessageBox.critical(None, "Not implemented", "Opening ARMv7 binaries is not implemented. Try AArch64.")
             return False
 
-        self.progress_dialog = QProgressDialog("Opening binary...", None, 0, 100)
+        self.progress_dialog = QProgressDialog("Opening binary...", "Cancel", 0, 100)
         self.progress_dialog.forceShow()
-        QCoreApplication.processEvents(QEventLoop.ExcludeUserInputEvents)
 
         binary = Binary(filename, arch)
-        binary.load_progress_callback = self
-        binary.load()
+
+        def load(progress):
+            binary.load_progress_callback = progress
+            try:
+                binary.load()
+            finally:
+                binary.load_progress_callback = None
+
+        job = self.worker.wait_for(self.worker.submit(AnalysisJob("Opening binary", load)), self.progress_dialog)
+        if job.cancelled or job.error is not None:
+            self.progress_dialog.close()
+            if job.error is not None:
+                QMessageBox.critical(None, "Opening binary failed", job.error)
+            return False
+
         window = MainWindow(self, binary)
 
         # Binary loaded...
@@ -177,6 +178,10 @@ class App:
         d = os.path.dirname(os.path.abspath(__file__)) + "/"
         qapp.setWindowIcon(QIcon(d + "icons/violin.png"))
 
+        self.worker = AnalysisWorker()
+        self.worker.start()
+        qapp.aboutToQuit.connect(self.worker.stop)
+
         self.welcome_dialog = WelcomeDialog(self)
         self.welcome_dialog.show()
 
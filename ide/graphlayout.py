@@ -0,0 +1,331 @@
+from collections import OrderedDict
+
+
+# Layered (Sugiyama style) layout of a directed graph, used for the basic block and CFG graph views:
+#   1. cycles are broken by reversing the back edges of a DFS from the first node,
+#   2. nodes are assigned to layers by longest path, long edges are split by dummy vertices,
+#   3. the order within the layers is improved by barycenter sweeps, keeping the ordering with the fewest crossings,
+#   4. x coordinates are pulled towards the median of the neighbors while keeping the order and the node separation.
+# Steps 1-3 only depend on the graph's shape and are done once (order()), step 4 depends on the node sizes and is
+# redone by place() whenever they change.
+class LayeredGraphLayout:
+    ORDERING_SWEEPS = 12
+    PLACEMENT_SWEEPS = 6
+
+    def __init__(self, nodes, edges, node_separation=30.0, layer_separation=40.0, margin=20.0):
+        self.nodes = list(nodes)
+        self.node_index = dict([(n, i) for (i, n) in enumerate(self.nodes)])
+        self.edges = list(edges)
+        self.node_separation = node_separation
+        self.layer_separation = layer_separation
+        self.margin = margin
+
+        self.vertex_count = 0
+        self.layer = []  # vertex -> layer number
+        self.layers = []  # layer number -> list of vertices, in order
+        self.succs = []  # vertex -> successors in the acyclic graph (with dummy vertices)
+        self.preds = []
+        self.chains = []  # edge index -> vertices along the edge (source to target), or None for self loops
+        self.reversed = []  # edge index -> whether the edge points upwards
+
+        self.last_sizes = None
+        self.last_placement = None
+
+    def order(self):
+        n = len(self.nodes)
+        adjacency = [[] for _ in range(n)]
+        for (a, b) in self.edges:
+            adjacency[self.node_index[a]].append(self.node_index[b])
+
+        back_edges = self.find_back_edges(adjacency)
+
+        dag_succs = [[] for _ in range(n)]
+        dag_edges = []
+        for (a, b) in self.edges:
+            (u, v) = (self.node_index[a], self.node_index[b])
+            if u == v:
+                dag_edges.append(None)
+                continue
+            is_reversed = (u, v) in back_edges
+            if is_reversed: (u, v) = (v, u)
+            dag_succs[u].append(v)
+            dag_edges.append((u, v, is_reversed))
+
+        layer = self.assign_layers(dag_succs)
+
+        self.vertex_count = n
+        self.layer = list(layer)
+        self.succs = [[] for _ in range(n)]
+        self.preds = [[] for _ in range(n)]
+        self.chains = []
+        self.reversed = []
+        for e in dag_edges:
+            if e is None:
+                self.chains.append(None)
+                self.reversed.append(False)
+                continue
+
+            (u, v, is_reversed) = e
+            chain = [u]
+            for l in range(layer[u] + 1, layer[v]):
+                chain.append(self.add_vertex(l))
+            chain.append(v)
+            for i in range(len(chain) - 1):
+                self.succs[chain[i]].append(chain[i + 1])
+                self.preds[chain[i + 1]].append(chain[i])
+            self.chains.append(chain)
+            self.reversed.append(is_reversed)
+
+        layer_count = max(self.layer) + 1 if self.vertex_count > 0 else 0
+        self.layers = [[] for _ in range(layer_count)]
+        for v in self.initial_order():
+            self.layers[self.layer[v]].append(v)
+
+        self.minimize_crossings()
+        self.last_sizes = None
+        self.last_placement = None
+
+    def add_vertex(self, l):
+        self.layer.append(l)
+        self.succs.append([])
+        self.preds.append([])
+        self.vertex_count += 1
+        return self.vertex_count - 1
+
+    def find_back_edges(self, adjacency):
+        n = len(adjacency)
+        state = [0] * n  # 0 = unvisited, 1 = on the DFS stack, 2 = done
+        back_edges = set()
+        for root in range(n):
+            if state[root] != 0: continue
+            state[root] = 1
+            stack = [(root, iter(adjacency[root]))]
+            while len(stack) > 0:
+                (u, it) = stack[-1]
+                v = next(it, None)
+                if v is None:
+                    state[u] = 2
+                    stack.pop()
+                elif state[v] == 0:
+                    state[v] = 1
+                    stack.append((v, iter(adjacency[v])))
+                elif state[v] == 1:
+                    back_edges.add((u, v))
+        return back_edges
+
+    def assign_layers(self, dag_succs):
+        n = len(dag_succs)
+        indegree = [0] * n
+        for u in range(n):
+            for v in dag_succs[u]: indegree[v] += 1
+
+        layer = [0] * n
+        ready = [u for u in range(n) if indegree[u] == 0]
+        while len(ready) > 0:
+            u = ready.pop()
+            for v in dag_succs[u]:
+                layer[v] = max(layer[v], layer[u] + 1)
+                indegree[v] -= 1
+                if indegree[v] == 0: ready.append(v)
+        return layer
+
+    # Breadth-first order from the first node, which keeps fallthrough successors next to each other.
+    def initial_order(self):
+        seen = [False] * self.vertex_count
+        result = []
+        for root in range(self.vertex_count):
+            if seen[root]: continue
+            seen[root] = True
+            queue = [root]
+            i = 0
+            while i < len(queue):
+                u = queue[i]
+                i += 1
+                result.append(u)
+                for v in self.succs[u]:
+                    if not seen[v]:
+                        seen[v] = True
+                        queue.append(v)
+        return result
+
+    def minimize_crossings(self):
+        position = self.positions()
+        best = [list(l) for l in self.layers]
+        best_crossings = self.count_crossings(position)
+        stale = 0
+        for sweep in range(self.ORDERING_SWEEPS):
+            if best_crossings == 0 or stale >= 4: break
+            if sweep % 2 == 0:
+                for i in range(1, len(self.layers)):
+                    self.reorder_layer(i, self.preds, position)
+            else:
+                for i in range(len(self.layers) - 2, -1, -1):
+                    self.reorder_layer(i, self.succs, position)
+
+            crossings = self.count_crossings(position)
+            if crossings < best_crossings:
+                best_crossings = crossings
+                best = [list(l) for l in self.layers]
+                stale = 0
+            else:
+                stale += 1
+        self.layers = best
+
+    def reorder_layer(self, i, neighbors, position):
+        keys = {}
+        for (idx, v) in enumerate(self.layers[i]):
+            ns = neighbors[v]
+            keys[v] = sum([position[w] for w in ns]) / float(len(ns)) if len(ns) > 0 else float(idx)
+        self.layers[i].sort(key=lambda v: keys[v])
+        for (idx, v) in enumerate(self.layers[i]):
+            position[v] = idx
+
+    def positions(self):
+        position = [0] * self.vertex_count
+        for l in self.layers:
+            for (idx, v) in enumerate(l):
+                position[v] = idx
+        return position
+
+    # Number of edge crossings between all neighboring layers, counted as inversions with a Fenwick tree.
+    def count_crossings(self, position):
+        total = 0
+        for (i, l) in enumerate(self.layers[:-1]):
+            size = len(self.layers[i + 1])
+            tree = [0] * (size + 1)
+            seen = 0
+            for u in l:
+                targets = sorted([position[v] for v in self.succs[u]])
+                for p in targets:
+                    # Earlier edges with a target to the right of p cross this one.
+                    j = p + 1
+                    not_greater = 0
+                    while j > 0:
+                        not_greater += tree[j]
+                        j -= j & -j
+                    total += seen - not_greater
+                for p in targets:
+                    j = p + 1
+                    while j <= size:
+                        tree[j] += 1
+                        j += j & -j
+                    seen += 1
+        return total
+
+    # 'sizes' maps nodes to (w, h). Returns (positions, edge_points): positions maps nodes to the top left corner
+    # (x, y), edge_points is a list of point lists, one per edge (in the order they were given), or None for self loops.
+    def place(self, sizes):
+        key = tuple([sizes[n] for n in self.nodes])
+        if key == self.last_sizes: return self.last_placement
+
+        width = [0.0] * self.vertex_count
+        height = [0.0] * self.vertex_count
+        for (i, n) in enumerate(self.nodes):
+            (width[i], height[i]) = sizes[n]
+
+        layer_top = []
+        layer_height = []
+        y = self.margin
+        for l in self.layers:
+            h = max([height[v] for v in l] + [0.0])
+            layer_top.append(y)
+            layer_height.append(h)
+            y += h + self.layer_separation
+
+        x = [0.0] * self.vertex_count
+        for l in self.layers:
+            cur = 0.0
+            for v in l:
+                x[v] = cur + width[v] / 2
+                cur += width[v] + self.node_separation
+
+        for sweep in range(self.PLACEMENT_SWEEPS):
+            if sweep % 2 == 0:
+                for l in self.layers[1:]: self.align_layer(l, x, width, self.preds)
+            else:
+                for l in reversed(self.layers[:-1]): self.align_layer(l, x, width, self.succs)
+
+        left = min([x[v] - width[v] / 2 for v in range(self.vertex_count)] + [0.0])
+        for v in range(self.vertex_count):
+            x[v] += self.margin - left
+
+        positions = {}
+        for (i, n) in enumerate(self.nodes):
+            positions[n] = (x[i] - width[i] / 2, layer_top[self.layer[i]])
+
+        edge_points = []
+        out_ports = {}
+        in_ports = {}
+        for (e, chain) in enumerate(self.chains):
+            if chain is None: continue
+            out_ports.setdefault(chain[0], []).append(e)
+            in_ports.setdefault(chain[-1], []).append(e)
+        for ports in list(out_ports.values()) + list(in_ports.values()):
+            ports.sort(key=lambda e: x[self.chains[e][1]] if len(self.chains[e]) > 1 else 0.0)
+
+        def port_x(v, ports, e):
+            idx = ports[v].index(e)
+            return x[v] - width[v] / 2 + width[v] * (idx + 1) / (len(ports[v]) + 1)
+
+        for (e, chain) in enumerate(self.chains):
+            if chain is None:
+                edge_points.append(None)
+                continue
+
+            (u, v) = (chain[0], chain[-1])
+            points = [(port_x(u, out_ports, e), layer_top[self.layer[u]] + height[u])]
+            for d in chain[1:-1]:
+                l = self.layer[d]
+                points.append((x[d], layer_top[l]))
+                points.append((x[d], layer_top[l] + layer_height[l]))
+            points.append((port_x(v, in_ports, e), layer_top[self.layer[v]]))
+            if self.reversed[e]: points.reverse()
+            edge_points.append(points)
+
+        self.last_sizes = key
+        self.last_placement = (positions, edge_points)
+        return self.last_placement
+
+    # Moves the vertices of a layer towards the median x of their neighbors. Two packings are computed, one pushing
+    # right and one pushing left, both keep the order and the separation, and so does their average.
+    def align_layer(self, l, x, width, neighbors):
+        desired = []
+        for v in l:
+            ns = sorted([x[w] for w in neighbors[v]])
+            desired.append(ns[len(ns) // 2] if len(ns) > 0 else x[v])
+
+        count = len(l)
+        right = [0.0] * count
+        for i in range(count):
+            right[i] = desired[i]
+            if i > 0:
+                right[i] = max(right[i], right[i - 1] + (width[l[i - 1]] + width[l[i]]) / 2 + self.node_separation)
+        left = [0.0] * count
+        for i in range(count - 1, -1, -1):
+            left[i] = desired[i]
+            if i < count - 1:
+                left[i] = min(left[i], left[i + 1] - (width[l[i + 1]] + width[l[i]]) / 2 - self.node_separation)
+
+        for i in range(count):
+            x[l[i]] = (left[i] + right[i]) / 2
+
+
+# Keeps the layouts of recently shown graphs. The key identifies the function and the graph's shape, so reopening a
+# view reuses the ordering, and a change that only affects the text in the nodes only redoes the placement.
+class GraphLayoutCache:
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self.layouts = OrderedDict()
+
+    def layout_for(self, key, nodes, edges):
+        layout = self.layouts.get(key)
+        if layout is not None:
+            self.layouts.move_to_end(key)
+            return layout
+
+        layout = LayeredGraphLayout(nodes, edges)
+        layout.order()
+        self.layouts[key] = layout
+        while len(self.layouts) > self.max_entries:
+            self.layouts.popitem(last=False)
+        return layout
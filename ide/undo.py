@@ -1,6 +1,64 @@
 import copy
-
-
+import sys
+
+
+# A function's state is split into components which are snapshotted independently: the assembly level (everything
+# that's not listed below), the ucode (including the CFG) and the AST. Later components reference objects of earlier
+# ones (ucode instructions point at their assembly instructions, the ucode parameters are built from the function's
+# variables, AST nodes point at assembly instructions and basic blocks), so the components are always copied in this
+# order with a single memo. A component that is kept as it is seeds the memo with the pairs of its live and frozen
+# objects, so the components copied after it reference the right objects.
+FUNCTION_COMPONENTS = ["ufunction", "ast"]
+COMPONENT_ORDER = ["asm"] + FUNCTION_COMPONENTS
+SHARED_ATTRIBUTES = ["arch", "binary", "method", "block_descriptor", "name", "addr", "len"]
+
+
+def component_attributes(func, component):
+    if component != "asm": return [component]
+    return [key for key in vars(func).keys() if key not in FUNCTION_COMPONENTS and key not in SHARED_ATTRIBUTES]
+
+
+# Cheap value that changes whenever the component is modified, so that an unchanged component can be shared with the
+# previous snapshot instead of being copied again. The ucode has a version counter (and the CFG allocates a new node
+# number for every conversion), the assembly level is compared structurally and the AST, which has no change tracking,
+# by its printed text.
+def component_fingerprint(func, component):
+    if component == "ufunction":
+        f = func.ufunction
+        if f is None: return ("none",)
+        cfg_state = (id(f.cfg), f.cfg.next_number) if f.cfg is not None else None
+        return (id(f), f.version, cfg_state)
+    elif component == "ast":
+        if func.ast is None: return ("none",)
+        (text, _) = func.print_ast()
+        return (id(func.ast), id(func.ast.root), text)
+    else:
+        bbs = func.bbs
+        return (id(func.instructions), len(func.instructions) if func.instructions is not None else -1,
+                id(bbs), tuple([(id(bb), len(bb.instructions)) for bb in bbs]) if bbs is not None else None,
+                id(func.bb_beginnings), len(func.bb_beginnings) if func.bb_beginnings is not None else -1,
+                func.func_end, len(func.patterns), func.stack_frame_size)
+
+
+class FunctionSnapshot:
+    def __init__(self, func_addr):
+        self.func_addr = func_addr
+        self.components = {}  # component -> frozen copy (dict of attribute -> value)
+        self.sizes = {}  # component -> estimated size in bytes
+
+
+class LiveState:
+    def __init__(self, snapshot, fingerprints, pairs):
+        self.snapshot = snapshot
+        ":type: FunctionSnapshot"
+        self.fingerprints = fingerprints
+        self.pairs = pairs  # component -> [(live object, frozen object)]
+
+
+# Snapshot based undo/redo with structural sharing. A snapshot only copies the components of the function that
+# changed since the last snapshot or restore, everything else is shared with the previous snapshot. Restoring likewise
+# only copies back the components that differ from the live function. The total size of all distinct frozen components
+# is kept under memory_budget bytes by dropping the oldest undo steps.
 class UndoManager:
     def __init__(self, window):
         self.window = window
@@ -8,9 +66,15 @@ class UndoManager:
         self.undo_index = 0
         self.pre_post_counter = 0
         self.disabled = False
+        self.memory_budget = 256 * 1024 * 1024
+        self.max_steps = None
+        self.live = {}  # func_addr -> LiveState
 
     def disable(self):
         self.disabled = True
+        self.stack = []
+        self.undo_index = 0
+        self.live = {}
 
     def setup_actions(self):
         self.window.actionUndo.triggered.connect(self.undo)
@@ -23,11 +87,8 @@ class UndoManager:
         if self.disabled: return
 
         item = self.stack[self.undo_index - 1]
-        func_before = item["func_before"]
-        func_addr = item["func_addr"]
-
-        f = self.window.binary.function_from_addr(func_addr)
-        f.replace_with_function(func_before)
+        f = self.window.binary.function_from_addr(item["func_addr"])
+        self.restore(f, item["func_before"])
 
         self.window.reload_func()
 
@@ -38,11 +99,8 @@ class UndoManager:
         if self.disabled: return
 
         item = self.stack[self.undo_index]
-        func_after = item["func_after"]
-        func_addr = item["func_addr"]
-
-        f = self.window.binary.function_from_addr(func_addr)
-        f.replace_with_function(func_after)
+        f = self.window.binary.function_from_addr(item["func_addr"])
+        self.restore(f, item["func_after"])
 
         self.window.reload_func()
 
@@ -58,7 +116,7 @@ class UndoManager:
         if len(self.stack) > 0:
             self.stack = self.stack[0:self.undo_index]
 
-        func_copy = copy.deepcopy(func)
+        func_copy = self.snapshot(func)
         self.stack.append({"func_addr": func.addr, "func_before": func_copy, "func": func, "name": name})
 
         self.undo_index = len(self.stack)
@@ -69,12 +127,125 @@ class UndoManager:
         assert self.pre_post_counter == 0
         if self.disabled: return
 
-        func = self.stack[len(self.stack) - 1]["func"]
-        func_copy = copy.deepcopy(func)
         item = self.stack[len(self.stack) - 1]
-        item["func_after"] = func_copy
+        item["func_after"] = self.snapshot(item["func"])
+        del item["func"]
+
+        self.enforce_memory_budget()
+        self.update_buttons()
+
+    # Ends an action that failed or was cancelled half-way: puts the function back into its state from before the
+    # action and forgets the action.
+    def abort_action(self):
+        self.pre_post_counter -= 1
+        if self.pre_post_counter > 0: return
+        assert self.pre_post_counter == 0
+        if self.disabled: return
+
+        item = self.stack.pop()
+        self.restore(item["func"], item["func_before"])
+        self.undo_index = len(self.stack)
         self.update_buttons()
 
+    def snapshot(self, func):
+        live = self.live.get(func.addr)
+        fingerprints = dict([(c, component_fingerprint(func, c)) for c in COMPONENT_ORDER])
+
+        # The components before the first changed one are shared with the previous snapshot, that one and everything
+        # after it is copied.
+        shared = 0
+        if live is not None:
+            while shared < len(COMPONENT_ORDER) and fingerprints[COMPONENT_ORDER[shared]] == \
+                    live.fingerprints[COMPONENT_ORDER[shared]]:
+                shared += 1
+            if shared == len(COMPONENT_ORDER): return live.snapshot  # Nothing changed at all.
+
+        snapshot = FunctionSnapshot(func.addr)
+        pairs = {}
+        memo = self.seed_memo(func)
+        for c in COMPONENT_ORDER[:shared]:
+            snapshot.components[c] = live.snapshot.components[c]
+            snapshot.sizes[c] = live.snapshot.sizes[c]
+            pairs[c] = live.pairs[c]
+            for (live_object, frozen_object) in pairs[c]:
+                memo[id(live_object)] = frozen_object
+        for c in COMPONENT_ORDER[shared:]:
+            value = dict([(key, getattr(func, key)) for key in component_attributes(func, c)])
+            (snapshot.components[c], pairs[c], snapshot.sizes[c]) = self.copy_component(value, memo)
+
+        self.live[func.addr] = LiveState(snapshot, fingerprints, pairs)
+        return snapshot
+
+    def restore(self, func, snapshot):
+        live = self.live.get(func.addr)
+
+        # The components before the first one that differs from the live function are kept, the rest is copied back.
+        kept = 0
+        if live is not None:
+            while kept < len(COMPONENT_ORDER):
+                c = COMPONENT_ORDER[kept]
+                if live.snapshot.components[c] is not snapshot.components[c]: break
+                if component_fingerprint(func, c) != live.fingerprints[c]: break
+                kept += 1
+
+        fingerprints = {}
+        pairs = {}
+        memo = self.seed_memo(func)
+        for c in COMPONENT_ORDER[:kept]:
+            fingerprints[c] = live.fingerprints[c]
+            pairs[c] = live.pairs[c]
+            for (live_object, frozen_object) in pairs[c]:
+                memo[id(frozen_object)] = live_object
+        for c in COMPONENT_ORDER[kept:]:
+            (value, copied, _) = self.copy_component(snapshot.components[c], memo)
+            for (key, v) in value.items():
+                setattr(func, key, v)
+            pairs[c] = [(live_object, frozen_object) for (frozen_object, live_object) in copied]
+        for c in COMPONENT_ORDER[kept:]:
+            fingerprints[c] = component_fingerprint(func, c)
+
+        self.live[func.addr] = LiveState(snapshot, fingerprints, pairs)
+
+        # Sanity check.
+        if func.bbs is not None:
+            for bb in func.bbs:
+                for instr in bb.instructions:
+                    assert instr.bb == bb
+
+    def seed_memo(self, func):
+        return {id(func): func, id(func.binary): func.binary, id(func.arch): func.arch}
+
+    # Deep copies 'value' with 'memo', which is shared by the components copied together. Returns the copy, the
+    # (original, copy) pairs of the objects copied for it and their estimated size.
+    def copy_component(self, value, memo):
+        keep_alive = memo.setdefault(id(memo), [])  # deepcopy keeps every copied original alive here
+        start = len(keep_alive)
+        result = copy.deepcopy(value, memo)
+
+        copied = [(x, memo[id(x)]) for x in keep_alive[start:]]
+        size = sum([sys.getsizeof(y) for (_, y) in copied])
+        return (result, copied, size)
+
+    def memory_usage(self):
+        seen = set()
+        total = 0
+        for item in self.stack:
+            for key in ["func_before", "func_after"]:
+                if key not in item: continue
+                snapshot = item[key]
+                for (c, frozen) in snapshot.components.items():
+                    if id(frozen) in seen: continue
+                    seen.add(id(frozen))
+                    total += snapshot.sizes[c]
+        return total
+
+    def enforce_memory_budget(self):
+        while len(self.stack) > 1:
+            too_many = self.max_steps is not None and len(self.stack) > self.max_steps
+            if not too_many and self.memory_usage() <= self.memory_budget: break
+            del self.stack[0]
+            self.undo_index = max(self.undo_index - 1, 0)
+
     def update_buttons(self):
         self.window.actionUndo.setEnabled(len(self.stack) > 0 and self.undo_index > 0)
         self.window.actionRedo.setEnabled(len(self.stack) > 0 and self.undo_index != len(self.stack))
@@ -1,18 +1,16 @@
 from PyQt5.QtCore import Qt
-from PyQt5.QtWidgets import QTreeWidget
+from PyQt5.QtWidgets import QTreeView
 
 
-class MyTreeWidget(QTreeWidget):
+class MyTreeView(QTreeView):
     def keyPressEvent(self, event):
         if event.key() == Qt.Key_Left:
-            selected_item = self.selectedItems()[0] if len(self.selectedItems()) > 0 else None
-            if selected_item:
-                if selected_item.childCount() == 0 or selected_item.isExpanded() == False:
-                    p = selected_item.parent()
-                    if p is not None:
-                        selected_item.setSelected(False)
-                        p.setSelected(True)
-                        self.setCurrentItem(p)
+            index = self.currentIndex()
+            if index.isValid():
+                if not self.model().hasChildren(index) or not self.isExpanded(index):
+                    p = index.parent()
+                    if p.isValid():
+                        self.setCurrentIndex(p)
                         return
 
-        super(MyTreeWidget, self).keyPressEvent(event)
+        super(MyTreeView, self).keyPressEvent(event)
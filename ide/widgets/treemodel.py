@@ -0,0 +1,149 @@
+import os
+
+from PyQt5.QtCore import QAbstractItemModel, QModelIndex, Qt
+from PyQt5.QtGui import QIcon
+
+icon_cache = {}
+
+
+def letter_icon(letter):
+    if letter not in icon_cache:
+        d = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        icon_cache[letter] = QIcon(d + "/" + "icons/letters/%s.png" % letter)
+    return icon_cache[letter]
+
+
+# One row of an ObjectTreeModel. 'entry' is a (kind, object) tuple, see ObjectTreeModel.describe. The node's own child
+# entries are only computed when the view asks for them, and child nodes are only created in batches by fetchMore.
+class ObjectTreeNode:
+    def __init__(self, parent, row, entry, model):
+        self.parent = parent
+        self.row = row
+        self.entry = entry
+        self.children = []
+        self.child_entries = None
+
+        (self.text, self.icon, self.func, self.cls, self.block) = model.describe(entry) if entry is not None else ("", None, None, None, None)
+
+    def entries(self, model):
+        if self.child_entries is None:
+            self.child_entries = model.child_entries(self.entry)
+        return self.child_entries
+
+
+# Item model for the class/function/block lists, backed directly by the Binary's lists. Rows are materialized lazily
+# (canFetchMore/fetchMore), so opening a binary with tens of thousands of functions only creates the visible rows. The
+# filter matches against a precomputed index of lowercase names of the top-level entries, and typing more characters
+# narrows the previous result instead of scanning everything again.
+class ObjectTreeModel(QAbstractItemModel):
+    FETCH_BATCH = 256
+
+    def __init__(self, entries, flat=False):
+        QAbstractItemModel.__init__(self)
+        self.all_entries = entries
+        self.flat = flat
+        self.filter_index = None
+        self.filter_text = ""
+        self.filter_result = None
+        self.root = ObjectTreeNode(None, 0, None, self)
+        self.root.child_entries = entries
+
+    # Returns (text, icon, func, cls, block) for an entry.
+    def describe(self, entry):
+        (kind, o) = entry
+        if kind == "class": return (o.name, letter_icon("c"), None, o, None)
+        if kind == "method": return (o.function.name if self.flat else o.name, letter_icon("m"), o.function, None, None)
+        if kind == "external_class": return ("(external) %s (in %s)" % (o.class_name, o.external_dylib), letter_icon("c"), None, None, None)
+        if kind == "function": return (o.name, letter_icon("f"), o, None, None)
+        if kind == "block": return (o.name, letter_icon("b"), None, None, o)
+        if kind == "use": return (o.name, letter_icon("m"), o.function if hasattr(o, "function") else None, None, None)
+        if kind == "subuse": return (o.name, letter_icon("m"), None, None, None)
+        if kind == "invoke": return ("Invoke: " + o.name, letter_icon("f"), o, None, None)
+        assert False
+
+    def child_entries(self, entry):
+        (kind, o) = entry
+        if kind == "class":
+            # In the flat view the methods follow their class at the top level.
+            return [] if self.flat else [("method", m) for m in o.methods]
+        if kind == "block":
+            result = []
+            for u in o.uses:
+                result.append(("use", u))
+                if hasattr(u, "invoke_func") and u.invoke_func is not None:
+                    result.append(("invoke", u.invoke_func))
+            return result
+        if kind == "use" and hasattr(o, "uses"):
+            return [("subuse", u2) for u2 in o.uses] + [("invoke", o.invoke_func)]
+        return []
+
+    def node(self, index):
+        if not index.isValid(): return self.root
+        return index.internalPointer()
+
+    def index(self, row, column, parent=QModelIndex()):
+        node = self.node(parent)
+        if column != 0 or row < 0 or row >= len(node.children): return QModelIndex()
+        return self.createIndex(row, column, node.children[row])
+
+    def parent(self, index):
+        if not index.isValid(): return QModelIndex()
+        p = index.internalPointer().parent
+        if p is None or p is self.root: return QModelIndex()
+        return self.createIndex(p.row, 0, p)
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.column() > 0: return 0
+        return len(self.node(parent).children)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 1
+
+    def hasChildren(self, parent=QModelIndex()):
+        node = self.node(parent)
+        if node is self.root: return len(node.entries(self)) > 0
+        return len(node.children) > 0 or len(node.entries(self)) > 0
+
+    def canFetchMore(self, parent):
+        node = self.node(parent)
+        return len(node.children) < len(node.entries(self))
+
+    def fetchMore(self, parent):
+        node = self.node(parent)
+        entries = node.entries(self)
+        start = len(node.children)
+        end = min(start + self.FETCH_BATCH, len(entries))
+        if end <= start: return
+
+        self.beginInsertRows(parent, start, end - 1)
+        for row in range(start, end):
+            node.children.append(ObjectTreeNode(node, row, entries[row], self))
+        self.endInsertRows()
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid(): return None
+        node = index.internalPointer()
+        if role == Qt.DisplayRole: return node.text
+        if role == Qt.DecorationRole: return node.icon
+        return None
+
+    def set_filter(self, text):
+        text = text.strip().lower()
+        if text == self.filter_text: return
+
+        if self.filter_index is None:
+            self.filter_index = [(self.describe(e)[0].lower(), e) for e in self.all_entries]
+
+        if text == "":
+            result = None
+        elif self.filter_result is not None and text.startswith(self.filter_text):
+            result = [(key, e) for (key, e) in self.filter_result if text in key]
+        else:
+            result = [(key, e) for (key, e) in self.filter_index if text in key]
+
+        self.beginResetModel()
+        self.filter_text = text
+        self.filter_result = result
+        self.root = ObjectTreeNode(None, 0, None, self)
+        self.root.child_entries = self.all_entries if result is None else [e for (key, e) in result]
+        self.endResetModel()
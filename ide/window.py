@@ -14,6 +14,7 @@ from ide.editor.editor import Editor
 from ide.graphs import GraphPlotter
 from ide.navigation import NavigationManager
 from ide.undo import UndoManager
+from ide.widgets.treemodel import ObjectTreeModel
 
 
 class MainWindow(QMainWindow):
@@ -61,95 +62,34 @@ class MainWindow(QMainWindow):
         self.action_manager.tab_changed(self.tabWidget.currentIndex())
 
     def load_tree_items(self):
-        self.classesTreeWidget.clear()
+        entries = []
+        flat = self.classListFlatViewCheckbox.isChecked()
         for c in self.binary.classes:
-            class_item = QTreeWidgetItem([c.name])
-            class_item.func = None
-            class_item.cls = c
-            class_item.setIcon(0, QIcon(os.path.dirname(os.path.abspath(__file__)) + "/" + "icons/letters/c.png"))
-            self.classesTreeWidget.addTopLevelItem(class_item)
-
-            for m in c.methods:
-                method_item = QTreeWidgetItem([m.name])
-                method_item.func = m.function
-                method_item.cls = None
-                method_item.setIcon(0, QIcon(os.path.dirname(os.path.abspath(__file__)) + "/" + "icons/letters/m.png"))
-
-                if self.classListFlatViewCheckbox.isChecked():
-                    method_item.setText(0, m.function.name)
-                    self.classesTreeWidget.addTopLevelItem(method_item)
-                else:
-                    class_item.addChild(method_item)
+            entries.append(("class", c))
+            if flat:
+                entries += [("method", m) for m in c.methods]
 
         if self.showExternalClassesCheckbox.isChecked():
-            for c in list(self.binary.class_refs.values()):
-                class_item = QTreeWidgetItem(["(external) %s (in %s)" % (c.class_name, c.external_dylib)])
-                class_item.func = None
-                class_item.cls = None
-                class_item.setIcon(0, QIcon(os.path.dirname(os.path.abspath(__file__)) + "/" + "icons/letters/c.png"))
-                self.classesTreeWidget.addTopLevelItem(class_item)
+            entries += [("external_class", c) for c in self.binary.class_refs.values()]
 
-        self.classesTreeWidget.itemSelectionChanged.connect(self.selection_changed(self.classesTreeWidget))
+        self.set_tree_model(self.classesTreeWidget, ObjectTreeModel(entries, flat))
 
         self.classesTreeWidget.setFocus(Qt.ActiveWindowFocusReason)
-        if self.classesTreeWidget.topLevelItemCount() > 0:
-            self.classesTreeWidget.topLevelItem(0).setSelected(True)
-
-        self.functionsTreeWidget.clear()
-        for f in self.binary.functions:
-            func_item = QTreeWidgetItem([f.name])
-            func_item.func = f
-            func_item.cls = None
-            func_item.setIcon(0, QIcon(os.path.dirname(os.path.abspath(__file__)) + "/" + "icons/letters/f.png"))
-            self.functionsTreeWidget.addTopLevelItem(func_item)
-        self.functionsTreeWidget.itemSelectionChanged.connect(self.selection_changed(self.functionsTreeWidget))
-
-        self.blocksTreeWidget.clear()
-        for b in self.binary.block_descriptors:
-            block_item = QTreeWidgetItem([b.name])
-            block_item.func = None
-            block_item.cls = None
-            block_item.block = b
-            block_item.setIcon(0, QIcon(os.path.dirname(os.path.abspath(__file__)) + "/" + "icons/letters/b.png"))
-            self.blocksTreeWidget.addTopLevelItem(block_item)
-
-            for u in b.uses:
-                subblock_item = QTreeWidgetItem([u.name])
-                subblock_item.func = u.function if hasattr(u, "function") else None
-                subblock_item.cls = None
-                subblock_item.block = None
-                subblock_item.setIcon(0, QIcon(os.path.dirname(os.path.abspath(__file__)) + "/" + "icons/letters/m.png"))
-                block_item.addChild(subblock_item)
-
-                if hasattr(u, "invoke_func") and u.invoke_func is not None:
-                    invoke_item = QTreeWidgetItem(["Invoke: " + u.invoke_func.name])
-                    invoke_item.func = u.invoke_func
-                    invoke_item.cls = None
-                    invoke_item.block = None
-                    invoke_item.setIcon(0, QIcon(
-                        os.path.dirname(os.path.abspath(__file__)) + "/" + "icons/letters/f.png"))
-                    block_item.addChild(invoke_item)
-
-
-                if hasattr(u, "uses"):
-                    for u2 in u.uses:
-                        subblock2_item = QTreeWidgetItem([u2.name])
-                        subblock2_item.func = None
-                        subblock2_item.cls = None
-                        subblock2_item.block = None
-                        subblock2_item.setIcon(0, QIcon(
-                            os.path.dirname(os.path.abspath(__file__)) + "/" + "icons/letters/m.png"))
-                        subblock_item.addChild(subblock2_item)
-
-                    invoke_item = QTreeWidgetItem(["Invoke: " + u.invoke_func.name])
-                    invoke_item.func = u.invoke_func
-                    invoke_item.cls = None
-                    invoke_item.block = None
-                    invoke_item.setIcon(0, QIcon(
-                        os.path.dirname(os.path.abspath(__file__)) + "/" + "icons/letters/f.png"))
-                    subblock_item.addChild(invoke_item)
-
-        self.blocksTreeWidget.itemSelectionChanged.connect(self.selection_changed(self.blocksTreeWidget))
+        if self.classesTreeWidget.model().rowCount() > 0:
+            self.classesTreeWidget.setCurrentIndex(self.classesTreeWidget.model().index(0, 0))
+
+        self.set_tree_model(self.functionsTreeWidget, ObjectTreeModel([("function", f) for f in self.binary.functions]))
+        self.set_tree_model(self.blocksTreeWidget, ObjectTreeModel([("block", b) for b in self.binary.block_descriptors]))
+
+    def set_tree_model(self, view, model):
+        model.set_filter(self.treeFilterEdit.text())
+        if model.canFetchMore(QModelIndex()): model.fetchMore(QModelIndex())
+        view.setModel(model)
+        view.selectionModel().selectionChanged.connect(self.selection_changed(view))
+
+    def filter_changed(self, text):
+        for view in [self.classesTreeWidget, self.functionsTreeWidget, self.blocksTreeWidget]:
+            view.model().set_filter(text)
 
     def setup_editor(self):
         self.class_dump_editor = Editor()
@@ -172,7 +112,8 @@ class MainWindow(QMainWindow):
 
     def selection_changed(self, widget):
         def f():
-            selected_item = widget.selectedItems()[0] if len(widget.selectedItems()) > 0 else None
+            indexes = widget.selectionModel().selectedIndexes()
+            selected_item = indexes[0].internalPointer() if len(indexes) > 0 else None
             if selected_item is None: return
 
             if selected_item.func:
@@ -205,32 +146,37 @@ class MainWindow(QMainWindow):
 
     def func_clicked(self, func):
         self.selected_func = func
-        func.load()
-        self.reload_func()
+        # A prefetch holds the lock for a whole step, cancelled it gives the lock up at its next progress report.
+        self.app.worker.cancel_speculative()
+        with self.binary.lock:
+            func.load()
+            self.reload_func()
         self.goto_tab(self.TAB_DISASSEMBLY)
+        self.action_manager.prefetch_around(func)
 
     def reload_assembly_instructions(self, func):
         ucode, line_map = func.print_asm_intructions()
         self.disassembly_editor.set_text(ucode, line_map)
 
     def reload_func(self):
-        func = self.selected_func
+        with self.binary.lock:
+            func = self.selected_func
 
-        self.tabWidget.setTabEnabled(self.TAB_DISASSEMBLY, True)
-        self.tabWidget.setTabEnabled(self.TAB_BASIC_BLOCKS, func.bbs is not None)
-        self.tabWidget.setTabEnabled(self.TAB_UCODE, func.ufunction is not None)
-        self.tabWidget.setTabEnabled(self.TAB_CFG, func.ufunction is not None and func.ufunction.cfg is not None)
-        self.tabWidget.setTabEnabled(self.TAB_SOURCE, func.ast is not None)
+            self.tabWidget.setTabEnabled(self.TAB_DISASSEMBLY, True)
+            self.tabWidget.setTabEnabled(self.TAB_BASIC_BLOCKS, func.bbs is not None)
+            self.tabWidget.setTabEnabled(self.TAB_UCODE, func.ufunction is not None)
+            self.tabWidget.setTabEnabled(self.TAB_CFG, func.ufunction is not None and func.ufunction.cfg is not None)
+            self.tabWidget.setTabEnabled(self.TAB_SOURCE, func.ast is not None)
 
-        self.reload_assembly_instructions(func)
+            self.reload_assembly_instructions(func)
 
-        self.reload_basic_blocks(func)
+            self.reload_basic_blocks(func)
 
-        self.reload_ucode()
+            self.reload_ucode()
 
-        self.reload_ucode_cfg(func)
+            self.reload_ucode_cfg(func)
 
-        self.reload_source()
+            self.reload_source()
 
     def reload_ucode(self):
         func = self.selected_func
@@ -416,8 +362,10 @@ class MainWindow(QMainWindow):
         uic.loadUi(self.ui_path, self)
 
         # Define type hints for widgets.
-        self.classesTreeWidget = self.classesTreeWidget; """:type : QTreeWidget"""
-        self.functionsTreeWidget = self.functionsTreeWidget; """:type : QTreeWidget"""
+        self.classesTreeWidget = self.classesTreeWidget; """:type : QTreeView"""
+        self.functionsTreeWidget = self.functionsTreeWidget; """:type : QTreeView"""
+        self.blocksTreeWidget = self.blocksTreeWidget; """:type : QTreeView"""
+        self.treeFilterEdit = self.treeFilterEdit; """:type : QLineEdit"""
         self.stackedWidget = self.stackedWidget; """:type : QStackedWidget"""
         self.splitter = self.splitter; """:type : QSplitter"""
         self.disassemblyTextEdit = self.disassemblyTextEdit; """:type : QTextEdit"""
@@ -461,6 +409,7 @@ class MainWindow(QMainWindow):
 
         self.showExternalClassesCheckbox.clicked.connect(self.load_tree_items)
         self.classListFlatViewCheckbox.clicked.connect(self.load_tree_items)
+        self.treeFilterEdit.textChanged.connect(self.filter_changed)
 
         self.setWindowTitle("Cricket - %s" % self.binary.full_path)
 
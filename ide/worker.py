@@ -0,0 +1,158 @@
+import threading
+import traceback
+
+from PyQt5.QtCore import *
+from PyQt5.QtWidgets import *
+
+
+class AnalysisCancelled(Exception):
+    pass
+
+
+# One unit of work for the AnalysisWorker. 'fn' is called on the worker thread with a progress callback object that
+# has the same progress(s, value=None) interface as Binary.load_progress_callback, and raises AnalysisCancelled from
+# there once the job is cancelled.
+class AnalysisJob:
+    def __init__(self, name, fn, key=None, speculative=False):
+        self.name = name
+        self.fn = fn
+        self.key = key
+        self.speculative = speculative
+        self.cancelled = False
+        self.done = False
+        self.result = None
+        self.error = None
+
+
+class AnalysisJobProgress:
+    def __init__(self, worker, job):
+        self.worker = worker
+        self.job = job
+
+    def progress(self, s, value=None):
+        if self.job.cancelled: raise AnalysisCancelled()
+        self.worker.job_progress.emit(self.job, s, -1.0 if value is None else float(value))
+
+
+# Runs binary loads and decompilation pipelines on a background thread, one job at a time, so the Qt event loop keeps
+# running. Foreground jobs are queued ahead of speculative (prefetch) jobs, and submitting a foreground job for a key
+# that is already being prefetched just promotes the prefetch.
+class AnalysisWorker(QThread):
+    job_progress = pyqtSignal(object, str, float)
+    job_finished = pyqtSignal(object)
+
+    def __init__(self):
+        QThread.__init__(self)
+        self.condition = threading.Condition()
+        self.queue = []
+        self.current = None
+        self.stopping = False
+
+    def submit(self, job):
+        with self.condition:
+            for other in [self.current] + self.queue:
+                if other is None or other.cancelled or job.key is None or other.key != job.key: continue
+                if not job.speculative and other.speculative:
+                    other.speculative = False
+                    if other in self.queue:
+                        self.queue.remove(other)
+                        self.insert(other)
+                return other
+
+            self.insert(job)
+            self.condition.notify()
+        return job
+
+    def insert(self, job):
+        idx = len(self.queue)
+        if not job.speculative:
+            idx = len([j for j in self.queue if not j.speculative])
+        self.queue.insert(idx, job)
+
+    # Turns a queued or running speculative job into a foreground one.
+    def promote(self, job):
+        with self.condition:
+            if not job.speculative: return
+            job.speculative = False
+            if job in self.queue:
+                self.queue.remove(job)
+                self.insert(job)
+
+    def cancel(self, job):
+        with self.condition:
+            job.cancelled = True
+            if job in self.queue:
+                self.queue.remove(job)
+                job.done = True
+                self.job_finished.emit(job)
+
+    def cancel_speculative(self):
+        with self.condition:
+            for job in [self.current] + list(self.queue):
+                if job is not None and job.speculative: self.cancel(job)
+
+    # The queued or running job for 'key', if there is one.
+    def find(self, key):
+        with self.condition:
+            for job in [self.current] + self.queue:
+                if job is not None and not job.cancelled and job.key == key: return job
+        return None
+
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            for job in list(self.queue): self.cancel(job)
+            if self.current is not None: self.current.cancelled = True
+            self.condition.notify()
+        self.wait()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while len(self.queue) == 0 and not self.stopping:
+                    self.condition.wait()
+                if self.stopping: return
+                job = self.queue.pop(0)
+                self.current = job
+
+            try:
+                job.result = job.fn(AnalysisJobProgress(self, job))
+            except AnalysisCancelled:
+                job.cancelled = True
+            except Exception:
+                job.error = traceback.format_exc()
+
+            with self.condition:
+                self.current = None
+                job.done = True
+            self.job_finished.emit(job)
+
+    # Runs a nested event loop until the job is done, showing its progress in 'dialog' (a QProgressDialog, its cancel
+    # button cancels the job). Returns the job.
+    def wait_for(self, job, dialog=None):
+        if job.done: return job
+
+        loop = QEventLoop()
+
+        def on_progress(j, s, value):
+            if j is not job or dialog is None: return
+            if value >= 0:
+                s += " %.2f%%" % (value * 100)
+                dialog.setValue(int(value * 100))
+            else:
+                # Some super fake progress
+                v = dialog.value()
+                v = int((v + 99) / 2)
+                dialog.setValue(v)
+            dialog.setLabelText(s)
+
+        def on_finished(j):
+            if j is job: loop.quit()
+
+        self.job_progress.connect(on_progress)
+        self.job_finished.connect(on_finished)
+        if dialog is not None: dialog.canceled.connect(lambda: self.cancel(job))
+        if not job.done: loop.exec_()
+        self.job_progress.disconnect(on_progress)
+        self.job_finished.disconnect(on_finished)
+        return job